@@ -0,0 +1,337 @@
+# Benchmark of the dashboard pipeline of map_count_distribution_visualization.py
+# python map_count_distribution_benchmark.py -o bench.json
+# python map_count_distribution_benchmark.py --cases 51x696x23 500x5000x50 --compare bench.json
+
+import argparse
+import csv
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple, OrderedDict
+
+import bokeh
+import numpy as np
+
+import map_count_distribution_visualization as mcdv
+
+
+###############################################
+#synthetic data of any size, in the same .csv layout as the real data
+#params:
+#   @n_states, n_occupations, n_careerareas, n_groups: size of the data
+#   @seed: seed of the random generator, the same seed gives the same files
+#return:
+#   make_synthetic_states_map gives a us states map like bokeh sampledata, real states first,
+#   then square states on a grid over the map once there are more than the real ones
+#   make_synthetic_world gives world borders (names, xs, ys) like load_geo_world
+###############################################
+
+def make_synthetic_states_map(n_states):
+    real = sorted(mcdv.get_states_map().items(), key = lambda item: item[1]['name'])
+    synthetic = dict(real[:n_states])
+    n_extra = n_states - len(synthetic)
+    side = int(np.ceil(np.sqrt(max(n_extra, 1))))
+    x0, x1 = mcdv.MAP_X_RANGE
+    y0, y1 = mcdv.MAP_Y_RANGE
+    width, height = (x1 - x0) / side, (y1 - y0) / side
+    for i in range(n_extra):
+        left, bottom = x0 + (i % side) * width, y0 + (i // side) * height
+        synthetic['S%05d' % i] = dict(name = 'Synthetic %05d' % i,
+            lons = [left, left + width, left + width, left], lats = [bottom, bottom, bottom + height, bottom + height])
+    return synthetic
+
+
+def make_synthetic_world(n_countries = 180, n_vertices = 400, seed = 0):
+    rs = np.random.RandomState(seed)
+    names, xs, ys = [], [], []
+    for i in range(n_countries):
+        angle = np.linspace(0, 2 * np.pi, n_vertices, endpoint = False)
+        radius = rs.uniform(2, 12) * (1 + 0.1 * rs.standard_normal(n_vertices))
+        x0, y0 = rs.uniform(-180, 180), rs.uniform(-60, 80)
+        names.append('Country %03d' % i)
+        xs.append((x0 + radius * np.cos(angle)).astype(np.float32))
+        ys.append((y0 + radius * np.sin(angle)).astype(np.float32))
+    return names, xs, ys
+
+
+def write_synthetic_counts(filepath, states_map, n_occupations, seed = 0):
+    rs = np.random.RandomState(seed)
+    state_names = sorted(state['name'] for state in states_map.values())
+    # a few big occupations and a long tail, like job postings
+    scale = rs.pareto(1.2, n_occupations) * 100
+    counts = rs.poisson(scale[None, :] * rs.uniform(0.1, 2, (len(state_names), 1)))
+    with open(filepath, "w", newline = "") as f:
+        writer = csv.writer(f, quoting = csv.QUOTE_ALL)
+        writer.writerow(["State"] + [str(Id) for Id in range(1, n_occupations + 1)])
+        for name, row in zip(state_names, counts):
+            writer.writerow([name] + row.tolist())
+
+
+def write_synthetic_occupations(filepath, n_occupations, n_careerareas, n_groups = None, seed = 0):
+    rs = np.random.RandomState(seed)
+    if n_groups is None:
+        n_groups = max(n_careerareas, n_occupations // 4)
+    group_careerarea = rs.randint(n_careerareas, size = n_groups)
+    with open(filepath, "w", newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "firststep", "starterjob", "occupation_group_id", "occupation_group_name",
+            "careerarea_id", "careerarea_name"])
+        for Id in range(1, n_occupations + 1):
+            group = rs.randint(n_groups)
+            careerarea = group_careerarea[group]
+            writer.writerow([Id, "TRUE" if rs.rand() < 0.3 else "FALSE", "TRUE" if rs.rand() < 0.4 else "FALSE",
+                group, "Group %d" % group, careerarea, "Career area %d" % careerarea])
+
+
+
+
+###############################################
+#run the pipeline of one case stage by stage, timing every stage
+#params:
+#   @counts_path, occupations_path: count and occupation info .csv files
+#   @world, states_map: world borders and us states map of the case
+#   @output: html file to write
+#   @stage_hook: function(name, function) runs a stage and gives its result
+#return:
+#   None, the stage hook records whatever it measures
+###############################################
+
+def run_pipeline(counts_path, occupations_path, world, states_map, output, stage_hook):
+    count_matrix = stage_hook('counts', lambda: mcdv.load_count_matrix(counts_path, cache = False, binary_cache = False))
+    occupation_info = stage_hook('occupations', lambda: mcdv.get_occupation_info(occupations_path, binary_cache = False))
+    occupation_index = stage_hook('index', lambda: mcdv.get_occupation_index(occupation_info, count_matrix))
+    world_source = stage_hook('world', lambda: mcdv.build_world_source(world))
+    geography = mcdv.get_states_geography(states_map)
+    count_matrix = mcdv.align_count_rows(count_matrix, geography)
+    data = mcdv.DashboardData(count_matrix, occupation_info, occupation_index, world, geography, None, None)
+
+    cube = stage_hook('aggregate', lambda: mcdv.aggregate_dashboard_data(data))
+    # parts of the source stage on their own, not counted in the total
+    stage_hook('states_source', lambda: mcdv.get_source_geo_and_count_us_continent(cube, geography))
+    stage_hook('career_source', lambda: mcdv.get_source_careerarea_experience_count(
+        mcdv.get_career_rankings(occupation_index, cube, count_matrix)))
+    stage_hook('geo_lookup', lambda: lookup_synthetic_points(states_map))
+    sources = stage_hook('sources', lambda: mcdv.build_dashboard_sources(data, cube, world_source = world_source))
+    stage_hook('render', lambda: mcdv.render_dashboard(data, sources, output))
+
+
+# geocode postings spread over the map into states, the index is built in the stage too
+GEO_LOOKUP_POINTS = 100000
+
+def lookup_synthetic_points(states_map, n_points = GEO_LOOKUP_POINTS, seed = 0):
+    rs = np.random.RandomState(seed)
+    lons = rs.uniform(mcdv.MAP_X_RANGE[0], mcdv.MAP_X_RANGE[1], n_points)
+    lats = rs.uniform(mcdv.MAP_Y_RANGE[0], mcdv.MAP_Y_RANGE[1], n_points)
+    return mcdv.lookup_geo_index(mcdv.get_states_geo_index(states_map), lons, lats)
+
+
+def time_stage(stage_seconds):
+    def stage_hook(name, function):
+        start = time.perf_counter()
+        result = function()
+        stage_seconds[name] = time.perf_counter() - start
+        return result
+    return stage_hook
+
+
+# peak of python and numpy allocations during each stage
+def trace_stage(stage_peak_bytes):
+    def stage_hook(name, function):
+        reset_traced_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = function()
+        stage_peak_bytes[name] = tracemalloc.get_traced_memory()[1] - before
+        return result
+    return stage_hook
+
+
+# tracemalloc.reset_peak is new in python 3.9, before it the tracing restarts, so that the stage is measured from 0
+def reset_traced_peak():
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+
+
+###############################################
+#benchmark one case: the best wall time of a few runs and the peak memory of one more traced run,
+#tracing allocations slows the run down, so it is never timed
+#params:
+#   @case: Case of its name and the files and maps it runs on
+#   @repeat: number of timed runs
+#   @work_dir: directory of the html files
+#return:
+#   OrderedDict of the results of the case
+###############################################
+
+Case = namedtuple('Case', ['name', 'counts_path', 'occupations_path', 'world', 'states_map', 'size'])
+
+PART_STAGES = ('states_source', 'career_source', 'geo_lookup')
+
+def benchmark_case(case, repeat, work_dir):
+    output = os.path.join(work_dir, case.name + ".html")
+    runs = []
+    for _ in range(repeat):
+        stage_seconds = OrderedDict()
+        run_pipeline(case.counts_path, case.occupations_path, case.world, case.states_map, output,
+            time_stage(stage_seconds))
+        runs.append(stage_seconds)
+
+    stage_peak_bytes = OrderedDict()
+    tracemalloc.start()
+    try:
+        run_pipeline(case.counts_path, case.occupations_path, case.world, case.states_map, output,
+            trace_stage(stage_peak_bytes))
+    finally:
+        tracemalloc.stop()
+
+    stages = OrderedDict((name, OrderedDict([
+        ('seconds', min(run[name] for run in runs)),
+        ('peak_bytes', stage_peak_bytes[name])])) for name in runs[0])
+    return OrderedDict([
+        ('name', case.name),
+        ('size', case.size),
+        ('seconds', min(sum(seconds for name, seconds in run.items() if name not in PART_STAGES) for run in runs)),
+        ('html_bytes', os.path.getsize(output)),
+        ('stages', stages)])
+
+
+def get_synthetic_case(name, work_dir, seed = 0):
+    n_states, n_occupations, n_careerareas = [int(n) for n in name.split('x')]
+    states_map = make_synthetic_states_map(n_states)
+    counts_path = os.path.join(work_dir, name + "-counts.csv")
+    occupations_path = os.path.join(work_dir, name + "-occupations.csv")
+    write_synthetic_counts(counts_path, states_map, n_occupations, seed)
+    write_synthetic_occupations(occupations_path, n_occupations, n_careerareas, seed = seed)
+    size = OrderedDict([('states', n_states), ('occupations', n_occupations), ('careerareas', n_careerareas)])
+    return Case(name, counts_path, occupations_path, make_synthetic_world(seed = seed), states_map, size)
+
+
+# the data of the repository, with synthetic world borders so that no network is needed
+def get_real_case(seed = 0):
+    count_matrix = mcdv.load_count_matrix(mcdv.COUNT_FILEPATH, cache = False, binary_cache = False)
+    n_careerareas = len(set(mcdv.get_occupation_info(mcdv.OCCUPATION_FILEPATH, binary_cache = False)[3]))
+    size = OrderedDict([('states', len(count_matrix.states)), ('occupations', len(count_matrix.occupation_ids)),
+        ('careerareas', n_careerareas)])
+    return Case('real', mcdv.COUNT_FILEPATH, mcdv.OCCUPATION_FILEPATH, make_synthetic_world(seed = seed),
+        mcdv.get_states_map(), size)
+
+
+
+
+###############################################
+#compare results with those of an earlier run
+#params:
+#   @results, baseline: results given by run_benchmark, or read from its json file
+#   @threshold: relative growth of a measure that counts as a regression, 0.2 is 20% slower or bigger
+#   @min_seconds: stages faster than this in both runs are noise and never compared
+#return:
+#   list of regressions (case, measure, baseline value, new value)
+###############################################
+
+def compare_results(results, baseline, threshold = 0.2, min_seconds = 0.005):
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        old = baseline_cases.get(case['name'])
+        if old is None or old['size'] != case['size']:
+            continue
+        measures = [('seconds', old['seconds'], case['seconds']), ('html_bytes', old['html_bytes'], case['html_bytes'])]
+        for name, stage in case['stages'].items():
+            if name not in old['stages']:
+                continue
+            old_stage = old['stages'][name]
+            if max(old_stage['seconds'], stage['seconds']) >= min_seconds:
+                measures.append((name + '.seconds', old_stage['seconds'], stage['seconds']))
+            measures.append((name + '.peak_bytes', old_stage['peak_bytes'], stage['peak_bytes']))
+        for measure, old_value, new_value in measures:
+            if new_value > old_value * (1 + threshold) and new_value > 0:
+                regressions.append((case['name'], measure, old_value, new_value))
+    return regressions
+
+
+
+
+###############################################
+#run every case and put the results together
+#params:
+#   @case_names: 'real' for the data of the repository, or states x occupations x careerareas like '51x696x23'
+#   @repeat: number of timed runs of each case
+#   @seed: seed of the synthetic data
+#return:
+#   OrderedDict of the environment and the results of every case
+###############################################
+
+DEFAULT_CASES = ['real', '51x696x23', '51x2000x23', '51x5000x50', '200x696x23', '500x5000x50']
+
+def run_benchmark(case_names = DEFAULT_CASES, repeat = 3, seed = 0):
+    work_dir = tempfile.mkdtemp(prefix = "map-benchmark-")
+    try:
+        cases = []
+        for name in case_names:
+            case = get_real_case(seed) if name == 'real' else get_synthetic_case(name, work_dir, seed)
+            cases.append(benchmark_case(case, repeat, work_dir))
+            print_case(cases[-1])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+    return OrderedDict([
+        ('created', time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('bokeh', bokeh.__version__),
+        ('repeat', repeat),
+        ('cases', cases)])
+
+
+def print_case(case):
+    print("%s: %.3f s, html %.1f kB" % (case['name'], case['seconds'], case['html_bytes'] / 1024.))
+    for name, stage in case['stages'].items():
+        print("  %-14s %8.4f s  peak %8.1f kB" % (name, stage['seconds'], stage['peak_bytes'] / 1024.))
+
+
+
+
+###############################################
+#command line entry point, exits with status 1 when a regression is found
+#params:
+#   @argv: command line arguments, default as sys.argv
+###############################################
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the job posting map dashboard pipeline.")
+    parser.add_argument("--cases", nargs = "+", default = DEFAULT_CASES,
+        help = "'real' or synthetic sizes as states x occupations x careerareas, e.g. 51x696x23")
+    parser.add_argument("--repeat", type = int, default = 3, help = "timed runs of each case, the best one is kept")
+    parser.add_argument("--seed", type = int, default = 0, help = "seed of the synthetic data")
+    parser.add_argument("-o", "--output", default = None, help = "json file to write the results to")
+    parser.add_argument("--compare", default = None, help = "json file of an earlier run to check for regressions")
+    parser.add_argument("--threshold", type = float, default = 0.2, help = "relative growth that counts as regression")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.cases, args.repeat, args.seed)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.threshold)
+        for name, measure, old_value, new_value in regressions:
+            print("regression %s %s: %.4g -> %.4g (%+.0f%%)" % (
+                name, measure, old_value, new_value, (new_value / old_value - 1) * 100 if old_value else float('inf')))
+        if regressions:
+            sys.exit(1)
+        print("no regression over %.0f%%" % (args.threshold * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,829 @@
+# Count data of the job posting dashboard of map_count_distribution_visualization.py, without bokeh:
+# parsing and caching of the count and occupation .csv files, the occupation index and the aggregation of counts,
+# and the opt-in tracing of the build stages
+
+import csv
+import functools
+import glob
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+###############################################
+#opt-in instrumentation of the build stages, nothing is recorded outside of trace_stages
+#params:
+#   @path: chrome trace json file written when tracing ends, None to write nothing
+#   @memory: trace allocations of python and numpy with tracemalloc, it slows the build down, python 3.9 or later
+#   @name: name of the stage, traced_stage decorates a function and stage_span wraps a block
+#return:
+#   trace_stages gives the StageTrace of the records of every stage, in order of their end
+###############################################
+
+StageRecord = namedtuple('StageRecord', ['name', 'start', 'seconds', 'cpu_seconds', 'alloc_bytes', 'rows', 'columns',
+    'pid', 'tid'])
+
+class StageTrace(object):
+
+    def __init__(self, memory = False):
+        self.memory = memory
+        self.records = []
+        # peak memory of the stages still running, innermost last
+        self.peaks = []
+
+    def to_chrome_trace(self):
+        events = []
+        for record in self.records:
+            args = OrderedDict([('cpu_ms', record.cpu_seconds * 1e3)])
+            for name in ('alloc_bytes', 'rows', 'columns'):
+                if getattr(record, name) is not None:
+                    args[name] = getattr(record, name)
+            events.append(OrderedDict([('name', record.name), ('cat', 'stage'), ('ph', 'X'),
+                ('ts', record.start * 1e6), ('dur', record.seconds * 1e6),
+                ('pid', record.pid), ('tid', record.tid), ('args', args)]))
+        return dict(traceEvents = events, displayTimeUnit = 'ms')
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+    # wall and cpu time, calls and largest allocation of each stage name, slowest first
+    def summary(self):
+        stages = OrderedDict()
+        for record in self.records:
+            stage = stages.setdefault(record.name, dict(calls = 0, seconds = 0., cpu_seconds = 0., alloc_bytes = None))
+            stage['calls'] += 1
+            stage['seconds'] += record.seconds
+            stage['cpu_seconds'] += record.cpu_seconds
+            if record.alloc_bytes is not None:
+                stage['alloc_bytes'] = max(stage['alloc_bytes'] or 0, record.alloc_bytes)
+        return OrderedDict(sorted(stages.items(), key = lambda item: -item[1]['seconds']))
+
+
+def print_stage_trace(trace):
+    for name, stage in trace.summary().items():
+        print("  %-40s %4d calls %9.4f s  cpu %9.4f s%s" % (name, stage['calls'], stage['seconds'], stage['cpu_seconds'],
+            "" if stage['alloc_bytes'] is None else "  alloc %9.1f kB" % (stage['alloc_bytes'] / 1024.)))
+
+
+# the trace of this process, set by trace_stages
+_stage_trace = {}
+
+@contextmanager
+def trace_stages(path = None, memory = False):
+    # nested stages reset the peak of the running ones, there is no way to do so before tracemalloc.reset_peak
+    if memory and not hasattr(tracemalloc, 'reset_peak'):
+        raise ValueError("tracing memory needs python 3.9 or later")
+    trace = StageTrace(memory)
+    previous = _stage_trace.get('trace')
+    _stage_trace['trace'] = trace
+    if memory:
+        tracemalloc.start()
+    try:
+        yield trace
+    finally:
+        if memory:
+            tracemalloc.stop()
+        _stage_trace['trace'] = previous
+        if path is not None:
+            trace.write(path)
+
+
+@contextmanager
+def stage_span(name):
+    trace = _stage_trace.get('trace')
+    span = {}
+    if trace is None:
+        yield span
+        return
+    if trace.memory:
+        # the peak of the running stages is kept before it is reset for this one
+        peak = tracemalloc.get_traced_memory()[1]
+        trace.peaks = [max(p, peak) for p in trace.peaks]
+        tracemalloc.reset_peak()
+        trace.peaks.append(0)
+        memory_start = tracemalloc.get_traced_memory()[0]
+    start, wall_start, cpu_start = time.time(), time.perf_counter(), time.process_time()
+    try:
+        yield span
+    finally:
+        seconds, cpu_seconds = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        alloc_bytes = None
+        if trace.memory:
+            peak = max(trace.peaks.pop(), tracemalloc.get_traced_memory()[1])
+            trace.peaks = [max(p, peak) for p in trace.peaks]
+            alloc_bytes = peak - memory_start
+        rows, columns = get_stage_size(span.get('result'))
+        trace.records.append(StageRecord(name, start, seconds, cpu_seconds, alloc_bytes, rows, columns,
+            os.getpid(), threading.get_ident()))
+
+
+def traced_stage(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            if _stage_trace.get('trace') is None:
+                return function(*args, **kwargs)
+            with stage_span(name) as span:
+                span['result'] = function(*args, **kwargs)
+            return span['result']
+        return traced
+    return decorator
+
+
+# rows and columns of what a stage gives: a count matrix or cube, a geo index, rankings, a source, or its column dict,
+# told apart by their fields, the types of the dashboard are not imported here
+def get_stage_size(result):
+    if hasattr(result, 'counts') and hasattr(result.counts, 'shape'):
+        return int(np.prod(result.counts.shape[:-1])), int(result.counts.shape[-1])
+    # GeoIndex
+    if hasattr(result, 'names') and hasattr(result, 'edges'):
+        return len(result.names), None
+    # CareerRankings
+    if hasattr(result, 'groups') and hasattr(result.groups, 'indptr'):
+        return len(result.groups.items), None
+    # ColumnDataSource
+    if isinstance(getattr(result, 'data', None), dict):
+        result = result.data
+    if hasattr(result, 'states') and isinstance(result.states, dict):
+        result = result.states
+    if isinstance(result, dict) and result:
+        return len(next(iter(result.values()))), len(result)
+    if isinstance(result, np.ndarray) and result.ndim:
+        return int(result.shape[0]), int(np.prod(result.shape[1:]))
+    return None, None
+
+
+
+
+###############################################
+#parse the count .csv file once into a state x occupation id matrix
+#rows are parsed in chunks into a preallocated int32 matrix, so memory stays bounded by the matrix itself
+#params:
+#   @filepath: .csv file with a 'State' column followed by one column per occupation id
+#   @cache: keep the parsed matrix in _count_matrix_cache so the file is only read once, until its size or
+#           modification time changes
+#   @columns: occupation ids to keep, None for all of them, the other columns are never converted
+#   @chunk_rows: number of rows parsed at a time, default as COUNT_CHUNK_CELLS cells whatever the file width is
+#   @mmap_path: .npy file to write the matrix to and memory-map, None to keep it in memory
+#   @binary_cache: keep the parsed matrix in BINARY_CACHE_DIR next to the .csv file and memory-map it
+#                  on later runs, as long as the .csv file does not change
+#return:
+#   CountMatrix of state names, occupation ids, int32 matrix of counts (state x occupation)
+#   and a dict that maps occupation id to its column in the matrix
+###############################################
+
+COUNT_FILEPATH = "Count-allOccupations-Continent.csv"
+COUNT_CHUNK_CELLS = 1 << 18
+
+CountMatrix = namedtuple('CountMatrix', ['states', 'occupation_ids', 'counts', 'column_index'])
+
+# (path, columns) -> (file signature, CountMatrix)
+_count_matrix_cache = {}
+
+@traced_stage('load_count_matrix')
+def load_count_matrix(filepath = COUNT_FILEPATH, cache = True, columns = None, chunk_rows = None,
+        mmap_path = None, binary_cache = True):
+    cache_key = (os.path.abspath(filepath), None if columns is None else tuple(sorted(columns)))
+    signature = get_file_signature(filepath) if cache else None
+    if cache and cache_key in _count_matrix_cache:
+        cached_signature, count_matrix = _count_matrix_cache[cache_key]
+        if cached_signature == signature:
+            return count_matrix
+
+    count_matrix = None
+    if binary_cache and mmap_path is None:
+        count_matrix = read_count_matrix_cache(filepath, columns)
+        # the whole matrix goes to the binary cache, a subset of columns is taken from it afterwards
+        if count_matrix is None and columns is None:
+            count_matrix = write_count_matrix_cache(filepath, chunk_rows)
+    if count_matrix is None:
+        count_matrix = parse_count_matrix(filepath, columns, chunk_rows, mmap_path)
+    if cache:
+        _count_matrix_cache[cache_key] = (signature, count_matrix)
+    return count_matrix
+
+
+@traced_stage('parse_count_matrix')
+def parse_count_matrix(filepath, columns = None, chunk_rows = None, mmap_path = None):
+
+    # first pass only counts the rows, so that the matrix can be allocated once
+    with open(filepath, "r") as csvfile:
+        n_states = sum(1 for line in csvfile if line.strip()) - 1
+
+    with open(filepath, "r") as csvfile:
+        data = csv.reader(csvfile)
+        headers = data.__next__()
+        header_ids = [int(h) for h in headers[1:]]
+        if columns is None:
+            positions = list(range(len(header_ids)))
+        else:
+            wanted = set(columns)
+            positions = [p for p, Id in enumerate(header_ids) if Id in wanted]
+        occupation_ids = np.array([header_ids[p] for p in positions], dtype = np.int64)
+
+        shape = (n_states, len(positions))
+        if mmap_path is None:
+            counts = np.zeros(shape, dtype = np.int32)
+        else:
+            counts = np.lib.format.open_memmap(mmap_path, mode = "w+", dtype = np.int32, shape = shape)
+
+        if chunk_rows is None:
+            chunk_rows = max(1, COUNT_CHUNK_CELLS // max(1, len(headers)))
+        states = []
+        for start, chunk in iter_count_chunks(data, chunk_rows):
+            # the first item of each row is an instance of 'State', not an int
+            states.extend(row[0] for row in chunk)
+            if columns is None:
+                text = ','.join(','.join(row[1:]) for row in chunk)
+            else:
+                text = ','.join(row[p + 1] for row in chunk for p in positions)
+            # numbers of the whole chunk are parsed by numpy in one call, instead of int() per cell
+            values = np.fromstring(text, dtype = np.int64, sep = ',') if positions else np.zeros(0, dtype = np.int64)
+            if len(values) != len(chunk) * len(positions):
+                raise ValueError("%s: rows %d-%d don't have one integer count per occupation column" % (
+                    filepath, start + 2, start + len(chunk) + 1))
+            counts[start:start + len(chunk)] = values.reshape(len(chunk), len(positions))
+
+    if len(states) != n_states:
+        counts = counts[:len(states)]
+    if mmap_path is not None:
+        counts.flush()
+
+    column_index = {Id: i for i, Id in enumerate(occupation_ids.tolist())}
+    return CountMatrix(states, occupation_ids, counts, column_index)
+
+
+# give (index of first row, list of rows) of every chunk of chunk_rows non empty rows
+def iter_count_chunks(data, chunk_rows):
+    start = 0
+    chunk = []
+    for row in data:
+        if not row:
+            continue
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield start, chunk
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        yield start, chunk
+
+
+
+
+###############################################
+#binary cache of parsed .csv files, kept in BINARY_CACHE_DIR next to each .csv file
+#a cache is valid while size and mtime of its .csv file stay the same, or when the content hash is still the same
+#params:
+#   @filepath: the .csv file
+#   @kind: 'counts' or 'occupations'
+#return:
+#   read_binary_cache_meta gives the meta dict of a valid cache, or None
+###############################################
+
+BINARY_CACHE_DIR = ".dashboard_cache"
+
+# bump it when the layout of cache files changes, so that old caches are invalid
+BINARY_CACHE_VERSION = 1
+
+def get_binary_cache_path(filepath, kind):
+    directory, name = os.path.split(os.path.abspath(filepath))
+    return os.path.join(directory, BINARY_CACHE_DIR, "%s.%s" % (name, kind))
+
+
+def get_file_signature(filepath):
+    stat = os.stat(filepath)
+    return dict(size = stat.st_size, mtime = stat.st_mtime_ns)
+
+
+# a new temporary file next to a cache file, processes that write the same cache at once never share one,
+# the caller renames it over the cache file once it is fully written
+def get_temp_path(path):
+    directory, name = os.path.split(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir = directory, prefix = name + ".", suffix = ".tmp", delete = False) as f:
+        return f.name
+
+
+def remove_temp_path(temp_path):
+    try:
+        os.remove(temp_path)
+    except OSError:
+        pass
+
+
+def get_file_hash(filepath):
+    sha1 = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_binary_cache_meta(filepath, kind):
+    meta_path = get_binary_cache_path(filepath, kind) + ".json"
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != BINARY_CACHE_VERSION:
+        return None
+    signature = get_file_signature(filepath)
+    if meta['size'] == signature['size'] and meta['mtime'] == signature['mtime']:
+        return meta
+    # the file is touched or copied but maybe not changed, trust the content hash then
+    if meta['size'] == signature['size'] and meta['sha1'] == get_file_hash(filepath):
+        meta.update(signature)
+        write_binary_cache_meta(filepath, kind, meta)
+        return meta
+    return None
+
+
+# the meta file is written last, so that a cache is only used once all of it is written,
+# size, mtime and sha1 of the file are taken now unless meta has those the cache was made from
+def write_binary_cache_meta(filepath, kind, meta):
+    meta = dict(meta, version = BINARY_CACHE_VERSION)
+    if 'size' not in meta:
+        meta.update(get_file_signature(filepath))
+    if 'sha1' not in meta:
+        meta['sha1'] = get_file_hash(filepath)
+    meta_path = get_binary_cache_path(filepath, kind) + ".json"
+    temp_path = get_temp_path(meta_path)
+    with open(temp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(temp_path, meta_path)
+
+
+###############################################
+#read and write the count matrix of a .csv file in the binary cache, the matrix is a memory-mapped .npy file
+#params:
+#   @filepath: count .csv file
+#   @columns: occupation ids to keep, None for all of them
+#return:
+#   CountMatrix, or None if there is no valid cache (read) or it cannot be written (write)
+###############################################
+
+def read_count_matrix_cache(filepath, columns = None):
+    meta = read_binary_cache_meta(filepath, 'counts')
+    if meta is None:
+        return None
+    try:
+        counts = np.load(get_binary_cache_path(filepath, 'counts') + ".npy", mmap_mode = "r")
+    except (OSError, ValueError):
+        return None
+    occupation_ids = np.array(meta['occupation_ids'], dtype = np.int64)
+    if columns is not None:
+        wanted = set(columns)
+        positions = [p for p, Id in enumerate(meta['occupation_ids']) if Id in wanted]
+        occupation_ids = occupation_ids[positions]
+        counts = np.ascontiguousarray(counts[:, positions])
+    column_index = {Id: i for i, Id in enumerate(occupation_ids.tolist())}
+    return CountMatrix(meta['states'], occupation_ids, counts, column_index)
+
+
+def write_count_matrix_cache(filepath, chunk_rows = None):
+    cache_path = get_binary_cache_path(filepath, 'counts')
+    temp_path = None
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+        signature = get_file_signature(filepath)
+        sha1 = get_file_hash(filepath)
+        temp_path = get_temp_path(cache_path + ".npy")
+        count_matrix = parse_count_matrix(filepath, chunk_rows = chunk_rows, mmap_path = temp_path)
+        # states and ids of the matrix go to the meta file, its counts are memory-mapped from the cache file
+        states, occupation_ids = count_matrix.states, count_matrix.occupation_ids
+        del count_matrix
+        # the file changed while it was parsed, the matrix may be of neither version, nothing is cached then
+        if get_file_signature(filepath) != signature:
+            remove_temp_path(temp_path)
+            return None
+        os.replace(temp_path, cache_path + ".npy")
+    except OSError:
+        if temp_path is not None:
+            remove_temp_path(temp_path)
+        return None
+    counts = np.load(cache_path + ".npy", mmap_mode = "r")
+    write_binary_cache_meta(filepath, 'counts', dict(signature, sha1 = sha1, states = states,
+        occupation_ids = occupation_ids.tolist()))
+    return CountMatrix(states, occupation_ids, counts, {Id: i for i, Id in enumerate(occupation_ids.tolist())})
+
+
+
+
+###############################################
+#load a stack of dated count .csv files into one (time x state x occupation) cube
+#params:
+#   @counts_pattern: directory of count .csv files, or a glob pattern of them, every file name carries its date
+#                    as YYYY-MM or YYYY-MM-DD, e.g. Count-allOccupations-Continent-2016-05.csv
+#return:
+#   CountSeries of dates, states, occupation ids, counts[time, state, occupation] in the narrowest integer type
+#   that holds every count, and column_index of occupation ids, frames in order of their date
+###############################################
+
+CountSeries = namedtuple('CountSeries', ['dates', 'states', 'occupation_ids', 'counts', 'column_index'])
+
+COUNT_SERIES_DATE = re.compile(r'(\d{4})-(\d{2})(?:-(\d{2}))?')
+
+@traced_stage('load_count_series')
+def load_count_series(counts_pattern):
+    dated_paths = sorted((get_count_file_date(path), path) for path in get_count_files(counts_pattern))
+
+    # occupation columns of the first frame are the columns of the cube, missing ones count as 0
+    frames = [load_count_matrix(path, cache = False) for date, path in dated_paths]
+    states, occupation_ids = frames[0].states, frames[0].occupation_ids
+    counts = np.zeros((len(frames), len(states), len(occupation_ids)),
+        dtype = np.uint16 if max(int(frame.counts.max()) for frame in frames) < 1 << 16 else np.int32)
+    for t, (frame, (date, path)) in enumerate(zip(frames, dated_paths)):
+        if list(frame.states) != list(states):
+            raise ValueError("states of %s differ from those of %s" % (path, dated_paths[0][1]))
+        columns = [frame.column_index.get(Id, -1) for Id in occupation_ids.tolist()]
+        present = np.array(columns) >= 0
+        counts[t][:, present] = frame.counts[:, np.array(columns)[present]]
+
+    column_index = {Id: i for i, Id in enumerate(occupation_ids.tolist())}
+    return CountSeries([date for date, path in dated_paths], states, occupation_ids, counts, column_index)
+
+
+# count .csv files of a directory or a glob pattern, in order of their names
+def get_count_files(counts_pattern):
+    if os.path.isdir(counts_pattern):
+        counts_pattern = os.path.join(counts_pattern, "*.csv")
+    counts_paths = sorted(glob.glob(counts_pattern))
+    if not counts_paths:
+        raise ValueError("no count file matches %s" % counts_pattern)
+    return counts_paths
+
+
+def get_count_file_date(path):
+    match = COUNT_SERIES_DATE.search(os.path.basename(path))
+    if match is None:
+        raise ValueError("no date as YYYY-MM or YYYY-MM-DD in the name of %s" % path)
+    return '-'.join(part for part in match.groups() if part)
+
+
+# one frame of the series as a CountMatrix, a view into the cube
+def get_count_series_frame(count_series, frame):
+    return CountMatrix(count_series.states, count_series.occupation_ids, count_series.counts[frame],
+        count_series.column_index)
+
+
+
+
+###############################################
+#give the count data of us each state according to selector
+#params:
+#   @occupation_set: a list of occupation id that user want
+#   @count_matrix: parsed count data, default as the matrix loaded from COUNT_FILEPATH
+#return:
+#   an array of count data in each state, adds up count data of all occupations in occupation_set
+###############################################
+
+def get_count_us_continent(occupations_set, count_matrix = None):
+    if count_matrix is None:
+        count_matrix = load_count_matrix()
+    columns = [count_matrix.column_index[i] for i in occupations_set]
+    return count_matrix.counts[:, columns].sum(axis = 1, dtype = np.int64)
+
+
+
+
+###############################################
+#gives info of every occupation id via .csv file
+#params:
+#   @filepath: .csv file of occupation id, firststep, starterjob, group and careerarea
+#return:
+#   dicts: firststep, starterjob, occupationgroup, careerarea that maps to a set of occupation ids.
+#   dicts: group_name maps group id to its name, careerarea_name maps careerarea id to its name
+###############################################
+OCCUPATION_FILEPATH = "Occupationid_firststep_group_careerarea.csv"
+
+@traced_stage('get_occupation_info')
+def get_occupation_info(filepath = OCCUPATION_FILEPATH, binary_cache = True):
+    rows = read_occupation_rows_cache(filepath) if binary_cache else None
+    if rows is None:
+        rows = read_occupation_rows(filepath)
+        if binary_cache:
+            write_occupation_rows_cache(filepath, rows)
+
+    occupations_firststep = {"False": [], "True": []}
+    occupations_starterjob = {"False": [], "True": []}
+    occupations_careerarea = {}
+    occupations_occupationgroup = {}
+    group_name = {}
+    careerarea_name = {}
+    for Id, firststep, starterjob, group_id, group, careerarea_id, careerarea in zip(
+            rows['id'].tolist(), rows['firststep'].tolist(), rows['starterjob'].tolist(),
+            rows['group_id'].tolist(), rows['group_name'].tolist(),
+            rows['careerarea_id'].tolist(), rows['careerarea_name'].tolist()):
+        occupations_firststep[str(firststep)].append(Id)
+        occupations_starterjob[str(starterjob)].append(Id)
+        group_name[group_id] = group
+        if group_id in occupations_occupationgroup.keys():
+            occupations_occupationgroup[group_id].append(Id)
+        else:
+            occupations_occupationgroup[group_id] = []
+            occupations_occupationgroup[group_id].append(Id)
+        careerarea_name[careerarea_id] = careerarea
+        if careerarea_id in occupations_careerarea.keys():
+            occupations_careerarea[careerarea_id].append(Id)
+        else:
+            occupations_careerarea[careerarea_id] = []
+            occupations_careerarea[careerarea_id].append(Id)
+
+    return (occupations_firststep,
+            occupations_starterjob,
+            occupations_occupationgroup,
+            occupations_careerarea,
+            group_name,
+            careerarea_name)
+
+
+
+
+###############################################
+#read the occupation .csv file into encoded columns, and keep them in the binary cache as .npz file
+#params:
+#   @filepath: occupation info .csv file
+#return:
+#   dict of arrays id, firststep, starterjob, group_id, group_name, careerarea_id, careerarea_name, one item per row
+###############################################
+
+OCCUPATION_COLUMNS = ['id', 'firststep', 'starterjob', 'group_id', 'group_name', 'careerarea_id', 'careerarea_name']
+
+def read_occupation_rows(filepath):
+    with open(filepath, "r") as csvfile:
+        data = csv.reader(csvfile)
+        next(data, None)
+        rows = [row for row in data if row]
+    return dict(
+        id = np.array([int(row[0]) for row in rows], dtype = np.int64),
+        firststep = np.array([row[1] != 'FALSE' for row in rows], dtype = bool),
+        starterjob = np.array([row[2] != 'FALSE' for row in rows], dtype = bool),
+        group_id = np.array([int(row[3]) for row in rows], dtype = np.int64),
+        group_name = np.array([row[4] for row in rows], dtype = str),
+        careerarea_id = np.array([int(row[5]) for row in rows], dtype = np.int64),
+        careerarea_name = np.array([row[6] for row in rows], dtype = str))
+
+
+def read_occupation_rows_cache(filepath):
+    if read_binary_cache_meta(filepath, 'occupations') is None:
+        return None
+    try:
+        with np.load(get_binary_cache_path(filepath, 'occupations') + ".npz") as cache:
+            return {name: cache[name] for name in OCCUPATION_COLUMNS}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def write_occupation_rows_cache(filepath, rows):
+    cache_path = get_binary_cache_path(filepath, 'occupations')
+    temp_path = None
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+        temp_path = get_temp_path(cache_path + ".npz")
+        with open(temp_path, "wb") as f:
+            np.savez(f, **rows)
+        os.replace(temp_path, cache_path + ".npz")
+        write_binary_cache_meta(filepath, 'occupations', {})
+    except OSError:
+        if temp_path is not None:
+            remove_temp_path(temp_path)
+
+
+
+
+###############################################
+#give a compact index of occupation attributes, aligned to the columns of the count matrix
+#params:
+#   @occupation_info: tuple given by get_occupation_info
+#   @count_matrix: parsed count data, default as the matrix loaded from COUNT_FILEPATH
+#return:
+#   OccupationIndex of boolean arrays firststep and starterjob, int arrays of experience, group and careerarea code
+#   of every column (-1 if unknown), and ids and names of groups and careerareas in order of their codes
+###############################################
+
+EXPERIENCE_NAMES = ['_none', '_1_year', '_2_year']
+
+# labels of the experience selector of the dashboard and their selector names
+EXPERIENCE_SELECTOR = {'All': '_all', 'None': '_none', 'At least 1 year': '_1_year', 'At least 2 year': '_2_year'}
+
+OccupationIndex = namedtuple('OccupationIndex', ['firststep', 'starterjob',
+    'experience_code', 'group_code', 'careerarea_code',
+    'group_ids', 'group_names', 'careerarea_ids', 'careerarea_names'])
+
+@traced_stage('get_occupation_index')
+def get_occupation_index(occupation_info, count_matrix = None):
+    if count_matrix is None:
+        count_matrix = load_count_matrix()
+    firststep, starterjob, occupationgroup, careerarea, group_name, careerarea_name = occupation_info
+    n = len(count_matrix.occupation_ids)
+    get_columns = lambda ids: [count_matrix.column_index[i] for i in ids if i in count_matrix.column_index]
+
+    is_firststep = np.zeros(n, dtype = bool)
+    is_firststep[get_columns(firststep['True'])] = True
+    is_starterjob = np.zeros(n, dtype = bool)
+    is_starterjob[get_columns(starterjob['True'])] = True
+    known = np.zeros(n, dtype = bool)
+    known[get_columns(firststep['True'] + firststep['False'])] = True
+
+    # code of EXPERIENCE_NAMES: at least 2 year for firststep, else at least 1 year for starterjob, else none
+    experience_code = np.where(is_firststep, 2, np.where(is_starterjob, 1, 0))
+    experience_code[~known] = -1
+
+    group_ids = list(occupationgroup.keys())
+    group_code = np.full(n, -1)
+    for code, k in enumerate(group_ids):
+        group_code[get_columns(occupationgroup[k])] = code
+    careerarea_ids = list(careerarea.keys())
+    careerarea_code = np.full(n, -1)
+    for code, k in enumerate(careerarea_ids):
+        careerarea_code[get_columns(careerarea[k])] = code
+
+    return OccupationIndex(is_firststep, is_starterjob,
+        experience_code, group_code, careerarea_code,
+        group_ids, [group_name[k] for k in group_ids],
+        careerarea_ids, [careerarea_name[k] for k in careerarea_ids])
+
+
+###############################################
+#give the columns of the count matrix that pass all filters
+#params:
+#   @occupation_index: OccupationIndex given by get_occupation_index
+#   @experience: experience selector name in EXPERIENCE_NAMES, None or '_all' for all
+#   @careerareas: codes of careerareas, any of them passes, None for all
+#   @groups: codes of occupation groups, any of them passes, None for all
+#return:
+#   boolean array over the columns of the count matrix
+###############################################
+
+def get_occupation_mask(occupation_index, experience = None, careerareas = None, groups = None):
+    mask = occupation_index.experience_code >= 0
+    if experience not in (None, '_all'):
+        mask &= occupation_index.experience_code == EXPERIENCE_NAMES.index(experience)
+    if careerareas is not None:
+        mask &= get_code_lookup(careerareas, len(occupation_index.careerarea_ids))[occupation_index.careerarea_code]
+    if groups is not None:
+        mask &= get_code_lookup(groups, len(occupation_index.group_ids))[occupation_index.group_code]
+    return mask
+
+
+# lookup table of selected codes, its last item stays False for unknown code -1
+def get_code_lookup(codes, n_codes):
+    lookup = np.zeros(n_codes + 1, dtype = bool)
+    lookup[list(codes)] = True
+    return lookup
+
+
+###############################################
+#give the count data of us each state for a column mask
+#params:
+#   @mask: boolean array over the columns of the count matrix
+#   @count_matrix: parsed count data, default as the matrix loaded from COUNT_FILEPATH
+#return:
+#   an array of count data in each state
+###############################################
+
+def get_count_us_continent_mask(mask, count_matrix = None):
+    if count_matrix is None:
+        count_matrix = load_count_matrix()
+    return count_matrix.counts @ mask.astype(np.int64)
+
+
+
+###############################################
+#give the count data of us each state of every career area for a column mask
+#params:
+#   @occupation_index: OccupationIndex given by get_occupation_index
+#   @mask: boolean array over the columns of the count matrix
+#   @count_matrix: parsed count data, default as the matrix loaded from COUNT_FILEPATH
+#return:
+#   an array of count data counts[careerarea, state]
+###############################################
+
+def get_careerarea_count_us_continent_mask(occupation_index, mask, count_matrix = None):
+    if count_matrix is None:
+        count_matrix = load_count_matrix()
+    membership = np.zeros((len(count_matrix.occupation_ids), len(occupation_index.careerarea_ids)),
+        dtype = np.int64)
+    in_careerarea = mask & (occupation_index.careerarea_code >= 0)
+    membership[np.nonzero(in_careerarea)[0], occupation_index.careerarea_code[in_careerarea]] = 1
+    return (count_matrix.counts @ membership).T
+
+
+###############################################
+#keeps the count of the selected career areas by adding or subtracting only the toggled area
+#params:
+#   @careerarea_count: array of count data counts[careerarea, state] under the current filters
+#   @cache_size: number of recently seen selections whose count is kept
+#count() gives the sum of the selected career areas, or of all areas when nothing is selected
+###############################################
+
+class SelectionAggregator(object):
+
+    def __init__(self, careerarea_count, cache_size = 64):
+        self.cache_size = cache_size
+        self.selected = 0
+        self.reset(careerarea_count)
+
+    # new count data of every career area, the selection stays and its sum is done from scratch
+    def reset(self, careerarea_count):
+        self.careerarea_count = careerarea_count
+        self.total = careerarea_count.sum(axis = 0)
+        self.cache = OrderedDict()
+        self.running = careerarea_count[self.get_selected_codes()].sum(axis = 0)
+        self.cache[self.selected] = self.running
+
+    # selection is a bitset of career area codes
+    def toggle(self, code):
+        bit = 1 << code
+        self.selected ^= bit
+        if self.selected in self.cache:
+            self.cache.move_to_end(self.selected)
+            self.running = self.cache[self.selected]
+        else:
+            if self.selected & bit:
+                self.running = self.running + self.careerarea_count[code]
+            else:
+                self.running = self.running - self.careerarea_count[code]
+            self.cache[self.selected] = self.running
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last = False)
+        return self.count()
+
+    def get_selected_codes(self):
+        return [code for code in range(len(self.careerarea_count)) if self.selected >> code & 1]
+
+    def count(self):
+        return self.running if self.selected else self.total
+
+
+
+###############################################
+#aggregate count data of every experience selector, career area and state in one step
+#params:
+#   @occupation_index: OccupationIndex given by get_occupation_index
+#   @count_matrix: parsed count data, default as the matrix loaded from COUNT_FILEPATH
+#return:
+#   StateCountCube of experience selector names, careerarea names and an int array counts[experience, careerarea, state]
+###############################################
+
+StateCountCube = namedtuple('StateCountCube', ['experience_names', 'careerarea_names', 'counts'])
+
+@traced_stage('get_state_count_cube')
+def get_state_count_cube(occupation_index, count_matrix = None):
+    if count_matrix is None:
+        count_matrix = load_count_matrix()
+    n_careerarea = len(occupation_index.careerarea_ids)
+
+    group_count = np.rint(count_matrix.counts @ get_group_membership(occupation_index)).astype(np.int64)
+
+    counts = group_count.T.reshape(len(EXPERIENCE_NAMES), n_careerarea, len(count_matrix.states))
+    return StateCountCube(list(EXPERIENCE_NAMES), list(occupation_index.careerarea_names), counts)
+
+
+# one-hot group membership matrix (occupation x group), counts summed per group by a single matrix product
+def get_group_membership(occupation_index):
+    n_careerarea = len(occupation_index.careerarea_ids)
+    n_groups = len(EXPERIENCE_NAMES) * n_careerarea
+
+    # give every occupation column the group (experience, careerarea) it belongs to
+    group_code = occupation_index.experience_code * n_careerarea + occupation_index.careerarea_code
+    in_group = (occupation_index.experience_code >= 0) & (occupation_index.careerarea_code >= 0)
+
+    membership = np.zeros((len(group_code), n_groups))
+    membership[np.nonzero(in_group)[0], group_code[in_group]] = 1
+    return membership
+
+
+###############################################
+#aggregate every frame of a count series like get_state_count_cube, all frames in one matrix product
+#params:
+#   @occupation_index: OccupationIndex given by get_occupation_index
+#   @count_series: CountSeries given by load_count_series
+#return:
+#   StateCountCube whose int32 counts[time, experience, careerarea, state] has one more axis in front
+###############################################
+
+@traced_stage('get_state_count_series')
+def get_state_count_series(occupation_index, count_series):
+    n_frames, n_states, n_occupations = count_series.counts.shape
+    n_careerarea = len(occupation_index.careerarea_ids)
+
+    group_count = np.rint(count_series.counts.reshape(n_frames * n_states, n_occupations)
+        @ get_group_membership(occupation_index)).astype(np.int32)
+
+    counts = group_count.reshape(n_frames, n_states, len(EXPERIENCE_NAMES), n_careerarea).transpose(0, 2, 3, 1)
+    return StateCountCube(list(EXPERIENCE_NAMES), list(occupation_index.careerarea_names), np.ascontiguousarray(counts))
@@ -0,0 +1,364 @@
+# Headless count queries over the count data of the dashboard, without bokeh
+# python map_count_distribution_query.py --careerarea Sales --careerarea Finance --experience "At least 1 year"
+# python map_count_distribution_query.py --serve --port 8765
+
+import argparse
+import json
+import sys
+import threading
+from collections import namedtuple, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+import map_count_distribution_data as mcdd
+
+
+###############################################
+#answers count queries of any filter combination, like the selectors of the dashboard do, without rendering it
+#the count of every state of a query is kept in a cache of the most recently used queries
+#params:
+#   @count_matrix: CountMatrix given by load_count_matrix
+#   @occupation_index: OccupationIndex given by get_occupation_index over the same count matrix
+#   @cache_size: number of recently used queries whose count is kept
+#   @paths: (count .csv file, occupation info .csv file) the data comes from, the data is loaded again and the cache
+#           emptied once one of them changes, None for data that never changes
+#count() gives the count of every state of one query, count_batch() those of many queries in one matrix product,
+#a query is a CountQuery given by get_query or a dict of its keyword arguments
+###############################################
+
+QUERY_CACHE_SIZE = 4096
+
+CountQuery = namedtuple('CountQuery', ['experience', 'careerareas', 'groups', 'occupations'])
+
+class CountQueryEngine(object):
+
+    def __init__(self, count_matrix, occupation_index, cache_size = QUERY_CACHE_SIZE, paths = None):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.paths = paths
+        self.signatures = get_path_signatures(paths)
+        self.generation = 0
+        self.set_data(count_matrix, occupation_index)
+
+    # a new generation of data, counts of an older generation are not cached
+    def set_data(self, count_matrix, occupation_index):
+        self.generation += 1
+        self.count_matrix = count_matrix
+        self.occupation_index = occupation_index
+        self.state_rows = {name: row for row, name in enumerate(count_matrix.states)}
+        self.careerarea_codes = get_name_codes(occupation_index.careerarea_ids, occupation_index.careerarea_names)
+        self.group_codes = get_name_codes(occupation_index.group_ids, occupation_index.group_names)
+
+    # careerareas and groups are names or ids, any of them passes, occupations are ids, None for all of them
+    # load the data again when a file it comes from changed, the cached counts are of the old data
+    def refresh(self):
+        signatures = get_path_signatures(self.paths)
+        if signatures == self.signatures:
+            return
+        with self.lock:
+            if signatures != self.signatures:
+                self.set_data(*load_query_data(*self.paths))
+                self.signatures = signatures
+                self.cache.clear()
+
+    def get_query(self, experience = None, careerareas = None, groups = None, occupations = None):
+        experience = mcdd.EXPERIENCE_SELECTOR.get(experience, experience)
+        if experience not in [None, '_all'] + mcdd.EXPERIENCE_NAMES:
+            raise ValueError("unknown experience selector %r" % (experience,))
+        if occupations is not None:
+            occupations = [get_occupation_id(value) for value in get_query_values(occupations)]
+            unknown = [i for i in occupations if i not in self.count_matrix.column_index]
+            if unknown:
+                raise ValueError("unknown occupation ids %s" % unknown)
+            occupations = tuple(sorted(set(occupations)))
+        return CountQuery(None if experience == '_all' else experience,
+            get_query_codes(self.careerarea_codes, careerareas, "career area"),
+            get_query_codes(self.group_codes, groups, "occupation group"), occupations)
+
+    def get_mask(self, query, count_matrix, occupation_index):
+        mask = mcdd.get_occupation_mask(occupation_index, query.experience, query.careerareas, query.groups)
+        if query.occupations is not None:
+            mask &= np.isin(np.arange(len(mask)), [count_matrix.column_index[i] for i in query.occupations])
+        return mask
+
+    def get_state_rows(self, states):
+        if states is None:
+            return None
+        states = get_query_values(states)
+        unknown = [name for name in states if name not in self.state_rows]
+        if unknown:
+            raise ValueError("unknown states %s" % unknown)
+        return [self.state_rows[name] for name in states]
+
+    def count(self, query, states = None):
+        return self.count_batch([query], states)[0]
+
+    def total(self, query, states = None):
+        return int(self.count(query, states).sum())
+
+    # counts[query, state] of every query, in the order of states or of the count matrix rows,
+    # a new array whatever was cached, the queries missing from the cache are counted in one matrix product,
+    # all of them over the data of one generation, even when a refresh swaps the data in the meantime
+    def count_batch(self, queries, states = None):
+        self.refresh()
+        with self.lock:
+            count_matrix, occupation_index, generation = self.count_matrix, self.occupation_index, self.generation
+            queries = [query if isinstance(query, CountQuery) else self.get_query(**query) for query in queries]
+            rows = self.get_state_rows(states)
+            # a query repeated in the batch is looked up and counted once
+            found = OrderedDict((query, self.cache_get(query)) for query in OrderedDict.fromkeys(queries))
+        missing = [query for query, count in found.items() if count is None]
+        if missing:
+            masks = np.stack([self.get_mask(query, count_matrix, occupation_index) for query in missing], axis = 1)
+            counts = (count_matrix.counts @ masks.astype(np.int64)).T
+            found.update(zip(missing, counts))
+            with self.lock:
+                if self.generation == generation:
+                    for query, count in zip(missing, counts):
+                        self.cache_put(query, count)
+        counts = np.stack([found[query] for query in queries]) if queries else \
+            np.zeros((0, len(count_matrix.states)), dtype = np.int64)
+        return counts if rows is None else counts[:, rows]
+
+    def cache_get(self, query):
+        count = self.cache.get(query)
+        if count is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(query)
+        return count
+
+    def cache_put(self, query, count):
+        self.cache[query] = count
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+
+    def get_options(self):
+        return OrderedDict([('states', list(self.count_matrix.states)),
+            ('experiences', list(mcdd.EXPERIENCE_SELECTOR)),
+            ('careerareas', list(self.occupation_index.careerarea_names)),
+            ('groups', list(self.occupation_index.group_names))])
+
+    def get_stats(self):
+        with self.lock:
+            return OrderedDict([('size', len(self.cache)), ('max_size', self.cache_size),
+                ('hits', self.hits), ('misses', self.misses)])
+
+
+# maps names and ids, as strings, to their codes
+def get_name_codes(ids, names):
+    codes = {str(k): code for code, k in enumerate(ids)}
+    codes.update((name, code) for code, name in enumerate(names))
+    return codes
+
+
+# codes of names or ids in sorted order, None stays None for all of them
+def get_query_codes(name_codes, values, kind):
+    if values is None:
+        return None
+    values = get_query_values(values)
+    unknown = [value for value in values if str(value) not in name_codes]
+    if unknown:
+        raise ValueError("unknown %s %s" % (kind, unknown))
+    return tuple(sorted(set(name_codes[str(value)] for value in values)))
+
+
+# a single value is a list of one
+def get_query_values(values):
+    return list(values) if isinstance(values, (list, tuple, set, np.ndarray)) else [values]
+
+
+# occupation ids are integers, or strings of digits from a query string, anything else is no id
+def get_occupation_id(value):
+    if isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+        return int(value)
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    raise ValueError("occupation id %r is not an integer" % (value,))
+
+
+###############################################
+#load the count matrix and occupation info, both from the binary cache of their .csv file once it is written
+#params:
+#   @counts_path: count .csv file, state x occupation id
+#   @occupations_path: occupation info .csv file
+#   @cache_size: number of recently used queries whose count is kept
+#return:
+#   CountQueryEngine over the count matrix
+###############################################
+
+def load_query_engine(counts_path = mcdd.COUNT_FILEPATH, occupations_path = mcdd.OCCUPATION_FILEPATH,
+        cache_size = QUERY_CACHE_SIZE):
+    paths = (counts_path, occupations_path)
+    signatures = get_path_signatures(paths)
+    engine = CountQueryEngine(*load_query_data(counts_path, occupations_path), cache_size = cache_size)
+    engine.paths, engine.signatures = paths, signatures
+    return engine
+
+
+def load_query_data(counts_path, occupations_path):
+    count_matrix = mcdd.load_count_matrix(counts_path)
+    return count_matrix, mcdd.get_occupation_index(mcdd.get_occupation_info(occupations_path), count_matrix)
+
+
+def get_path_signatures(paths):
+    return None if paths is None else [mcdd.get_file_signature(path) for path in paths]
+
+
+###############################################
+#json of query results
+#params:
+#   @engine: CountQueryEngine that answered the queries
+#   @counts: counts[query, state] given by count_batch
+#   @states: state names of the columns of counts, None for all states
+#   @total: give the total of every query instead of the count of every state
+#return:
+#   dict of 'states' and 'counts', a list of counts of every state per query, or of 'totals' per query
+###############################################
+
+def get_result_json(engine, counts, states = None, total = False):
+    if total:
+        return OrderedDict([('totals', counts.sum(axis = 1).tolist())])
+    states = list(engine.count_matrix.states) if states is None else get_query_values(states)
+    return OrderedDict([('states', states), ('counts', counts.tolist())])
+
+
+###############################################
+#local http endpoint of a CountQueryEngine
+#   GET /count?experience=...&careerarea=...&group=...&occupation=...&state=...&total=1 gives one query,
+#       careerarea, group, occupation and state may be repeated
+#   POST /count of json {"queries": [{"experience": ..., "careerareas": [...], ...}], "states": [...], "total": false}
+#       gives many queries in one matrix product
+#   GET /options gives the names to query by, GET /stats the use of the cache
+#params:
+#   @engine: CountQueryEngine to answer the queries
+#   @host, port: address to listen on, the local host only by default
+#return:
+#   ThreadingHTTPServer, serve_forever() answers the requests
+###############################################
+
+QUERY_HOST = "127.0.0.1"
+QUERY_PORT = 8765
+
+QUERY_PARAMS = {'careerarea': 'careerareas', 'group': 'groups', 'occupation': 'occupations'}
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        engine = self.server.engine
+        if url.path == '/options':
+            return self.send_json(200, engine.get_options())
+        if url.path == '/stats':
+            return self.send_json(200, engine.get_stats())
+        if url.path != '/count':
+            return self.send_json(404, {'error': "unknown path %s" % url.path})
+        params = parse_qs(url.query)
+        query = {QUERY_PARAMS[name]: values for name, values in params.items() if name in QUERY_PARAMS}
+        if 'experience' in params:
+            query['experience'] = params['experience'][-1]
+        total = params.get('total', ['0'])[-1] not in ('0', 'false', '')
+        self.send_result([query], params.get('state'), total, single = True)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/count':
+            return self.send_json(404, {'error': "unknown path %s" % url.path})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            queries = body['queries']
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {'error': "a json object with a list of queries is expected: %s" % e})
+        self.send_result(queries, body.get('states'), bool(body.get('total', False)))
+
+    def send_result(self, queries, states, total, single = False):
+        engine = self.server.engine
+        try:
+            counts = engine.count_batch(queries, states)
+        except (ValueError, TypeError) as e:
+            return self.send_json(400, {'error': str(e)})
+        result = get_result_json(engine, counts, states, total)
+        if single:
+            result = OrderedDict((key, value if key == 'states' else value[0]) for key, value in result.items())
+        self.send_json(200, result)
+
+    def send_json(self, status, value):
+        content = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def get_query_server(engine, host = QUERY_HOST, port = QUERY_PORT):
+    server = ThreadingHTTPServer((host, port), QueryRequestHandler)
+    server.engine = engine
+    return server
+
+
+
+
+###############################################
+#command line entry point, prints the result of a query, or of a json file of queries, or serves queries over http
+#params:
+#   @argv: command line arguments, default as sys.argv
+###############################################
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Count job postings per state of any selection, without the dashboard.")
+    parser.add_argument("--counts", default = mcdd.COUNT_FILEPATH, help = "count .csv file, state x occupation id")
+    parser.add_argument("--occupations", default = mcdd.OCCUPATION_FILEPATH, help = "occupation info .csv file")
+    parser.add_argument("--experience", default = None,
+        help = "experience selector, e.g. 'At least 1 year' or _1_year, default as all")
+    parser.add_argument("--careerarea", action = "append", default = None,
+        help = "career area name or id, may be repeated, default as all")
+    parser.add_argument("--group", action = "append", default = None,
+        help = "occupation group name or id, may be repeated, default as all")
+    parser.add_argument("--occupation", action = "append", type = int, default = None,
+        help = "occupation id, may be repeated, default as all")
+    parser.add_argument("--state", action = "append", default = None, help = "state to give, may be repeated")
+    parser.add_argument("--total", action = "store_true", help = "give the total instead of the count of every state")
+    parser.add_argument("--queries", default = None,
+        help = "json file of a list of queries like {\"experience\": ..., \"careerareas\": [...]}, answered at once")
+    parser.add_argument("--serve", action = "store_true", help = "answer queries over http, see get_query_server")
+    parser.add_argument("--host", default = QUERY_HOST, help = "address of the http endpoint")
+    parser.add_argument("--port", type = int, default = QUERY_PORT, help = "port of the http endpoint")
+    parser.add_argument("--cache-size", type = int, default = QUERY_CACHE_SIZE,
+        help = "number of recently used queries whose result is kept")
+    args = parser.parse_args(argv)
+
+    engine = load_query_engine(args.counts, args.occupations, args.cache_size)
+    if args.serve:
+        server = get_query_server(engine, args.host, args.port)
+        print("answering queries on http://%s:%d/count" % server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    if args.queries is not None:
+        with open(args.queries, "r") as f:
+            queries = json.load(f)
+    else:
+        queries = [dict(experience = args.experience, careerareas = args.careerarea, groups = args.group,
+            occupations = args.occupation)]
+    try:
+        counts = engine.count_batch(queries, args.state)
+    except ValueError as e:
+        sys.exit(str(e))
+    json.dump(get_result_json(engine, counts, args.state, args.total), sys.stdout)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,632 +5,2936 @@
 #>>> import bokeh.sampledata
 #>>> bokeh.sampledata.download()
 
-from bokeh.io import show
+from bokeh import __version__ as bokeh_version
+from bokeh.events import DoubleTap
+from bokeh.io import curdoc, save
 from bokeh.models import (
     ColumnDataSource,
     HoverTool,
-    ColorBar, LinearColorMapper, FixedTicker, NumeralTickFormatter, BasicTicker,
-    Callback, Select, CustomJS,
-    LabelSet, TapTool
+    ColorBar, LinearColorMapper, FixedTicker, NumeralTickFormatter,
+    Select, CustomJS,
+    LabelSet, TapTool, Slider, Button
 )
 from bokeh.models.layouts import VBox,HBox
-from bokeh.palettes import Blues9 as palette
 from bokeh.plotting import figure, gridplot
+from bokeh.resources import CDN
 from bokeh.layouts import widgetbox
 
-from bokeh.sampledata.us_states import data as states_map
 #from bokeh.sampledata.unemployment import data as unemployment
 
-import csv
+import argparse
+import base64
+import glob
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+import webbrowser
+from collections import namedtuple, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
 import numpy as np
-import requests
+
+from map_count_distribution_data import (
+    _stage_trace, trace_stages, stage_span, traced_stage, print_stage_trace,
+    COUNT_FILEPATH, CountMatrix, load_count_matrix, get_count_files, CountSeries, load_count_series,
+    get_count_series_frame,
+    BINARY_CACHE_DIR, get_file_signature, get_file_hash, get_temp_path,
+    OCCUPATION_FILEPATH, get_occupation_info,
+    EXPERIENCE_NAMES, EXPERIENCE_SELECTOR, OccupationIndex, get_occupation_index, get_occupation_mask,
+    get_careerarea_count_us_continent_mask, SelectionAggregator,
+    StateCountCube, get_state_count_cube, get_state_count_series
+)
+
+
 
 
 ###############################################
-#give the coordinates of the world via json url
+#give the coordinates of the world, from a local cache of processed polygons when possible
 #parmas:
-#   @features: dicts of country name and polygon boundaries geo location
-#              read from world-geo json url
+#   @cache_path: .npz file keeps flat coordinate buffers, ring offsets, country names and content hash
+#                of processed polygons, None means no cache at all
+#   @geojson_path: local world-geo json file, cache is rebuilt when its content hash changes
+#   @url: world-geo json url, only fetched when there is neither cache nor local json file
 #return:
-#   ColumnDataSource object to plot
+#   get_geo_world gives ColumnDataSource object to plot,
+#   load_geo_world gives list of country names, lists of float32 arrays of lons and lats, one item per border
+###############################################
+
+WORLD_GEO_URL = 'https://raw.githubusercontent.com/johan/world.geo.json/master/countries.geo.json'
+# next to the script, whatever directory it runs from
+WORLD_GEO_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "world-geo-cache.npz")
+
+# bump it when the way polygons are processed changes, so that old caches are invalid
+GEO_CACHE_VERSION = b'1'
+
+def get_geo_world(cache_path = WORLD_GEO_CACHE, geojson_path = None, url = WORLD_GEO_URL):
+    names, xs, ys = load_geo_world(cache_path, geojson_path, url)
+    return ColumnDataSource(data=dict(x = xs, y = ys, name = names,))
+
+
+@traced_stage('load_geo_world')
+def load_geo_world(cache_path = WORLD_GEO_CACHE, geojson_path = None, url = WORLD_GEO_URL):
+    content = None
+    if geojson_path is not None:
+        with open(geojson_path, "rb") as f:
+            content = f.read()
+    source_key = get_geo_source_key(geojson_path if geojson_path is not None else url)
+
+    cached = read_geo_world_cache(cache_path) if cache_path else None
+    if cached is not None:
+        names, xs, ys, content_hash, cached_key = cached
+        # without local json file, trust the cache as long as it comes from the same url
+        if (content is None and cached_key == source_key) or \
+                (content is not None and content_hash == get_geo_content_hash(content)):
+            return names, xs, ys
+
+    if content is None:
+        # requests is only imported when the borders are downloaded, the cache needs none of it
+        import requests
+        with stage_span('fetch_geo_world'):
+            r = requests.get(url)
+            r.raise_for_status()
+            content = r.content
+    names, xs, ys = get_geo_world_rings(json.loads(content.decode('utf-8')))
+    if cache_path:
+        write_geo_world_cache(cache_path, names, xs, ys, get_geo_content_hash(content), source_key)
+    return names, xs, ys
+
+
+def get_geo_content_hash(content):
+    return hashlib.sha1(GEO_CACHE_VERSION + b'\0' + content).hexdigest()
+
+
+# source of the borders with the cache version, a cache of another version never matches
+def get_geo_source_key(source):
+    return GEO_CACHE_VERSION.decode('ascii') + ':' + source
+
+
+###############################################
+#give the outer border of every polygon in world-geo json data
+#parmas:
+#   @geo_json_data: dict of country name and polygon boundaries geo location
+#return:
+#   list of country names, lists of float32 arrays of lons and lats, one item per border
 ###############################################
 
-def get_geo_world():
-    url = 'https://raw.githubusercontent.com/johan/world.geo.json/master/countries.geo.json'
-    r = requests.get(url)
-    geo_json_data = r.json()
-    features = geo_json_data['features']
-    depth = lambda L: isinstance(L, list) and max(map(depth, L))+1
+def get_geo_world_rings(geo_json_data):
     xs = []
     ys = []
     names = []
-    for feature in features:
+    for feature in geo_json_data['features']:
         name = feature['properties']['name']
-        coords = feature['geometry']['coordinates']
-        nbdims = depth(coords)
+        geometry = feature['geometry']
         # one border
-        if nbdims == 3:
-            pts = np.array(coords[0], 'f')
+        if geometry['type'] == 'Polygon':
+            shapes = [geometry['coordinates']]
+        # several borders
+        else:
+            shapes = geometry['coordinates']
+        for shape in shapes:
+            pts = np.array(shape[0], 'f')
             xs.append(pts[:, 0])
             ys.append(pts[:, 1])
             names.append(name)
-        # several borders
+    return names, xs, ys
+
+
+###############################################
+#read and write the processed world polygons as flat coordinate buffers plus ring offsets
+#params:
+#   @cache_path: .npz file of the cache
+#return:
+#   read_geo_world_cache gives names, xs, ys, content hash and source of the cache, or None if there is no valid cache
+###############################################
+
+def read_geo_world_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cache:
+            offsets = cache['offsets']
+            xs = np.split(cache['x'], offsets[1:-1])
+            ys = np.split(cache['y'], offsets[1:-1])
+            names = cache['name'].tolist()
+            content_hash = str(cache['content_hash'])
+            source_key = str(cache['source'])
+    except (OSError, KeyError, ValueError):
+        return None
+    return names, xs, ys, content_hash, source_key
+
+
+def write_geo_world_cache(cache_path, names, xs, ys, content_hash, source_key):
+    offsets = np.zeros(len(xs) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in xs])
+    # write to a temporary file first, so that a broken write never leaves a half cache behind
+    temp_path = get_temp_path(cache_path)
+    with open(temp_path, "wb") as f:
+        np.savez(f,
+            x = np.concatenate(xs).astype('f') if xs else np.zeros(0, 'f'),
+            y = np.concatenate(ys).astype('f') if ys else np.zeros(0, 'f'),
+            offsets = offsets,
+            name = np.array(names, dtype = str),
+            content_hash = np.array(content_hash),
+            source = np.array(source_key))
+    os.replace(temp_path, cache_path)
+
+
+
+
+###############################################
+#simplify a polyline by Douglas-Peucker algorithm
+#params:
+#   @xs, ys: arrays of lons and lats of the polyline, a closed border repeats its first point at the end
+#   @tolerance: max distance in degree between the polyline and its simplification
+#return:
+#   arrays of lons and lats of the kept points, always keeps the first and the last point
+###############################################
+
+def simplify_polyline(xs, ys, tolerance):
+    n = len(xs)
+    if n < 3:
+        return xs, ys
+    keep = np.zeros(n, dtype = bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        d = get_segment_distance(xs[a+1:b], ys[a+1:b], xs[a], ys[a], xs[b], ys[b])
+        k = int(np.argmax(d))
+        if d[k] > tolerance:
+            k += a + 1
+            keep[k] = True
+            stack.append((a, k))
+            stack.append((k, b))
+    return xs[keep], ys[keep]
+
+
+def get_segment_distance(xs, ys, x0, y0, x1, y1):
+    dx, dy = x1 - x0, y1 - y0
+    length2 = dx * dx + dy * dy
+    # a closed border starts and ends at the same point, distance to a point then
+    if length2 == 0:
+        return np.hypot(xs - x0, ys - y0)
+    t = np.clip(((xs - x0) * dx + (ys - y0) * dy) / length2, 0, 1)
+    return np.hypot(xs - (x0 + t * dx), ys - (y0 + t * dy))
+
+
+###############################################
+#clip a polygon border to a rectangle extent by Sutherland-Hodgman algorithm
+#params:
+#   @xs, ys: arrays of lons and lats of the border
+#   @extent: (lon_min, lon_max, lat_min, lat_max) of the rectangle
+#return:
+#   arrays of lons and lats of the clipped border, empty if the border is out of the extent
+###############################################
+
+def clip_polygon_to_extent(xs, ys, extent):
+    lon_min, lon_max, lat_min, lat_max = extent
+    if len(xs) == 0 or xs.min() >= lon_max or xs.max() <= lon_min or ys.min() >= lat_max or ys.max() <= lat_min:
+        return xs[:0], ys[:0]
+    # nothing to clip when the border is inside the extent
+    if xs.min() >= lon_min and xs.max() <= lon_max and ys.min() >= lat_min and ys.max() <= lat_max:
+        return xs, ys
+    for axis, bound, side in ((0, lon_min, 1), (0, lon_max, -1), (1, lat_min, 1), (1, lat_max, -1)):
+        xs, ys = clip_polygon_to_half_plane(xs, ys, axis, bound, side)
+        if len(xs) == 0:
+            break
+    return xs, ys
+
+
+def clip_polygon_to_half_plane(xs, ys, axis, bound, side):
+    v = xs if axis == 0 else ys
+    prev_xs, prev_ys, prev_v = np.roll(xs, 1), np.roll(ys, 1), np.roll(v, 1)
+    inside = (v - bound) * side >= 0
+    prev_inside = np.roll(inside, 1)
+    cross = inside != prev_inside
+    # t is only meaningful on edges that cross the bound, the others are dropped below
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        t = (bound - prev_v) / (v - prev_v)
+        cross_xs = prev_xs + t * (xs - prev_xs)
+        cross_ys = prev_ys + t * (ys - prev_ys)
+    # each point gives the crossing of the edge that ends at it first, then itself if it is inside
+    out_xs = np.column_stack((cross_xs, xs)).ravel()
+    out_ys = np.column_stack((cross_ys, ys)).ravel()
+    keep = np.column_stack((cross, inside)).ravel()
+    return out_xs[keep].astype(xs.dtype), out_ys[keep].astype(ys.dtype)
+
+
+###############################################
+#clip the patches of a source to the view extent and give simplified borders of several levels of detail
+#params:
+#   @source: ColumnDataSource with 'x' and 'y' columns of borders, parts of one border are separated by NaN
+#   @tolerances: simplification tolerance in degree of each level, from the coarsest to the finest
+#   @extent: (lon_min, lon_max, lat_min, lat_max), patches out of it are dropped and the others clipped
+#   @level: the level of detail that 'x' and 'y' columns keep, the other levels go to 'x_lod<level>', 'y_lod<level>'
+#return:
+#   the same ColumnDataSource object, with rows out of the extent removed from every column
+###############################################
+
+GEO_LOD_TOLERANCES = [0.4, 0.1, 0.025]
+
+@traced_stage('simplify_geo_source')
+def simplify_geo_source(source, tolerances = GEO_LOD_TOLERANCES, extent = None, level = 0):
+    borders = []
+    for xs, ys in zip(source.data['x'], source.data['y']):
+        xs = np.asarray(xs, dtype = 'f')
+        ys = np.asarray(ys, dtype = 'f')
+        parts = []
+        for part in np.split(np.arange(len(xs)), np.nonzero(np.isnan(xs))[0]):
+            part = part[~np.isnan(xs[part])]
+            part_xs, part_ys = xs[part], ys[part]
+            if extent is not None:
+                part_xs, part_ys = clip_polygon_to_extent(part_xs, part_ys, extent)
+            if len(part_xs):
+                parts.append((part_xs, part_ys))
+        borders.append(parts)
+
+    keep = [i for i, parts in enumerate(borders) if parts]
+    data = {}
+    for name, column in source.data.items():
+        if name in ('x', 'y'):
+            continue
+        data[name] = np.asarray(column)[keep] if isinstance(column, np.ndarray) else [column[i] for i in keep]
+
+    for lod, tolerance in enumerate(tolerances):
+        lod_xs, lod_ys = [], []
+        for i in keep:
+            xs, ys = join_geo_parts([simplify_geo_part(part_xs, part_ys, tolerance) for part_xs, part_ys in borders[i]])
+            lod_xs.append(xs)
+            lod_ys.append(ys)
+        if lod == level:
+            data['x'], data['y'] = lod_xs, lod_ys
         else:
-            for shape in coords:
-                pts = np.array(shape[0], 'f')
-                xs.append(pts[:, 0])
-                ys.append(pts[:, 1])
-                names.append(name)
-    source = ColumnDataSource(data=dict(x = xs, y = ys, name = names,))
+            data['x_lod%d' % lod], data['y_lod%d' % lod] = lod_xs, lod_ys
+
+    source.data = data
     return source
 
 
+def simplify_geo_part(xs, ys, tolerance):
+    simple_xs, simple_ys = simplify_polyline(xs, ys, tolerance)
+    # a border smaller than the tolerance is kept as it is, so that no patch ever disappears
+    if len(simple_xs) < 4:
+        return xs, ys
+    return simple_xs, simple_ys
+
+
+def join_geo_parts(parts):
+    xs, ys = [], []
+    for part_xs, part_ys in parts:
+        if xs:
+            xs.append(np.full(1, np.nan, dtype = 'f'))
+            ys.append(np.full(1, np.nan, dtype = 'f'))
+        xs.append(part_xs)
+        ys.append(part_ys)
+    return np.concatenate(xs), np.concatenate(ys)
 
 
 ###############################################
-#give the count data of us each state according to selector
+#give the level of detail of a map according to its range
 #params:
-#   @occupation_set: a list of occupation id that user want, default as in each state add all count together
+#   @x_span: lon span of the map range in degree
+#   @plot_width: width of the map in pixels
+#   @tolerances: simplification tolerance of each level, from the coarsest to the finest
 #return:
-#   an dict of count data, contains key of 'State' and numeric number of occupation id
+#   index of the coarsest level whose tolerance is not larger than one pixel
 ###############################################
 
-def get_count_us_continent(occupations_set):#, add_all = None):
-    filepath = "Count-allOccupations-Continent.csv"
-    with open(filepath, "r") as csvfile:
-        data = csv.reader(csvfile)
-        headers = data.__next__()
-        state_count_dict = {}
-        state_count_dict[headers[0]] = []
-        for i in range(1,len(headers)):
-          headers[i] = int(headers[i])
-          state_count_dict[headers[i]] = []
-        for row in data:
-            # the first item of each row is an instance of 'State', not an int
-            state_count_dict[headers[0]].append(row[0])
-            for h, v in zip(headers[1:], row[1:]):
-                state_count_dict[h].append(int(v))
+def get_geo_lod_level(x_span, plot_width, tolerances = GEO_LOD_TOLERANCES):
+    pixel = float(x_span) / plot_width
+    for level, tolerance in enumerate(tolerances):
+        if tolerance <= pixel:
+            return level
+    return len(tolerances) - 1
+
 
-    state_count = np.zeros(len(state_count_dict['State']))
-    #if not add_all:
-    # add all occupations' count data together
-    #    keys = [key for key in state_count_dict.keys() if key != 'State']
-    #    for i in keys:
-    #        state_count = [sum(x) for x in zip(state_count, state_count_dict[i])]
-    #else:
-    # add only required count data from occupations_set
-    for i in occupations_set:
-        state_count = [sum(x) for x in zip(state_count, state_count_dict[i])]
 
-    return state_count
 
+###############################################
+#index the bounding boxes of patches in a packed R-tree, sorted tile recursive, to find the patch under a point
+#every part of a patch gets a box of its own, so that far apart islands do not box the sea between them
+#params:
+#   @xs, ys: lists of arrays of lons and lats of each patch, parts of one patch are separated by NaN
+#   @names: name of each patch
+#   @node_size: number of children of every node of the tree
+#return:
+#   GeoIndex of patch names, edges (x0, y0, x1, y1) of every part, the patch of every part, boxes of each level of
+#   the tree from the root down to the parts, a box is (lon_min, lat_min, lon_max, lat_max), the part of every box
+#   of the last level and the node size
+###############################################
 
+GeoIndex = namedtuple('GeoIndex', ['names', 'edges', 'parts', 'levels', 'order', 'node_size'])
+
+GEO_INDEX_NODE_SIZE = 16
+
+@traced_stage('build_geo_index')
+def build_geo_index(xs, ys, names, node_size = GEO_INDEX_NODE_SIZE):
+    edges, parts = [], []
+    for patch, (x, y) in enumerate(zip(xs, ys)):
+        patch_edges = get_patch_edges(np.asarray(x, dtype = np.float64), np.asarray(y, dtype = np.float64))
+        edges.extend(patch_edges)
+        parts.extend([patch] * len(patch_edges))
+    boxes = np.array([(x0.min(), y0.min(), x0.max(), y0.max()) for x0, y0, _, _ in edges],
+        dtype = np.float64).reshape(-1, 4)
+
+    # sort tile recursive: slabs of boxes sorted by lon, then each slab by lat, so that close boxes share nodes
+    n = len(boxes)
+    n_slabs = int(np.ceil(np.sqrt(np.ceil(float(n) / node_size))))
+    slab_size = node_size * int(np.ceil(float(n) / (node_size * max(n_slabs, 1))))
+    center_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    center_y = (boxes[:, 1] + boxes[:, 3]) / 2
+    order = np.argsort(center_x, kind = 'mergesort')
+    for start in range(0, n, max(slab_size, 1)):
+        slab = order[start:start + slab_size]
+        order[start:start + slab_size] = slab[np.argsort(center_y[slab], kind = 'mergesort')]
+
+    # every node boxes node_size boxes of the level below, up to a root level of at most node_size boxes
+    levels = [boxes[order]]
+    while len(levels[-1]) > node_size:
+        level = levels[-1]
+        starts = np.arange(0, len(level), node_size)
+        levels.append(np.column_stack((
+            np.fmin.reduceat(level[:, 0], starts), np.fmin.reduceat(level[:, 1], starts),
+            np.fmax.reduceat(level[:, 2], starts), np.fmax.reduceat(level[:, 3], starts))))
+    levels.reverse()
+    return GeoIndex(list(names), edges, np.array(parts, dtype = np.int64), levels, order, node_size)
+
+
+# edges of every part of a patch, a patch without any part is never found
+def get_patch_edges(xs, ys):
+    edges = []
+    for part in np.split(np.arange(len(xs)), np.nonzero(np.isnan(xs) | np.isnan(ys))[0]):
+        part = part[~(np.isnan(xs[part]) | np.isnan(ys[part]))]
+        if len(part) < 3:
+            continue
+        # every part is closed, from its last point back to the first one
+        edges.append((xs[part], ys[part], np.roll(xs[part], -1), np.roll(ys[part], -1)))
+    return edges
 
 
 ###############################################
-#give the coordinates and count data of us states
+#find the patch under each point by the GeoIndex, e.g. to geocode job postings into states
+#only parts whose box holds a point are tested, so the cost stays flat with many small patches
 #params:
-#   @state_count_experience_selector_dict: dict of different count data on each state according to selection,
-#                      here state are already sorted alphabetically in .csv file.
-#   @state_count_careerarea_selector_dict: dict of count data on each state according to doubel selection
-#   @state_map: sampledata from bokeh moduls, multipolygon of us map data
+#   @index: GeoIndex given by build_geo_index
+#   @lons, lats: arrays of lons and lats of the points
 #return:
-#   ColumnDataSource object to plot
+#   lookup_geo_index gives int64 array of the patch of each point, the first one in the index if patches overlap,
+#   and -1 where no patch holds the point
+#   get_geo_region_names gives the patch name of each point, None where no patch holds it
+###############################################
+
+# number of points looked up at a time, and of point x edge tests at a time
+GEO_LOOKUP_CHUNK = 1 << 14
+GEO_LOOKUP_CELLS = 1 << 20
+
+def lookup_geo_index(index, lons, lats):
+    lons = np.atleast_1d(np.asarray(lons, dtype = np.float64))
+    lats = np.atleast_1d(np.asarray(lats, dtype = np.float64))
+    patches = np.full(len(lons), -1, dtype = np.int64)
+    for start in range(0, len(lons), GEO_LOOKUP_CHUNK):
+        chunk_lons, chunk_lats = lons[start:start + GEO_LOOKUP_CHUNK], lats[start:start + GEO_LOOKUP_CHUNK]
+        chunk_patches = patches[start:start + GEO_LOOKUP_CHUNK]
+        candidates, points = get_geo_index_candidates(index, chunk_lons, chunk_lats)
+        by_part = np.lexsort((points, candidates))
+        candidates, points = candidates[by_part], points[by_part]
+        inside = np.zeros(len(points), dtype = bool)
+        for pairs in np.split(np.arange(len(candidates)), np.nonzero(np.diff(candidates))[0] + 1):
+            if len(pairs):
+                inside[pairs] = get_points_in_edges(index.edges[candidates[pairs[0]]],
+                    chunk_lons[points[pairs]], chunk_lats[points[pairs]])
+        # the even-odd rule over a whole patch: a part whose box misses a point is crossed an even number of times,
+        # so the point is in the patch when it is inside an odd number of the parts tested
+        n_points = len(chunk_lons)
+        keys, pairs = np.unique(index.parts[candidates] * n_points + points, return_inverse = True)
+        keys = keys[np.bincount(pairs.ravel(), weights = inside, minlength = len(keys)) % 2 == 1]
+        # keys in patch order, so that the first patch holding a point keeps it
+        found, first = np.unique(keys % n_points, return_index = True)
+        chunk_patches[found] = keys[first] // n_points
+    return patches
+
+
+def get_geo_region_names(index, lons, lats):
+    return [index.names[patch] if patch >= 0 else None for patch in lookup_geo_index(index, lons, lats)]
+
+
+###############################################
+#walk the R-tree down from the root with every point at once
+#params:
+#   @index: GeoIndex given by build_geo_index
+#   @lons, lats: float64 arrays of lons and lats of the points
+#return:
+#   int64 arrays of parts and points, one pair for every part whose box holds a point
+###############################################
+
+def get_geo_index_candidates(index, lons, lats):
+    n_points = len(lons)
+    n_nodes = len(index.levels[0])
+    nodes = np.repeat(np.arange(n_nodes), n_points)
+    points = np.tile(np.arange(n_points), n_nodes)
+    for depth, level in enumerate(index.levels):
+        if depth > 0:
+            # each (node, point) pair goes on with the children of the node
+            nodes = (nodes[:, None] * index.node_size + np.arange(index.node_size)).ravel()
+            points = np.repeat(points, index.node_size)
+            valid = nodes < len(level)
+            nodes, points = nodes[valid], points[valid]
+        box = level[nodes]
+        x, y = lons[points], lats[points]
+        inside = (box[:, 0] <= x) & (x <= box[:, 2]) & (box[:, 1] <= y) & (y <= box[:, 3])
+        nodes, points = nodes[inside], points[inside]
+    return index.order[nodes], points
+
+
+###############################################
+#test which points are inside a part of a patch by the even-odd rule
+#params:
+#   @edges: edges (x0, y0, x1, y1) of the part
+#   @lons, lats: float64 arrays of lons and lats of the points
+#return:
+#   bool array, True for points inside the part
+###############################################
+
+def get_points_in_edges(edges, lons, lats):
+    x0, y0, x1, y1 = edges
+    inside = np.zeros(len(lons), dtype = bool)
+    step = max(1, GEO_LOOKUP_CELLS // max(len(x0), 1))
+    for start in range(0, len(lons), step):
+        px = lons[start:start + step, None]
+        py = lats[start:start + step, None]
+        crossing = (y0 > py) != (y1 > py)
+        # the lon where each edge crosses the horizontal line through the point, only used on crossing edges
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            cross_x = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+        inside[start:start + step] = np.count_nonzero(crossing & (px < cross_x), axis = 1) % 2 == 1
+    return inside
+
+
+###############################################
+#GeoIndex of us states, of any geography layer and of world borders
+#params:
+#   @states_map: sampledata from bokeh moduls, multipolygon of us map data
+#   @geography: Geography given by get_states_geography or get_counties_geography
+#   @world: world borders (names, xs, ys) given by load_geo_world
+#return:
+#   GeoIndex whose patches are the rows of the geography, in FIPS order like the aligned count data
+###############################################
+
+def get_states_geo_index(states_map = None):
+    return get_geography_geo_index(get_states_geography(states_map))
+
+
+def get_geography_geo_index(geography):
+    return build_geo_index(geography.xs, geography.ys, geography.names)
+
+
+def get_world_geo_index(world = None):
+    if world is None:
+        world = load_geo_world()
+    names, xs, ys = world
+    return build_geo_index(xs, ys, names)
+
+
+
+
+
+
+
+
+###############################################
+#geography layers keyed by FIPS code, states by 2 digits and counties by 5 digits, the first 2 of their state
+#params:
+#   @states_map: sampledata from bokeh moduls, multipolygon of us map data, a state may carry its own 'fips',
+#                None for the one of get_states_map
+#   @counties_map: dict like bokeh.sampledata.us_counties keyed by (state fips, county fips),
+#                  None for bokeh sampledata, that has to be downloaded by bokeh.sampledata.download() first
+#return:
+#   Geography of FIPS codes, names, lons and lats of every row sorted by FIPS code,
+#   and the FIPS code of the state each row is in, '' for states
+###############################################
+
+Geography = namedtuple('Geography', ['fips', 'names', 'xs', 'ys', 'parents'])
+
+STATE_FIPS = {
+    'Alabama': '01', 'Alaska': '02', 'Arizona': '04', 'Arkansas': '05', 'California': '06', 'Colorado': '08',
+    'Connecticut': '09', 'Delaware': '10', 'District of Columbia': '11', 'Florida': '12', 'Georgia': '13',
+    'Hawaii': '15', 'Idaho': '16', 'Illinois': '17', 'Indiana': '18', 'Iowa': '19', 'Kansas': '20',
+    'Kentucky': '21', 'Louisiana': '22', 'Maine': '23', 'Maryland': '24', 'Massachusetts': '25', 'Michigan': '26',
+    'Minnesota': '27', 'Mississippi': '28', 'Missouri': '29', 'Montana': '30', 'Nebraska': '31', 'Nevada': '32',
+    'New Hampshire': '33', 'New Jersey': '34', 'New Mexico': '35', 'New York': '36', 'North Carolina': '37',
+    'North Dakota': '38', 'Ohio': '39', 'Oklahoma': '40', 'Oregon': '41', 'Pennsylvania': '42',
+    'Rhode Island': '44', 'South Carolina': '45', 'South Dakota': '46', 'Tennessee': '47', 'Texas': '48',
+    'Utah': '49', 'Vermont': '50', 'Virginia': '51', 'Washington': '53', 'West Virginia': '54',
+    'Wisconsin': '55', 'Wyoming': '56', 'Puerto Rico': '72'}
+
+def get_states_geography(states_map = None):
+    if states_map is None:
+        states_map = get_states_map()
+    rows = []
+    for code, state in states_map.items():
+        # a state out of the FIPS table, e.g. a synthetic one, is keyed by its code in the map
+        fips = state.get('fips', STATE_FIPS.get(state['name'], code))
+        rows.append((fips, state['name'], state['lons'], state['lats']))
+    rows.sort(key = lambda row: row[0])
+    return Geography([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows],
+        [row[3] for row in rows], [''] * len(rows))
+
+
+# bokeh sampledata of us states, imported on first use so that a cached build never waits for it
+def get_states_map():
+    from bokeh.sampledata.us_states import data as states_map
+    return states_map
+
+
+def get_counties_geography(counties_map = None):
+    if counties_map is None:
+        from bokeh.sampledata.us_counties import data as counties_map
+    rows = sorted((('%02d%03d' % key, county) for key, county in counties_map.items()), key = lambda row: row[0])
+    # county names repeat from state to state, the detailed name 'Autauga County, Alabama' does not
+    return Geography([fips for fips, county in rows],
+        [county.get('detailed name', county['name']) for fips, county in rows],
+        [county['lons'] for fips, county in rows], [county['lats'] for fips, county in rows],
+        [fips[:2] for fips, county in rows])
+
+
+###############################################
+#join rows of count data to a geography by their labels instead of their order
+#a label is looked up as a FIPS code first, digits are zero padded like '6037' to '06037', then as a name
+#params:
+#   @geography: Geography given by get_states_geography or get_counties_geography
+#   @labels: row labels of count data, e.g. the 'State' column of the count .csv file
+#   @count_data: CountMatrix or CountSeries, their rows are labelled by 'states'
+#return:
+#   get_geography_rows gives int64 array of the geography row of every label, -1 if no row matches it
+#   align_count_rows gives the same kind of count data with one row per geography row in geography order,
+#   zero counts where the count data has no row, count rows out of the geography are left out with a warning
+###############################################
+
+def get_geography_rows(geography, labels):
+    by_fips = {fips: row for row, fips in enumerate(geography.fips)}
+    by_name = {name: row for row, name in enumerate(geography.names)}
+    width = max([len(fips) for fips in geography.fips if fips.isdigit()] or [0])
+    rows = []
+    for label in labels:
+        label = str(label).strip()
+        fips = label.zfill(width) if label.isdigit() else label
+        rows.append(by_fips.get(fips, by_name.get(label, -1)))
+    return np.array(rows, dtype = np.int64)
+
+
+def align_count_rows(count_data, geography):
+    rows = get_geography_rows(geography, count_data.states)
+    matched = rows >= 0
+    if not matched.all():
+        warnings.warn("count rows out of the geography are left out: %s" % ", ".join(
+            str(label) for label, row in zip(count_data.states, rows) if row < 0))
+    if len(np.unique(rows[matched])) != np.count_nonzero(matched):
+        raise ValueError("several count rows join the same geography row")
+
+    names = list(geography.names)
+    if matched.all() and np.array_equal(rows, np.arange(len(names))):
+        return count_data._replace(states = names)
+    counts = count_data.counts
+    aligned = np.zeros(counts.shape[:-2] + (len(names), counts.shape[-1]), dtype = counts.dtype)
+    aligned[..., rows[matched], :] = counts[..., np.nonzero(matched)[0], :]
+    return count_data._replace(states = names, counts = aligned)
+
+
 ###############################################
+#sparse aggregation matrix from the rows of a geography to the rows of its parent geography, in CSR layout
+#params:
+#   @geography: Geography of the rows to roll up, e.g. counties
+#   @parent_geography: Geography of the rows they roll up to, e.g. states
+#   @rollup: GeoRollup given by get_geo_rollup
+#   @counts: array whose last axis is the rows of the geography
+#   @count_matrix: CountMatrix whose rows are the rows of the geography
+#return:
+#   get_geo_rollup gives GeoRollup, parent row r sums rows indices[indptr[r]:indptr[r + 1]],
+#   and its shape (parent rows, rows), rows of no parent are left out
+#   rollup_counts gives counts whose last axis is the rows of the parent geography
+#   rollup_count_matrix gives CountMatrix of the parent geography
+###############################################
+
+GeoRollup = namedtuple('GeoRollup', ['indptr', 'indices', 'shape'])
+
+def get_geo_rollup(geography, parent_geography):
+    parent_rows = get_geography_rows(parent_geography, geography.parents)
+    rows = np.nonzero(parent_rows >= 0)[0]
+    indices = rows[np.argsort(parent_rows[rows], kind = 'mergesort')]
+    indptr = np.zeros(len(parent_geography.fips) + 1, dtype = np.int64)
+    indptr[1:] = np.cumsum(np.bincount(parent_rows[rows], minlength = len(parent_geography.fips)))
+    return GeoRollup(indptr, indices, (len(parent_geography.fips), len(geography.fips)))
 
-def get_source_geo_and_count_us_continent(state_count_experience_selector_dict, state_count_careerarea_selector_dict, states_map):
-    states = {code: state for code, state in states_map.items()}
-    states_sort_by_name = states.values()
-    states_sort_by_name = sorted(states_sort_by_name, key = lambda x : x['name'])
-    # sort states' geo by its name, it helps decide the order of count data. cause .csv data is already sorted by state name
 
-    state_xs = [state["lons"] for state in states_sort_by_name]
-    state_ys = [state["lats"] for state in states_sort_by_name]
-    state_names = [state["name"] for state in states_sort_by_name]
+def rollup_counts(rollup, counts):
+    counts = np.asarray(counts)
+    rolled = np.zeros(counts.shape[:-1] + (rollup.shape[0],), dtype = counts.dtype)
+    # every parent with rows sums one contiguous run of the gathered rows
+    parents = np.nonzero(np.diff(rollup.indptr))[0]
+    if len(parents):
+        rolled[..., parents] = np.add.reduceat(counts[..., rollup.indices], rollup.indptr[parents], axis = -1)
+    return rolled
 
-    source = ColumnDataSource(data=dict(x = state_xs, y = state_ys,
-        name = [name + ", United States" for name in state_names]))
 
-    state_count_total = np.zeros(len(list(state_count_experience_selector_dict.values())[0]))
-    for name, state_count in state_count_experience_selector_dict.items():
-        state_count_total = [sum(x) for x in zip(state_count_total, state_count)]
-        source.add(data = state_count, name = 'count'+name)
-    source.add(data = state_count_total, name = 'count_all')
-    source.add(data = state_count_total, name = 'count')
+def rollup_count_matrix(rollup, count_matrix, parent_geography):
+    counts = rollup_counts(rollup, np.asarray(count_matrix.counts).T).T
+    return count_matrix._replace(states = list(parent_geography.names), counts = np.ascontiguousarray(counts))
+
+
+###############################################
+#give the coordinates and count data of a geography layer, us states or counties
+#params:
+#   @state_count_cube: StateCountCube of count data on each row according to experience and careerarea selection,
+#                      its rows are the rows of the geography, see align_count_rows
+#   @geography: Geography given by get_states_geography or get_counties_geography
+#return:
+#   ColumnDataSource object to plot
+###############################################
 
-    for experience_selector_name, state_count_careerarea in state_count_careerarea_selector_dict.items():
-        careerarea_selector_name_initial = 'count'+experience_selector_name
-        for careerarea_name, state_count in state_count_careerarea.items():
-            source.add(data = state_count, name = careerarea_selector_name_initial + careerarea_name)
+@traced_stage('get_source_geo_and_count_us_continent')
+def get_source_geo_and_count_us_continent(state_count_cube, geography):
+    if state_count_cube.counts.shape[-1] != len(geography.fips):
+        raise ValueError("count data has %d rows, the geography %d" % (
+            state_count_cube.counts.shape[-1], len(geography.fips)))
+    # states are named after their country, counties after their state already
+    names = [name if parent else name + ", United States" for name, parent in zip(geography.names, geography.parents)]
+    source = ColumnDataSource(data=dict(x = list(geography.xs), y = list(geography.ys), fips = list(geography.fips),
+        name = names))
+
+    # int32 columns go to the html as base64 binary arrays instead of lists of numbers
+    count_columns = get_count_columns(state_count_cube)
+    for name, state_count in count_columns.items():
+        source.add(data = state_count.astype(np.int32), name = name)
+    source.add(data = count_columns['count_all'].astype(np.int32), name = 'count')
 
     return source
 
 
+###############################################
+#give the count column of every experience and careerarea selector
+#params:
+#   @state_count_cube: StateCountCube, counts[..., e, a, s] may have more axes in front, e.g. time
+#return:
+#   OrderedDict maps column names to count arrays [..., s]
+###############################################
+
+def get_count_columns(state_count_cube):
+    counts = state_count_cube.counts
+    # counts[e, a, s] -> sum over career areas gives each experience selector, sum over both gives the total
+    state_count_experience = counts.sum(axis = -2)
+    state_count_careerarea_all = counts.sum(axis = -3)
+    state_count_total = state_count_experience.sum(axis = -2)
+
+    count_columns = OrderedDict()
+    for e, name in enumerate(state_count_cube.experience_names):
+        count_columns['count'+name] = state_count_experience[..., e, :]
+    count_columns['count_all'] = state_count_total
+
+    for a, careerarea_name in enumerate(state_count_cube.careerarea_names):
+        count_columns['count_all_' + careerarea_name] = state_count_careerarea_all[..., a, :]
+    for e, experience_selector_name in enumerate(state_count_cube.experience_names):
+        careerarea_selector_name_initial = 'count'+experience_selector_name+'_'
+        for a, careerarea_name in enumerate(state_count_cube.careerarea_names):
+            count_columns[careerarea_selector_name_initial + careerarea_name] = counts[..., e, a, :]
+    return count_columns
+
+
+
+
+###############################################
+#move count columns of the map source out to binary json shards, that the page fetches only when they are selected
+#params:
+#   @source: ColumnDataSource of the map
+#   @shard_dir: directory of the shards, it has to be next to the html
+#   @keep: count columns that still ship in the html
+#return:
+#   dict maps every column moved out to the url of its shard, relative to the html
+###############################################
+
+@traced_stage('write_count_shards')
+def write_count_shards(source, shard_dir, keep = ('count',)):
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    shard_files = {}
+    for name in sorted(source.data.keys()):
+        if not name.startswith('count') or name in keep:
+            continue
+        values = np.asarray(source.data[name], dtype = '<i4')
+        filename = 'count_%d.json' % len(shard_files)
+        with open(os.path.join(shard_dir, filename), "w") as f:
+            json.dump(dict(
+                dtype = 'int32',
+                length = len(values),
+                data = base64.b64encode(values.tobytes()).decode('ascii')), f)
+        shard_files[name] = os.path.basename(os.path.normpath(shard_dir)) + '/' + filename
+        source.remove(name)
+    return shard_files
+
+
 
 
 ###############################################
-#gives a colormapping method and colorbar (not use it any more)
+#quintile coloring of the map: a state is colored by the fifth of all states its count falls in
 #params:
-#   @palette: from bokeh library
-#   @quantile_level: the amount of quantile levels that user want to plot the data
-#   @data: data that needs to be plotted with different levels of quantile
+#   @counts: count arrays [..., s], quintile breaks are taken over the states axis
+#   @count, breaks: count of each state and the quintile breaks of it
+#   @palette: one color per quintile, lightest first
 #return:
-#   ColorMapper object and list of int as ticker
+#   get_quantile_breaks gives breaks [..., 4] at QUANTILE_LEVELS percent of the states
+#   get_quantile_table gives a dict maps every count column to its breaks, [time][4] for a count series
+#   get_quantile_colors gives the color of each state
 ###############################################
-def color_map_ticker(palette, quantile_level, data):
-    p = palette[:quantile_level - len(palette)]
-    p.reverse()
-    colormap = LinearColorMapper(palette=p, low=min(data), high=max(data))
 
-    fixedticker = [min(data) + 1 + (max(data) - min(data) - 1) * i / quantile_level#, i/(quantile_level)*100)
-        for i in range(0,quantile_level+1) ]
+QUANTILE_LEVELS = [20, 40, 60, 80]
+
+def get_quantile_breaks(counts):
+    return np.moveaxis(np.percentile(counts, QUANTILE_LEVELS, axis = -1), 0, -1)
+
+
+def get_quantile_table(count_columns):
+    return {name: get_quantile_breaks(counts).tolist() for name, counts in count_columns.items()}
+
+
+# the quintile of a state is the number of breaks its count is above
+def get_quantile_colors(count, breaks, palette = None):
+    if palette is None:
+        palette = palette1
+    quantile = (np.asarray(count)[:, None] > np.asarray(breaks)[None, :]).sum(axis = 1)
+    return [palette[k] for k in quantile]
+
+
+def get_quantile_title(breaks):
+    # rounds half up like Math.round of the page
+    return "Quintile breaks: " + " / ".join("%d" % np.floor(b + 0.5) for b in breaks)
+
 
-    #colormap, legendmap = [],[]
-    #for c in state_count:
-    #    index = 0
-    #    while(c > quantile[index] and index < len(quantile)):
-    #        index += 1
-    #    colormap.append(palette[index-1])
 
-    return colormap, fixedticker
 
 
 
 
 ###############################################
-#gives info of every occupation id via .csv file
+#rank the items of every row of a count table by their count, all rows by one argsort
+#params:
+#   @item_count: array counts[..., item], every index of the leading axes is one ranking
+#   @top_k: keep only the k items of largest count in each ranking, None for all
+#   @nonzero: leave the items of no count out of the rankings
 #return:
-#   dicts: firststep, starterjob, occupationgroup, careerarea that maps to a set of occupation ids.
-#   dicts: group_name maps group id to its name, careerarea_name maps careerarea id to its name
+#   RankingIndex of int32 arrays, ranking r is items[indptr[r]:indptr[r + 1]] and their counts,
+#   in ascending order of count so that the largest one is on top of the bar
 ###############################################
-def get_occupation_info():
-    with open("Occupationid_firststep_group_careerarea.csv", "r") as csvfile:
-        data = csv.reader(csvfile)
-        #headers = data.__next__()
-        next(data, None)
-        occupations_firststep = {"False": [], "True": []}
-        occupations_starterjob = {"False": [], "True": []}
-        occupations_careerarea = {}
-        occupations_occupationgroup = {}
-        group_name = {}
-        careerarea_name = {}
-        for row in data:
-            Id = int(row[0])
-            if row[1] == 'FALSE':
-                occupations_firststep["False"].append(Id)
-            else:
-                occupations_firststep["True"].append(Id)
-            if row[2] == 'FALSE':
-                occupations_starterjob["False"].append(Id)
-            else:
-                occupations_starterjob["True"].append(Id)
-            group_id = int(row[3])
-            group_name[group_id] = row[4]
-            if group_id in occupations_occupationgroup.keys():
-                occupations_occupationgroup[group_id].append(Id)
-            else:
-                occupations_occupationgroup[group_id] = []
-                occupations_occupationgroup[group_id].append(Id)
-            careerarea_id = int(row[5])
-            careerarea_name[careerarea_id] = row[6]
-            if careerarea_id in occupations_careerarea.keys():
-                occupations_careerarea[careerarea_id].append(Id)
-            else:
-                occupations_careerarea[careerarea_id] = []
-                occupations_careerarea[careerarea_id].append(Id)
 
-    return (occupations_firststep,
-            occupations_starterjob,
-            occupations_occupationgroup,
-            occupations_careerarea,
-            group_name,
-            careerarea_name)
+RankingIndex = namedtuple('RankingIndex', ['indptr', 'items', 'counts'])
+
+def get_ranking_index(item_count, top_k = None, nonzero = False):
+    item_count = np.asarray(item_count)
+    item_count = item_count.reshape(-1, item_count.shape[-1])
+    order = np.argsort(item_count, axis = 1, kind = 'stable')
+    ranked = np.take_along_axis(item_count, order, axis = 1)
 
+    keep = np.ones(ranked.shape, dtype = bool)
+    if top_k is not None:
+        keep[:, :max(ranked.shape[1] - top_k, 0)] = False
+    if nonzero:
+        keep &= ranked > 0
+    indptr = np.zeros(len(ranked) + 1, dtype = np.int32)
+    np.cumsum(keep.sum(axis = 1), out = indptr[1:])
+    return RankingIndex(indptr, order[keep].astype(np.int32), ranked[keep].astype(np.int32))
 
 
+def get_ranking(ranking_index, r):
+    start, end = ranking_index.indptr[r], ranking_index.indptr[r + 1]
+    return ranking_index.items[start:end], ranking_index.counts[start:end]
+
 
 ###############################################
-#give the coordinates and count data of us states
+#aggregate the total count in all states of every experience selector, career area and occupation group
 #params:
-#   @sset_2_year, set_1_year, set_none: sets of occupation id from experience selection
-#   @careerarea: career data maps area id to sets of occupation id
-#   @careerarea_name: career data maps area name to its name
+#   @occupation_index: OccupationIndex given by get_occupation_index
+#   @count_matrix: parsed count data, default as the matrix loaded from COUNT_FILEPATH
 #return:
-#   - dict of careerarea total count in all states according to 3 experience selectors (used for bar plot)
-#   - dict of careerarea count in each state according to 3 experience selectors (used for career selector)
+#   int array counts[selector, careerarea, group] of the selectors in RANKING_SELECTORS
 ###############################################
-def get_careerarea_count_selector(set_2_year, set_1_year, set_none, careerarea, careerarea_name):
-    careerarea_count_total_2_year = {}
-    careerarea_count_total_1_year = {}
-    careerarea_count_total_none = {}
 
-    careerarea_count_all = {}
-    careerarea_count_2_year = {}
-    careerarea_count_1_year = {}
-    careerarea_count_none = {}
+RANKING_SELECTORS = ['_all'] + EXPERIENCE_NAMES
 
-    for k,v in careerarea.items():
-        temp_career_set_2_year = set(v)&set(set_2_year)
-        temp_career_set_1_year = set(v)&set(set_1_year)
-        temp_career_set_none = set(v)&set(set_none)
+def get_group_count_table(occupation_index, count_matrix = None):
+    if count_matrix is None:
+        count_matrix = load_count_matrix()
+    n_careerarea = len(occupation_index.careerarea_ids)
+    n_group = len(occupation_index.group_ids)
+    known = ((occupation_index.experience_code >= 0) & (occupation_index.careerarea_code >= 0)
+        & (occupation_index.group_code >= 0))
 
-        temp_count_all = get_count_us_continent(v)
-        temp_count_2_year = get_count_us_continent(temp_career_set_2_year)
-        temp_count_1_year = get_count_us_continent(temp_career_set_1_year)
-        temp_count_none = get_count_us_continent(temp_career_set_none)
+    # one flat code of (experience, careerarea, group) per occupation column, summed by a single bincount
+    code = ((occupation_index.experience_code[known] * n_careerarea + occupation_index.careerarea_code[known])
+        * n_group + occupation_index.group_code[known])
+    total = count_matrix.counts.sum(axis = 0)[known]
+    table = np.rint(np.bincount(code, weights = total, minlength = len(EXPERIENCE_NAMES) * n_careerarea * n_group))
+    table = table.astype(np.int64).reshape(len(EXPERIENCE_NAMES), n_careerarea, n_group)
+    return np.concatenate([table.sum(axis = 0)[None], table])
 
-        temp_sum_2_year = sum(temp_count_2_year)
-        temp_sum_1_year = sum(temp_count_1_year)
-        temp_sum_none = sum(temp_count_none)
 
-        name = careerarea_name[k]
+###############################################
+#precompute the rankings the career area bar shows: career areas of every experience selector,
+#and the top occupation groups of every experience selector and career area
+#params:
+#   @occupation_index: OccupationIndex given by get_occupation_index
+#   @state_count_cube: StateCountCube of count data according to experience and careerarea selection
+#   @count_matrix: parsed count data the cube is aggregated from, default as the matrix loaded from COUNT_FILEPATH
+#   @top_k: number of occupation groups kept of every career area
+#return:
+#   CareerRankings of the selectors, names of careerareas and groups, RankingIndex of careerareas, one ranking
+#   per selector, and RankingIndex of groups with a count, one ranking per (selector, careerarea)
+###############################################
 
-        careerarea_count_total_2_year[name] = temp_sum_2_year
-        careerarea_count_total_1_year[name] = temp_sum_1_year
-        careerarea_count_total_none[name] = temp_sum_none
+CareerRankings = namedtuple('CareerRankings', ['selectors', 'careerarea_names', 'group_names', 'careerareas', 'groups'])
 
-        careerarea_count_all[name] = temp_count_all
-        careerarea_count_2_year[name] = temp_count_2_year
-        careerarea_count_1_year[name] = temp_count_1_year
-        careerarea_count_none[name] = temp_count_none
+GROUP_RANKING_TOP_K = 25
 
-    careerarea_count_total_dict = dict(
-        _2_year = careerarea_count_total_2_year,
-        _1_year = careerarea_count_total_1_year,
-        _none = careerarea_count_total_none)
+@traced_stage('get_career_rankings')
+def get_career_rankings(occupation_index, state_count_cube, count_matrix = None, top_k = GROUP_RANKING_TOP_K):
+    careerarea_count = state_count_cube.counts.sum(axis = 2)
+    careerarea_count = np.concatenate([careerarea_count.sum(axis = 0)[None], careerarea_count])
+    return CareerRankings(list(RANKING_SELECTORS), list(state_count_cube.careerarea_names),
+        list(occupation_index.group_names),
+        get_ranking_index(careerarea_count),
+        get_ranking_index(get_group_count_table(occupation_index, count_matrix), top_k, nonzero = True))
 
-    state_count_careerarea_selector_dict = dict(
-        _all_ = careerarea_count_all,
-        _2_year_ = careerarea_count_2_year,
-        _1_year_ = careerarea_count_1_year,
-        _none_ = careerarea_count_none)
 
-    return careerarea_count_total_dict, state_count_careerarea_selector_dict
+###############################################
+#give the columns of the career area bar for one ranking
+#params:
+#   @career_rankings: CareerRankings given by get_career_rankings
+#   @selector: experience selector name in RANKING_SELECTORS
+#   @careerarea: name of the career area whose occupation groups are shown, None for the career areas
+#return:
+#   dict of columns y, label_x, width, x and tag, one item per bar
+###############################################
 
+def get_ranking_columns(career_rankings, selector, careerarea = None):
+    r = career_rankings.selectors.index(selector)
+    ranking_index, names = career_rankings.careerareas, career_rankings.careerarea_names
+    if careerarea is not None:
+        r = r * len(career_rankings.careerarea_names) + career_rankings.careerarea_names.index(careerarea)
+        ranking_index, names = career_rankings.groups, career_rankings.group_names
+    items, counts = get_ranking(ranking_index, r)
+    return dict(
+        y = np.arange(1, len(items) + 1, dtype = np.int32),
+        label_x = np.zeros(len(items), dtype = np.float32),
+        width = counts,
+        x = (counts / 2).astype(np.float32),
+        tag = [names[k] for k in items])
+
+
+# the rankings as lists for the page, kept in the tags of the career source
+def get_ranking_tags(career_rankings):
+    ranking_tags = lambda ranking_index: {name: getattr(ranking_index, name).tolist() for name in ranking_index._fields}
+    return dict(selectors = career_rankings.selectors,
+        careerarea_names = career_rankings.careerarea_names,
+        group_names = career_rankings.group_names,
+        careerareas = ranking_tags(career_rankings.careerareas),
+        groups = ranking_tags(career_rankings.groups))
 
 
 ###############################################
-#give the coordinates and count data of us states
+#give the career area bar source of the career areas of all experience, the page and the server fill
+#it from the rankings when the experience selector changes or a career area is drilled into
 #params:
-#   @careerarea_count_dict: dict of careerarea count according to 3 selectors
+#   @career_rankings: CareerRankings given by get_career_rankings
 #return:
 #   ColumnDataSource object to plot
 ###############################################
-def get_source_careerarea_experience_count(careerarea_count_total_dict):
+@traced_stage('get_source_careerarea_experience_count')
+def get_source_careerarea_experience_count(career_rankings):
+    columns = get_ranking_columns(career_rankings, '_all')
+    n_bars = len(columns['y'])
     experience_selector = ['count_all']
-    experience_selector.extend(np.zeros(22))
-    color = ['#6baed6'] * 23
-    career_source = ColumnDataSource(data=dict(
-        y = range(1,23+1),
-        label_x = np.zeros(23),
+    experience_selector.extend(np.zeros(n_bars - 1))
+    color = ['#6baed6'] * n_bars
+    return ColumnDataSource(data=dict(columns,
         experience_selector = experience_selector,
         color = color,
         color2 = color,
         ))
 
-    careerarea_count_all = {}
-    for name, careerarea_count in careerarea_count_total_dict.items():
-        x_temp = []
-        tag_temp = []
-        width_temp = []
-        for k,v in sorted(careerarea_count.items(), key = lambda x: x[1]):
-            x_temp.append(v/2)
-            tag_temp.append(k)
-            width_temp.append(v)
-            if k in careerarea_count_all.keys():
-                careerarea_count_all[k]+=v
+
+
+
+###############################################
+#style of the dashboard
+###############################################
+palette1 = ['#6baed6', '#4292c6', '#2171b5', '#08519c', '#08306b']
+
+TOOLS = "pan,wheel_zoom,box_zoom,reset,save"
+MAP_WIDTH, MAP_HEIGHT = 1050, 680
+MAP_X_RANGE, MAP_Y_RANGE = (-160, -55), (7, 75)
+# patches are clipped to the map range padded by a quarter of it on every side
+MAP_EXTENT = (MAP_X_RANGE[0] - 26, MAP_X_RANGE[1] + 26, MAP_Y_RANGE[0] - 17, MAP_Y_RANGE[1] + 17)
+MAP_LOD_LEVEL = get_geo_lod_level(MAP_X_RANGE[1] - MAP_X_RANGE[0], MAP_WIDTH)
+
+DASHBOARD_HTML = "map_count_distribution_visualization.html"
+DASHBOARD_TITLE = "Job posting distribution over US"
+
+# `bokeh serve map_count_distribution_visualization.py` runs this script under a generated module name
+SERVER_MODE = __name__.startswith(('bk_script_', 'bokeh_app_'))
+
+
+
+
+###############################################
+#load stage: parse count data and occupation info, load world borders
+#params:
+#   @counts_path: count .csv file, state x occupation id
+#   @occupations_path: occupation info .csv file
+#   @geo_cache: .npz cache of the world borders, None means no cache
+#   @geojson_path: local world-geo json file, None to use the cache or the url
+#   @series_pattern: directory or glob pattern of dated count .csv files, their latest frame replaces counts_path
+#   @county_counts_path: count .csv file, county (FIPS code or detailed name) x occupation id,
+#                        the state counts are rolled up from it and replace counts_path
+#   @counties_map: county borders like bokeh.sampledata.us_counties, None for bokeh sampledata
+#return:
+#   DashboardData of CountMatrix, occupation info tuple, OccupationIndex, world borders (names, xs, ys),
+#   Geography of us states, CountSeries, None without series_pattern,
+#   and CountyData of the county Geography, its CountMatrix and the GeoRollup to states, None without county counts
+#   every count row is joined to its geography row, see align_count_rows
+###############################################
+
+DashboardData = namedtuple('DashboardData', ['count_matrix', 'occupation_info', 'occupation_index', 'world', 'geography',
+    'count_series', 'counties'])
+
+CountyData = namedtuple('CountyData', ['geography', 'count_matrix', 'rollup'])
+
+@traced_stage('load')
+def load_dashboard_data(counts_path = COUNT_FILEPATH, occupations_path = OCCUPATION_FILEPATH,
+        geo_cache = WORLD_GEO_CACHE, geojson_path = None, series_pattern = None, county_counts_path = None,
+        counties_map = None):
+    geography = get_states_geography()
+    county_geography = get_counties_geography(counties_map) if county_counts_path is not None else None
+    count_data = load_count_data(counts_path, series_pattern, county_counts_path)
+    occupation_info = get_occupation_info(occupations_path)
+    world = load_geo_world(geo_cache, geojson_path)
+    return join_dashboard_data(count_data, occupation_info, geography, county_geography, world)
+
+
+# count data as parsed, (count matrix, count series, county count matrix), None for those not given
+def load_count_data(counts_path = COUNT_FILEPATH, series_pattern = None, county_counts_path = None):
+    if county_counts_path is not None:
+        if series_pattern is not None:
+            raise ValueError("county counts can't be combined with a count series")
+        return None, None, load_count_matrix(county_counts_path)
+    if series_pattern is not None:
+        return None, load_count_series(series_pattern), None
+    return load_count_matrix(counts_path), None, None
+
+
+###############################################
+#join parsed count data to the geography and index the occupations of its columns
+#params:
+#   @count_data: (count matrix, count series, county count matrix) given by load_count_data
+#   @occupation_info: occupation info tuple given by get_occupation_info
+#   @geography, county_geography: Geography of states and counties, None without county counts
+#   @world: world borders given by load_geo_world, None if they are loaded on their own
+#return:
+#   DashboardData, see load_dashboard_data
+###############################################
+
+@traced_stage('join')
+def join_dashboard_data(count_data, occupation_info, geography, county_geography = None, world = None):
+    count_matrix, count_series, county_matrix = count_data
+    counties = None
+    if county_matrix is not None:
+        county_matrix = align_count_rows(county_matrix, county_geography)
+        rollup = get_geo_rollup(county_geography, geography)
+        counties = CountyData(county_geography, county_matrix, rollup)
+        count_matrix = rollup_count_matrix(rollup, county_matrix, geography)
+    elif count_series is not None:
+        count_series = align_count_rows(count_series, geography)
+        count_matrix = get_count_series_frame(count_series, -1)
+    else:
+        count_matrix = align_count_rows(count_matrix, geography)
+    occupation_index = get_occupation_index(occupation_info, count_matrix)
+    return DashboardData(count_matrix, occupation_info, occupation_index, world, geography, count_series, counties)
+
+
+
+
+###############################################
+#aggregate stage: count in each state of each career area under experience selectors
+#params:
+#   @data: DashboardData given by load_dashboard_data
+#return:
+#   StateCountCube, aggregate_county_data gives that of counties, None without county counts
+###############################################
+
+@traced_stage('aggregate')
+def aggregate_dashboard_data(data):
+    return get_state_count_cube(data.occupation_index, data.count_matrix)
+
+
+@traced_stage('aggregate_counties')
+def aggregate_county_data(data):
+    if data.counties is None:
+        return None
+    return get_state_count_cube(data.occupation_index, data.counties.count_matrix)
+
+
+
+
+###############################################
+#build-source stage: columns of the world map, the us states map and the career area bar
+#params:
+#   @data: DashboardData given by load_dashboard_data
+#   @state_count_cube: StateCountCube given by aggregate_dashboard_data
+#   @shard_dir: move count columns of every selector combination out to shards in this directory
+#               next to the html, None to embed all of them
+#   @server_mode: only keep the 'count' column on show, the server computes the others
+#   @world_source: column dict given by build_world_source, to share one between many dashboards
+#   @dedupe: ship columns that are copies of another one only once, the page copies them back on first use
+#   @worker: ship no count column but the one on show, and the packed counts[frame, experience, careerarea, state]
+#            that a web worker of the page sums, only in standalone html
+#   @county_count_cube: StateCountCube of counties given by aggregate_county_data, None for no county layer,
+#                       it has the same count columns as the states and can't be combined with worker or a series
+#return:
+#   DashboardSources of column dicts of the world, states and career sources, urls of count shards,
+#   dates of the count series and the column dict of its frames, one after another in every count column
+#   (only in standalone html, and then no column goes to shards),
+#   quintile breaks of every count column, and of every count column in each frame,
+#   the columns left out by dedupe, dict of the states and the career source maps each of them to its copy,
+#   and the packed counts of the worker, None without it,
+#   the column dict of counties and quintile breaks of its count columns, None and {} without county layer,
+#   and CareerRankings the career area bar is filled from
+###############################################
+
+DashboardSources = namedtuple('DashboardSources', ['world', 'states', 'career', 'shard_files', 'frame_dates', 'frames',
+    'quantile_breaks', 'frame_quantile_breaks', 'column_aliases', 'packed_counts', 'counties', 'county_quantile_breaks',
+    'rankings'])
+
+# columns that are the same as another one when the page is loaded, the page changes the one on show later
+STATES_COLUMN_ALIASES = {'count_all': 'count'}
+
+@traced_stage('sources')
+def build_dashboard_sources(data, state_count_cube, shard_dir = None, server_mode = False, world_source = None,
+        dedupe = True, worker = False, county_count_cube = None):
+    if county_count_cube is not None and (worker or data.count_series is not None):
+        raise ValueError("the county layer can't be combined with the worker or a count series")
+    if world_source is None:
+        world_source = build_world_source(data.world)
+
+    #get the source data based on experience selector and careerarea selector
+    source = simplify_geo_source(
+        get_source_geo_and_count_us_continent(state_count_cube, data.geography),
+        extent = MAP_EXTENT, level = MAP_LOD_LEVEL)
+
+    #quintile breaks of every column are looked up on selection, only a selection of many career areas is sorted
+    quantile_breaks = get_quantile_table(get_count_columns(state_count_cube))
+    source.add(data = get_quantile_colors(source.data['count'], quantile_breaks['count_all']), name = 'color')
+
+    #the career area bar ships only the bars on show, other ones are filled from the rankings
+    career_rankings = get_career_rankings(data.occupation_index, state_count_cube, data.count_matrix)
+    career_source = get_source_careerarea_experience_count(career_rankings)
+
+    #the server changes the count from its own columns, so only the standalone html leaves out copies
+    column_aliases = dict(states = {}, career = {}, counties = {})
+    if dedupe and not server_mode:
+        column_aliases['states'] = dict(STATES_COLUMN_ALIASES)
+        for name in STATES_COLUMN_ALIASES:
+            source.remove(name)
+
+    #only ship the column on show, the others are fetched from shards next to the html when selected
+    #in server mode the count is computed in python, and with a worker from the packed counts,
+    #no other column is needed at all
+    shard_files = {}
+    worker = worker and not server_mode
+    if server_mode or worker:
+        for name in list(source.data.keys()):
+            if name.startswith('count') and name != 'count':
+                source.remove(name)
+    elif shard_dir is not None and data.count_series is None:
+        shard_files = write_count_shards(source, shard_dir)
+
+    frame_dates, frames, frame_quantile_breaks = [], {}, []
+    packed_counts = state_count_cube.counts[None] if worker else None
+    if data.count_series is not None:
+        frame_dates = list(data.count_series.dates)
+        if not server_mode:
+            state_count_series = get_state_count_series(data.occupation_index, data.count_series)
+            frame_columns = get_count_columns(state_count_series)
+            if worker:
+                packed_counts = state_count_series.counts
             else:
-                careerarea_count_all[k]=v
+                frames = {name: counts.reshape(-1) for name, counts in frame_columns.items()}
+            frame_table = get_quantile_table(frame_columns)
+            frame_quantile_breaks = [{name: breaks[t] for name, breaks in frame_table.items()}
+                for t in range(len(frame_dates))]
+    if packed_counts is not None:
+        # float32 holds every count exactly below 2**24, the worker sums them in float64
+        packed_counts = packed_counts.astype(np.float32 if packed_counts.max() < 1 << 24 else np.float64)
+
+    counties, county_quantile_breaks = None, {}
+    if county_count_cube is not None:
+        counties, county_quantile_breaks = build_county_source(data, county_count_cube, server_mode,
+            column_aliases['counties'] if dedupe and not server_mode else None)
+
+    return DashboardSources(world_source, dict(source.data), dict(career_source.data), shard_files, frame_dates, frames,
+        quantile_breaks, frame_quantile_breaks, column_aliases, packed_counts, counties, county_quantile_breaks,
+        career_rankings)
+
+
+# the county layer has the count columns of the states, all of them in the html, and only 'count' in server mode
+@traced_stage('build_county_source')
+def build_county_source(data, county_count_cube, server_mode = False, column_aliases = None):
+    county_source = simplify_geo_source(
+        get_source_geo_and_count_us_continent(county_count_cube, data.counties.geography),
+        extent = MAP_EXTENT, level = MAP_LOD_LEVEL)
+    quantile_breaks = get_quantile_table(get_count_columns(county_count_cube))
+    county_source.add(data = get_quantile_colors(county_source.data['count'], quantile_breaks['count_all']),
+        name = 'color')
+    if column_aliases is not None:
+        column_aliases.update(STATES_COLUMN_ALIASES)
+        for name in STATES_COLUMN_ALIASES:
+            county_source.remove(name)
+    if server_mode:
+        for name in list(county_source.data.keys()):
+            if name.startswith('count') and name != 'count':
+                county_source.remove(name)
+    return dict(county_source.data), quantile_breaks
+
+
+@traced_stage('build_world_source')
+def build_world_source(world):
+    names, xs, ys = world
+    world_source = simplify_geo_source(ColumnDataSource(data=dict(x = xs, y = ys, name = names,)),
+        extent = MAP_EXTENT, level = MAP_LOD_LEVEL)
+    return dict(world_source.data)
 
-        career_source.add(data = width_temp, name = 'width'+name)
-        career_source.add(data = x_temp, name = 'x'+name)
-        career_source.add(data = tag_temp, name = 'tag'+name)
 
-    width = sorted(careerarea_count_all.values())
-    x = [v/2 for v in sorted(careerarea_count_all.values())]
-    tag = [k for k,v in sorted(careerarea_count_all.items(), key = lambda x: x[1])]
-    career_source.add(data = width, name = 'width')
-    career_source.add(data = width, name = 'width_all')
-    career_source.add(data = x, name = 'x')
-    career_source.add(data = x, name = 'x_all')
-    career_source.add(data = tag, name = 'tag')
-    career_source.add(data = tag, name = 'tag_all')
 
-    return career_source
 
+###############################################
+#render stage: plot the map and the career area bar, deploy widgets and callbacks
+#params:
+#   @data: DashboardData given by load_dashboard_data
+#   @sources: DashboardSources given by build_dashboard_sources
+#   @output: standalone html file to write, None to write nothing
+#   @server_mode: widgets call python handlers of a bokeh server instead of javascript
+#return:
+#   layout of the dashboard
+###############################################
 
+@traced_stage('render')
+def render_dashboard(data, sources, output = None, server_mode = False):
+    world_source = ColumnDataSource(data = sources.world)
+    source = ColumnDataSource(data = sources.states)
+    career_source = ColumnDataSource(data = sources.career)
+    county_source = ColumnDataSource(data = sources.counties) if sources.counties is not None else None
+
+    mp, color_bar, map_renderers = get_map_figure(world_source, source,
+        get_quantile_title(sources.quantile_breaks['count_all']), county_source)
+    career_area_bar, bar = get_career_area_bar(career_source)
+
+    #with a county layer, each map source keeps the quintile title of its own counts, the color bar shows
+    #that of the layer on show, and the callbacks sum the selection of both layers
+    county_args = {}
+    if county_source is not None:
+        source.tags = [color_bar.title]
+        county_source.tags = [get_quantile_title(sources.county_quantile_breaks['count_all'])]
+        county_args = dict(source3 = county_source, renderer1 = map_renderers.states, renderer3 = map_renderers.counties)
+
+    select_experience = Select(
+        title="Select postings that require experience of:",
+        value='All',
+        options= ['All', 'None', 'At least 1 year', 'At least 2 year'])
+
+    if county_source is None:
+        mp.x_range.callback = CustomJS(args=dict(
+            source1 = world_source,
+            source2 = source),
+            code=LOD_CALLBACK_CODE % (GEO_LOD_TOLERANCES, MAP_WIDTH, MAP_LOD_LEVEL))
+    else:
+        mp.x_range.callback = CustomJS(args=dict(
+            source1 = world_source,
+            source2 = source,
+            source3 = county_source,
+            renderer2 = map_renderers.states,
+            renderer3 = map_renderers.counties,
+            hover2 = map_renderers.states_hover,
+            hover3 = map_renderers.counties_hover,
+            color_bar = color_bar),
+            code=LOD_CALLBACK_CODE % (GEO_LOD_TOLERANCES, MAP_WIDTH, MAP_LOD_LEVEL)
+                + COUNTY_ZOOM_CODE % COUNTY_ZOOM_SPAN)
+
+    #a date slider and a play button over the frames of a count series, the latest frame is on show first
+    time_widgets = []
+    if len(sources.frame_dates) > 1:
+        slider_frame = Slider(
+            title="Date: " + sources.frame_dates[-1],
+            start=0, end=len(sources.frame_dates) - 1, value=len(sources.frame_dates) - 1, step=1)
+        button_play = Button(label="Play", width=80)
+        time_widgets = [slider_frame, button_play]
+
+    if server_mode:
+        select_group = Select(
+            title="Select occupation group:",
+            value='All',
+            options= ['All'] + sorted(data.occupation_index.group_names))
+        career_area_bar.add_tools(TapTool(renderers=[bar]))
+        add_server_handlers(data, source, career_source, color_bar, select_experience, select_group, *time_widgets,
+            county_source = county_source, map_renderers = map_renderers,
+            career_area_bar = career_area_bar, career_rankings = sources.rankings)
+        widgets = widgetbox(select_experience, select_group, *time_widgets)
+    else:
+        color_bar.tags = [dict(quantile_breaks = sources.quantile_breaks,
+            frame_quantile_breaks = sources.frame_quantile_breaks,
+            county_quantile_breaks = sources.county_quantile_breaks)]
+        # one source of the packed counts the worker sums, flat so that it ships as one binary array
+        packed_source = None
+        if sources.packed_counts is not None:
+            packed_source = ColumnDataSource(data = dict(counts = sources.packed_counts.reshape(-1)))
+        #the rankings of career areas and occupation groups the bars are filled from
+        career_source.tags = [get_ranking_tags(sources.rankings)]
+        shared = get_shared_callback(data, sources, source, career_source, color_bar, packed_source, county_args,
+            career_area_bar)
+        callback_experience, callback_career, callback_drill = get_static_callbacks(shared, source, career_source)
+        career_area_bar.add_tools(TapTool(renderers=[bar],
+            callback = callback_career))
+        career_area_bar.js_on_event(DoubleTap, callback_drill)
+        select_experience.callback = callback_experience
+        if time_widgets:
+            slider_frame.callback, button_play.callback = get_frame_callbacks(
+                shared, sources, source, career_source, color_bar, slider_frame)
+        widgets = widgetbox(select_experience, *time_widgets)
+
+    #Display data
+    multi_filter = VBox(widgets, career_area_bar)
+    tot =  HBox(multi_filter, gridplot([[mp]]))
+
+    if output is not None:
+        save_dashboard(tot, output)
+    return tot
 
 
 ###############################################
-#print map with all countries in the world and give them a country name hovertool
+#write the standalone html of a layout and give its content and the content hash of every count shard it loads,
+#restore_dashboard writes the html again when the file differs
+#params:
+#   @layout: layout given by render_dashboard
+#   @output: standalone html file to write
+#   @shard_files: urls of count shards relative to the html, given by build_dashboard_sources
+#   @saved: SavedDashboard given by save_dashboard
+#return:
+#   save_dashboard gives SavedDashboard of the html and a dict maps the url of every shard to its content hash
+#   has_saved_shards gives whether every shard the html loads is still next to output as it was saved
 ###############################################
-palette1 = ['#6baed6', '#4292c6', '#2171b5', '#08519c', '#08306b']
 
-TOOLS = "pan,wheel_zoom,box_zoom,reset,save"
-mp = figure(
-    title="Job posting distribution over US",
-    tools=TOOLS, toolbar_location="above",
-    x_axis_location=None, y_axis_location=None,
-    plot_width=1050, plot_height=680, x_range=(-160,-55), y_range=(7,75)
-)
-mp.grid.grid_line_color = None
-mp.title.text_font_size = '20pt'
-
-#print world map as background
-mp1 = mp.patches(
-    'x', 'y', source=get_geo_world(),
-    fill_color="#F1EEF6", fill_alpha=0.7, line_width=0.5)
-
-mp.add_tools(HoverTool(renderers=[mp1],
-    point_policy = "follow_mouse",
-    tooltips = {
-        "Name": "@name",
-        "(Lon, Lat)":
-        "($x, $y)",}))
-
-
-#print us states level map and coloring according to count data
-#count_total = get_count_us_continent()
-#source_total = get_source_geo_and_count_us_continent(dict(count_total = count_total), states_map)
-#color_mapper, fixed_ticks = color_map_ticker(palette, 5, count_total)
-#color_bar = ColorBar(color_mapper=color_mapper, ticker=FixedTicker(ticks = fixed_ticks),
-#    formatter = NumeralTickFormatter(format="0.0"), label_standoff=14, border_line_color=None, location=(0,0))
-#mp2 = mp.patches('x', 'y', source=source_total, fill_color={'field': 'count', 'transform': color_mapper},
-#    fill_alpha=0.7, line_color="grey", line_width=0.5)
-#mp.add_layout(color_bar, 'right')
-#mp.add_tools(HoverTool(renderers=[mp2], point_policy = "follow_mouse", tooltips = {"Name": "@name", "Job posting amount": "@count",
-#    "(Lon, Lat)": "($x, $y)",}))
-#show(mp)
-
-############################################
-#get the new set of occupations according to selection
-############################################
-
-firststep, starterjob, occupationgroup, careerarea, group_name, careerarea_name = get_occupation_info()
-
-#get the sets of occupations under different experience selectors
-set_2_year = firststep['True']
-set_1_year = set(firststep['False'])&set(starterjob['True'])
-set_none = set(firststep['False'])&set(starterjob['False'])
-
-#get the dicts of total count and count in each state of each career area under experience selectors
-careerarea_count_total_dict, state_count_careerarea_selector_dict = get_careerarea_count_selector(
-        set_2_year,
-        set_1_year,
-        set_none,
-        careerarea,
-        careerarea_name)
-
-
-#print the career area count bar
-career_source = get_source_careerarea_experience_count(careerarea_count_total_dict)
-
-career_area_bar = figure(title="Select career areas",
-    x_axis_location=None, y_axis_location = None,
-    width=290, height=642, tools = "reset", toolbar_location="above", #y_range=career_source.data('name'),
-    x_range = (0, max(career_source.data['width'])))
-career_area_bar.grid.grid_line_color = None
-career_area_bar.title.text_font_style = 'normal'
-
-bar = career_area_bar.rect(
-    x='x', y='y',
-    width='width',
-    height=0.4, color = 'color',
-    source = career_source)
-
-career_labels = LabelSet(
-    x="label_x", y="y",
-    text="tag",
-    y_offset=5, x_offset = 2,
-    text_font_size="8pt", text_color="#555555",
-    source=career_source, text_align='left')
-
-career_area_bar.add_layout(career_labels)
-
-career_area_bar.add_tools(HoverTool(renderers=[bar],
-    point_policy = "follow_mouse",
-    tooltips = {
-        "career area": "@tag",
-        "total count": "@width"}))
-
-
-
-############################################
-#print the map that relates to two selectors
-############################################
-
-#get the count in each state of each experience selector
-count_2_year = get_count_us_continent(set_2_year )
-count_1_year = get_count_us_continent(set_1_year)
-count_none = get_count_us_continent(set_none)
-
-#make these count data into a dict
-state_count_experience_selector_dict = dict(
-    _none = count_none,
-    _1_year = count_1_year,
-    _2_year = count_2_year)
-
-#get the source data based on experience selector and careerarea selector
-source = get_source_geo_and_count_us_continent(
-    state_count_experience_selector_dict,
-    state_count_careerarea_selector_dict,
-    states_map)
-
-
-###
-#here I have a bug that the color bar text of map cannot change according to selectors' changing.
-#It is mainly because the argument of colobar model in bokeh does not support specific source data
-#my way of solving this bug is to show the percent instead of specific numbers
-###
-
-#color_mapper, fixed_ticks = color_map_ticker(palette, 5, source.data['count'])
-
-mp2 = mp.patches('x', 'y', source=source,
-    fill_color={'field': 'count', 'transform': LinearColorMapper(palette=palette1)},
-    fill_alpha=0.7, line_color="grey", line_width=0.5)
-
-#color_bar = ColorBar(color_mapper=color_mapper, ticker=FixedTicker(ticks = fixed_ticks),
-#    formatter = NumeralTickFormatter(format="0.0"), label_standoff=14, border_line_color=None, location=(0,0))
-color_bar = ColorBar(
-    color_mapper = LinearColorMapper(palette=palette1),
-        #low = min(source.data['count']),
-        #high = max(source.data['count'])),
-    ticker=BasicTicker(),
-    formatter = NumeralTickFormatter(format="0.0%"),
-    label_standoff=14, border_line_color=None, location=(0,0))
-#print(color_bar)
+SavedDashboard = namedtuple('SavedDashboard', ['html', 'shard_hashes'])
+
+@traced_stage('save')
+def save_dashboard(layout, output, shard_files = None):
+    save(layout, filename = output, resources = CDN, title = DASHBOARD_TITLE)
+    with open(output, "rb") as f:
+        html = f.read()
+    directory = os.path.dirname(os.path.abspath(output))
+    return SavedDashboard(html, {url: get_file_hash(os.path.join(directory, url))
+        for url in sorted((shard_files or {}).values())})
+
 
-mp.add_layout(color_bar, 'right')
+def has_saved_shards(saved, output):
+    directory = os.path.dirname(os.path.abspath(output))
+    for url, shard_hash in saved.shard_hashes.items():
+        path = os.path.join(directory, url)
+        if not os.path.isfile(path) or get_file_hash(path) != shard_hash:
+            return False
+    return True
+
+
+def restore_dashboard(html, output):
+    if os.path.isfile(output):
+        with open(output, "rb") as f:
+            if f.read() == html:
+                return
+    with open(output, "wb") as f:
+        f.write(html)
 
-mp.add_tools(HoverTool(renderers=[mp2],
-    point_policy = "follow_mouse",
-    tooltips = {
-        "Name": "@name",
-        "Job posting amount": "@count",
-        "(Lon, Lat)": "($x, $y)",}))
 
 
 
 ###############################################
-#callbacks
+#print map with all countries in the world and give them a country name hovertool,
+#and us states map coloring according to the quintile of count data
+#params:
+#   @world_source, source: ColumnDataSource of the world and us states
+#   @quantile_title: title of the ColorBar, quintile breaks of the count on show
+#   @county_source: ColumnDataSource of counties, drawn instead of the states once the map is zoomed in,
+#                   None for no county layer
+#return:
+#   figure of the map, its ColorBar and MapRenderers of the patches renderers of the states and the counties
+#   and their HoverTools, the county ones are None without county layer
 ###############################################
-callback_experience = CustomJS(args=dict(
-    source1 = source,
-    source2 = career_source,
-    color_bar = color_bar),
-    code="""
-        var f = cb_obj.get('value');
-        var data1 = source1.get('data');
-        var count = data1['count'];
 
-        var mapper = color_bar.get('color_mapper');
-        var mapper_low = mapper.get('low');
-        var mapper_high = mapper.get('high');
+MapRenderers = namedtuple('MapRenderers', ['states', 'counties', 'states_hover', 'counties_hover'])
+
+def get_map_figure(world_source, source, quantile_title = None, county_source = None):
+    mp = figure(
+        title=DASHBOARD_TITLE,
+        tools=TOOLS, toolbar_location="above",
+        x_axis_location=None, y_axis_location=None,
+        plot_width=MAP_WIDTH, plot_height=MAP_HEIGHT, x_range=MAP_X_RANGE, y_range=MAP_Y_RANGE
+    )
+    mp.grid.grid_line_color = None
+    mp.title.text_font_size = '20pt'
+
+    #print world map as background
+    mp1 = mp.patches(
+        'x', 'y', source=world_source,
+        fill_color="#F1EEF6", fill_alpha=0.7, line_width=0.5)
+
+    hover1 = HoverTool(renderers=[mp1],
+        point_policy = "follow_mouse",
+        tooltips = {
+            "Name": "@name",
+            "(Lon, Lat)":
+            "($x, $y)",})
+    mp.add_tools(hover1)
+
+    ###
+    #states are colored by the quintile their count falls in, so the color bar shows percent of states,
+    #and the count at each break goes to its title, that changes with the selectors
+    ###
+    mp2 = mp.patches('x', 'y', source=source,
+        fill_color='color',
+        fill_alpha=0.7, line_color="grey", line_width=0.5)
+
+    color_bar = ColorBar(
+        color_mapper = LinearColorMapper(palette=palette1, low=0, high=1),
+        ticker=FixedTicker(ticks=[0, 0.2, 0.4, 0.6, 0.8, 1]),
+        formatter = NumeralTickFormatter(format="0%"),
+        title = quantile_title,
+        label_standoff=14, border_line_color=None, location=(0,0))
+
+    mp.add_layout(color_bar, 'right')
+
+    hover2 = HoverTool(renderers=[mp2],
+        point_policy = "follow_mouse",
+        tooltips = {
+            "Name": "@name",
+            "Job posting amount": "@count",
+            "(Lon, Lat)": "($x, $y)",})
+    mp.add_tools(hover2)
+
+    #counties are hidden until the map is zoomed in, and a hidden layer is never hovered
+    mp3 = hover3 = None
+    if county_source is not None:
+        mp3 = mp.patches('x', 'y', source=county_source,
+            fill_color='color',
+            fill_alpha=0.7, line_color="grey", line_width=0.2, visible=False)
+        hover3 = HoverTool(renderers=[mp3],
+            point_policy = "follow_mouse",
+            tooltips = {
+                "Name": "@name",
+                "Job posting amount": "@count",
+                "(Lon, Lat)": "($x, $y)",})
+        mp.add_tools(hover3)
+        mp.toolbar.active_inspect = [hover1, hover2]
+
+    return mp, color_bar, MapRenderers(mp2, mp3, hover2, hover3)
 
-        var data2 = source2.get('data');
-        var width = data2['width'];
-        var x = data2['x'];
-        var tag = data2['tag'];
-        var experience_selector = data2['experience_selector'][0]
 
-        if (f == 'None') {
-            for (i = 0; i < count.length; i++) {
-                count[i] = data1['count_none'][i];
+
+
+###############################################
+#print the career area count bar, a tap selects a career area, a double-tap shows its occupation groups
+#and another one the career areas again
+#params:
+#   @career_source: ColumnDataSource of the career area bar
+#return:
+#   figure of the bar plot and its rect renderer
+###############################################
+
+CAREER_AREA_BAR_TITLE = "Select career areas"
+
+def get_career_area_bar(career_source):
+    career_area_bar = figure(title=CAREER_AREA_BAR_TITLE,
+        x_axis_location=None, y_axis_location = None,
+        width=290, height=642, tools = "reset", toolbar_location="above",
+        x_range = (0, max(career_source.data['width'])))
+    career_area_bar.grid.grid_line_color = None
+    career_area_bar.title.text_font_style = 'normal'
+
+    bar = career_area_bar.rect(
+        x='x', y='y',
+        width='width',
+        height=0.4, color = 'color',
+        source = career_source)
+
+    career_labels = LabelSet(
+        x="label_x", y="y",
+        text="tag",
+        y_offset=5, x_offset = 2,
+        text_font_size="8pt", text_color="#555555",
+        source=career_source, text_align='left')
+
+    career_area_bar.add_layout(career_labels)
+
+    career_area_bar.add_tools(HoverTool(renderers=[bar],
+        point_policy = "follow_mouse",
+        tooltips = {
+            "name": "@tag",
+            "total count": "@width"}))
+
+    return career_area_bar, bar
+
+
+
+
+###############################################
+#callbacks
+###############################################
+
+#javascript that makes sure count columns are in the map source before using them,
+#columns moved out to shards are fetched once and kept in the source afterwards.
+#done always runs once every request is over, with the names of the columns that could not be fetched,
+#those are reported on the console and fetched again the next time they are needed
+COLUMN_LOADER_CODE = """
+        var shard_files = %s;
+        function load_columns(data, names, done) {
+            var missing = names.filter(function (name) {return !(name in data);});
+            var pending = missing.length;
+            var failed = [];
+            if (pending == 0) {done(failed); return;}
+            function finish(name, error) {
+                if (error !== null) {
+                    console.error('count column ' + name + ' could not be loaded from ' + shard_files[name] + ': ' + error);
+                    failed.push(name);
+                }
+                pending -= 1;
+                if (pending == 0) {done(failed);}
             }
-            for (j = 0; j < width.length; j++){
-                wjdth[i] = data2['width_none'][j];
-                x[j] = data2['x_none'][j];
-                tag[j] = data2['tag_none'][j];
+            missing.forEach(function (name) {
+                var request = new XMLHttpRequest();
+                request.open('GET', shard_files[name]);
+                request.onload = function () {
+                    if (request.status < 200 || request.status >= 300) {
+                        finish(name, 'status ' + request.status);
+                        return;
+                    }
+                    try {
+                        var shard = JSON.parse(request.responseText);
+                        var bytes = atob(shard['data']);
+                    } catch (e) {
+                        finish(name, e);
+                        return;
+                    }
+                    var buffer = new ArrayBuffer(bytes.length);
+                    var view = new Uint8Array(buffer);
+                    for (var k = 0; k < bytes.length; k++) {view[k] = bytes.charCodeAt(k);}
+                    data[name] = Array.prototype.slice.call(new Int32Array(buffer));
+                    finish(name, null);
+                };
+                request.onerror = function () {finish(name, 'network error');};
+                request.send();
+            });
+        }
+"""
+
+#javascript that copies columns left out of the html as copies of another column back,
+#it runs before any callback changes a column, so the copy is still the same as the original
+COLUMN_ALIAS_CODE = """
+        var column_aliases = %s;
+        function copy_column_aliases(source, aliases) {
+            var data = source.get('data');
+            for (var name in aliases) {
+                if (!(name in data)) {data[name] = Array.prototype.slice.call(data[aliases[name]]);}
             }
-            experience_selector = "count_none"
-        }else if (f == 'At least 1 year') {
-            for (i = 0; i < count.length; i++) {
-                count[i] = data1['count_1_year'][i];
+        }
+        copy_column_aliases(source1, column_aliases['states']);
+        copy_column_aliases(source2, column_aliases['career']);
+        if (typeof source3 !== 'undefined') {copy_column_aliases(source3, column_aliases['counties']);}
+"""
+
+#javascript that keeps the count of the selected career areas in the map source,
+#a toggle adds or subtracts only that area, and sums of recently seen selections are cached
+SELECTION_AGGREGATOR_CODE = """
+        var careerarea_names = %s;
+        function get_aggregator(source, experience_selector_name) {
+            if (source.selection_aggregator === undefined) {
+                source.selection_aggregator = {experience: experience_selector_name,
+                    selected: {}, running: null, cache: {}, cache_keys: []};
+            }
+            return source.selection_aggregator;
+        }
+        function selected_names(agg) {
+            return careerarea_names.filter(function (name) {return agg.selected[name];});
+        }
+        // the selection as a bitset over career areas
+        function selection_key(agg) {
+            return careerarea_names.map(function (name) {return agg.selected[name] ? '1' : '0';}).join('');
+        }
+        function cache_selection(agg) {
+            var key = selection_key(agg);
+            if (key in agg.cache) {
+                agg.cache_keys.splice(agg.cache_keys.indexOf(key), 1);
             }
-            for (j = 0; j < width.length; j++){
-                width[j] = data2['width_1_year'][j];
-                x[j] = data2['x_1_year'][j];
-                tag[j] = data2['tag_1_year'][j];
+            agg.cache_keys.push(key);
+            agg.cache[key] = agg.running.slice();
+            if (agg.cache_keys.length > %d) {
+                delete agg.cache[agg.cache_keys.shift()];
             }
-            experience_selector = "count_1_year"
-        }else if (f == 'At least 2 year'){
-            for (i = 0; i < count.length; i++) {
-                count[i] = data1['count_2_year'][i];
+        }
+        function toggle_careerarea(agg, data, name) {
+            var column = data[agg.experience + "_" + name];
+            var sign = agg.selected[name] ? -1 : 1;
+            if (agg.selected[name]) {delete agg.selected[name];} else {agg.selected[name] = true;}
+            var key = selection_key(agg);
+            if (key in agg.cache) {
+                agg.running = agg.cache[key].slice();
+            } else {
+                for (var j = 0; j < column.length; j++) {agg.running[j] += sign * column[j];}
+            }
+            cache_selection(agg);
+        }
+        // sum the selected career areas from scratch under a new experience selector
+        function reset_aggregator(agg, data, experience_selector_name) {
+            agg.experience = experience_selector_name;
+            agg.cache = {};
+            agg.cache_keys = [];
+            agg.running = data[experience_selector_name].map(function () {return 0;});
+            selected_names(agg).forEach(function (name) {
+                var column = data[experience_selector_name + "_" + name];
+                for (var j = 0; j < column.length; j++) {agg.running[j] += column[j];}
+            });
+            cache_selection(agg);
+        }
+        function aggregated_count(agg, data) {
+            return selected_names(agg).length ? agg.running : data[agg.experience];
+        }
+        function aggregate_count(source, agg, data, done) {
+            done(aggregated_count(agg, data));
+        }
+        function selected_columns(agg, experience_selector_name) {
+            return selected_names(agg).map(function (name) {return experience_selector_name + "_" + name;});
+        }
+"""
+
+SELECTION_CACHE_SIZE = 64
+
+#javascript that sums the count of the selection in a web worker over the packed counts[frame, experience, careerarea, state]
+#instead of columns of the map source. Its functions come after those of the selection aggregator and replace them,
+#the selection is still kept by the aggregator but no column is summed on the main thread.
+#Only the newest request is answered back to the page, a worker keeps its last sum and adds or subtracts
+#only the toggled career areas, and without web workers the same kernel runs on the main thread
+COUNT_WORKER_CODE = """
+        var experience_names = %s;
+        var packed_shape = %s;
+        function load_columns(data, names, done) {done([]);}
+        function selected_columns(agg, experience_selector_name) {return [];}
+        function reset_aggregator(agg, data, experience_selector_name) {agg.experience = experience_selector_name;}
+        function toggle_careerarea(agg, data, name) {
+            if (agg.selected[name]) {delete agg.selected[name];} else {agg.selected[name] = true;}
+        }
+        function make_count_kernel(post) {
+            var counts = null, shape = null, last = null;
+            function add_areas(sum, frame, experiences, areas, sign) {
+                for (var e = 0; e < experiences.length; e++) {
+                    for (var a = 0; a < areas.length; a++) {
+                        var offset = ((frame * shape[1] + experiences[e]) * shape[2] + areas[a]) * shape[3];
+                        for (var s = 0; s < shape[3]; s++) {sum[s] += sign * counts[offset + s];}
+                    }
+                }
+            }
+            return function (message) {
+                if (message.counts) {
+                    counts = message.counts;
+                    shape = message.shape;
+                    last = null;
+                    return;
+                }
+                var experiences = [], areas = [], k;
+                for (k = 0; k < shape[1]; k++) {if (message.experience < 0 || message.experience == k) {experiences.push(k);}}
+                for (k = 0; k < shape[2]; k++) {if (message.selected.length == 0 || message.selected.indexOf(k) >= 0) {areas.push(k);}}
+                var sum;
+                if (last && last.frame == message.frame && last.experience == message.experience) {
+                    var added = areas.filter(function (a) {return last.areas.indexOf(a) < 0;});
+                    var removed = last.areas.filter(function (a) {return areas.indexOf(a) < 0;});
+                    if (added.length + removed.length < areas.length) {
+                        sum = last.sum.slice();
+                        add_areas(sum, message.frame, experiences, added, 1);
+                        add_areas(sum, message.frame, experiences, removed, -1);
+                    }
+                }
+                if (sum === undefined) {
+                    sum = new Float64Array(shape[3]);
+                    add_areas(sum, message.frame, experiences, areas, 1);
+                }
+                last = {frame: message.frame, experience: message.experience, areas: areas, sum: sum};
+                var count = new Float64Array(sum);
+                post({id: message.id, count: count}, [count.buffer]);
+            };
+        }
+        function get_count_worker(source) {
+            if (source.count_worker === undefined) {
+                var answer = function (message) {
+                    if (message.id == source.count_request) {source.count_done(message.count);}
+                };
+                try {
+                    var script = "var make_count_kernel = " + make_count_kernel.toString() + ";" +
+                        "var handle = make_count_kernel(function (message, transfer) {self.postMessage(message, transfer);});" +
+                        "self.onmessage = function (event) {handle(event.data);};";
+                    var worker = new Worker(URL.createObjectURL(new Blob([script], {type: 'application/javascript'})));
+                    worker.onmessage = function (event) {answer(event.data);};
+                    source.count_worker = worker;
+                } catch (error) {
+                    var handle = make_count_kernel(answer);
+                    source.count_worker = {postMessage: function (message) {handle(message);}};
+                }
+                source.count_worker.postMessage({counts: packed.get('data')['counts'], shape: packed_shape});
+            }
+            return source.count_worker;
+        }
+        function aggregate_count(source, agg, data, done) {
+            var worker = get_count_worker(source);
+            source.count_request = (source.count_request || 0) + 1;
+            source.count_done = done;
+            worker.postMessage({id: source.count_request, frame: agg.frame || 0,
+                experience: experience_names.indexOf(agg.experience),
+                selected: selected_names(agg).map(function (name) {return careerarea_names.indexOf(name);})});
+        }
+"""
+
+#javascript that colors the map by quintile, breaks of a single count column come from the table,
+#the count of many career areas is sorted once per selection and its breaks are kept,
+#the table ships once in the tags of the color bar, an argument of the shared callback
+QUANTILE_CODE = """
+        var quantile_breaks = color_bar.get('tags')[0]['quantile_breaks'];
+        var quantile_levels = %s;
+        var quantile_palette = %s;
+        function get_quantile_breaks(source, agg, count) {
+            var table = source.quantile_breaks === undefined ? quantile_breaks : source.quantile_breaks;
+            var names = selected_names(agg);
+            if (names.length == 0) {return table[agg.experience];}
+            if (names.length == 1) {return table[agg.experience + "_" + names[0]];}
+            if (source.quantile_cache === undefined) {source.quantile_cache = {};}
+            var key = agg.experience + selection_key(agg);
+            if (!(key in source.quantile_cache)) {
+                var sorted = Array.prototype.slice.call(count).sort(function (a, b) {return a - b;});
+                source.quantile_cache[key] = quantile_levels.map(function (level) {
+                    var position = level / 100 * (sorted.length - 1);
+                    var lower = Math.floor(position);
+                    var upper = Math.min(lower + 1, sorted.length - 1);
+                    return sorted[lower] + (sorted[upper] - sorted[lower]) * (position - lower);
+                });
+            }
+            return source.quantile_cache[key];
+        }
+        function color_by_quantile(source, agg, color_bar) {
+            var data = source.get('data');
+            var count = data['count'];
+            var color = data['color'];
+            var breaks = get_quantile_breaks(source, agg, count);
+            for (var j = 0; j < count.length; j++) {
+                var k = 0;
+                while (k < breaks.length && count[j] > breaks[k]) {k++;}
+                color[j] = quantile_palette[k];
+            }
+            var title = "Quintile breaks: " + breaks.map(Math.round).join(" / ");
+            // the title of each layer is kept for the zoom to show it, silently so that the glyphs are not redrawn twice
+            source.setv({tags: [title]}, {silent: true});
+            if (color_bar !== null) {color_bar.set('title', title);}
+        }
+"""
+
+#javascript of the map layers a selection is summed on, the states, and the counties with a county layer,
+#each layer keeps its own sum, and the color bar shows the quintile breaks of the layer on show
+MAP_LAYER_CODE = """
+        function get_map_layers() {
+            var layers = [{source: source1, renderer: typeof renderer1 === 'undefined' ? null : renderer1}];
+            if (typeof source3 !== 'undefined') {
+                if (source3.quantile_breaks === undefined) {
+                    source3.quantile_breaks = color_bar.get('tags')[0]['county_quantile_breaks'];
+                }
+                layers.push({source: source3, renderer: renderer3});
             }
-            for (j = 0; j < width.length; j++){
-                width[j] = data2['width_2_year'][j];
-                x[j] = data2['x_2_year'][j];
-                tag[j] = data2['tag_2_year'][j];
+            return layers;
+        }
+        function show_layer_count(layer, agg, new_count) {
+            var count = layer.source.get('data')['count'];
+            for (var j = 0; j < count.length; j++) {
+                count[j] = new_count[j];
             }
-            experience_selector = "count_2_year"
-        }else{
-            for (i = 0; i < count.length; i++) {
-                count[i] = data1['count_all'][i];
+            var shown = layer.renderer === null || layer.renderer.get('visible');
+            color_by_quantile(layer.source, agg, shown ? color_bar : null);
+            layer.source.trigger('change');
+        }
+"""
+
+#javascript that fills the career area bar from the rankings in the tags of its source, the career areas
+#of an experience selector, or the occupation groups of one career area, nothing is sorted in the page
+RANKING_CODE = """
+        var career_rankings = source2.get('tags')[0];
+        var career_area_bar_title = %s;
+        function show_ranking(source2, selector, careerarea, agg) {
+            var r = career_rankings['selectors'].indexOf(selector);
+            var ranking = career_rankings['careerareas'];
+            var names = career_rankings['careerarea_names'];
+            if (careerarea !== null) {
+                r = r * names.length + names.indexOf(careerarea);
+                ranking = career_rankings['groups'];
+                names = career_rankings['group_names'];
             }
-            for (j = 0; j < width.length; j++){
-                width[j] = data2['width_all'][j];
-                x[j] = data2['x_all'][j];
-                tag[j] = data2['tag_all'][j];
+            var start = ranking['indptr'][r];
+            var n = ranking['indptr'][r + 1] - start;
+            var columns = {y: [], label_x: [], width: [], x: [], tag: [], color: [], color2: [], experience_selector: []};
+            for (var j = 0; j < n; j++) {
+                var tag = names[ranking['items'][start + j]];
+                columns['y'].push(j + 1);
+                columns['label_x'].push(0);
+                columns['width'].push(ranking['counts'][start + j]);
+                columns['x'].push(ranking['counts'][start + j] / 2);
+                columns['tag'].push(tag);
+                columns['color'].push(careerarea === null && agg.selected[tag] ? "#08519c" : "#6baed6");
+                columns['color2'].push("#6baed6");
+                columns['experience_selector'].push(j == 0 ? "count" + selector : 0);
             }
-            experience_selector = "count_all"
+            var data2 = source2.get('data');
+            for (var name in columns) {data2[name] = columns[name];}
+            source2.drill_careerarea = careerarea;
+            // the largest bar is the last one
+            range2.set('end', n > 0 ? Math.max(columns['width'][n - 1], 1) : 1);
+            title2.set('text', careerarea === null ? career_area_bar_title : careerarea + " (double-tap to go back)");
+            source2.trigger('change');
         }
-        mapper_low = Math.min(count);
-        mapper_high = Math.max(count);
+        function get_drill_careerarea(source2) {
+            return source2.drill_careerarea === undefined ? null : source2.drill_careerarea;
+        }
+"""
 
-        source1.trigger('change');
-        source2.trgger('change');
-        bar.trigger('change');
-    """)
+EXPERIENCE_CALLBACK_CODE = """
+        var f = cb_obj.get('value');
 
+        var data2 = source2.get('data');
 
-callback_career = CustomJS(args=dict(
-    source1 = source,
-    source2 = career_source),
-    code="""
+        var selector = "_all";
+        if (f == 'None') {
+            selector = "_none";
+        }else if (f == 'At least 1 year') {
+            selector = "_1_year";
+        }else if (f == 'At least 2 year'){
+            selector = "_2_year";
+        }
+        var experience_selector = "count" + selector;
+        var layers = lib.get_map_layers();
+        var aggs = layers.map(function (layer) {
+            return lib.get_aggregator(layer.source, data2['experience_selector'][0]);
+        });
+        var agg = aggs[0];
+
+        lib.show_ranking(source2, selector, lib.get_drill_careerarea(source2), agg);
+
+        layers.forEach(function (layer, k) {
+            var data1 = layer.source.get('data');
+            lib.load_columns(data1, [experience_selector].concat(lib.selected_columns(aggs[k], experience_selector)),
+                function (failed) {
+                    // the map keeps what it shows when a count column is missing
+                    if (failed.length > 0) {return;}
+                    lib.reset_aggregator(aggs[k], data1, experience_selector);
+                    lib.aggregate_count(layer.source, aggs[k], data1, function (new_count) {
+                        lib.show_layer_count(layer, aggs[k], new_count);
+                    });
+                });
+        });
+    """
+
+CAREER_CALLBACK_CODE = """
         var inds = cb_obj.get('selected')['1d'].indices;
-
-        var data1 = source1.get('data');
-        var count = data1['count'];
+        // the occupation groups of a career area are only shown, they select nothing
+        if (lib.get_drill_careerarea(source2) !== null) {return;}
 
         var data2 = source2.get('data');
         var tag = data2['tag'];
         var experience_selector_name = data2['experience_selector'][0];
         var color = data2['color'];
 
-        num = 0
-        for (i = 0; i<color.length; i++){
-            if(color[i] == "#08519c"){num += 1;}
+        var names = [experience_selector_name];
+        for (i = 0; i < inds.length; i++) {
+            names.push(experience_selector_name + "_"+ tag[inds[i]]);
         }
 
-        for (i = 0; i < inds.length; i++) {
-            careerarea_selector_name = experience_selector_name + "_"+ tag[inds[i]];
-            if (color[inds[i]] == "#08519c"){
-                color[inds[i]] = data2['color2'][inds[i]];
-                for(j = 0; j < count.length; j++){
-                    if (num == 0){
-                        temp = data1[experience_selector_name][j];
-                    }else{
-                        temp = count[j];
-                    }
-                    temp = temp - data1[careerarea_selector_name][j];
-                    if(temp <= 0){
-                        count[j] = data1[experience_selector_name][j];
-                    }else{
-                        count[j] = temp
-                    }
+        lib.get_map_layers().forEach(function (layer, k) {
+            var data1 = layer.source.get('data');
+            var agg = lib.get_aggregator(layer.source, experience_selector_name);
+            lib.load_columns(data1, names, function (failed) {
+                if (failed.length > 0) {return;}
+                if (agg.running === null) {
+                    lib.reset_aggregator(agg, data1, experience_selector_name);
                 }
-            }
-            else{
-                color[inds[i]] = "#08519c";
-                for(j = 0; j < count.length; j++){
-                    if (num == 0){
-                        temp = 0;
-                    }else{
-                        temp = count[j];
+                for (var i = 0; i < inds.length; i++) {
+                    lib.toggle_careerarea(agg, data1, tag[inds[i]]);
+                }
+                // the career area bar follows the selection of the states
+                if (k == 0) {
+                    for (var j = 0; j < color.length; j++) {
+                        color[j] = agg.selected[tag[j]] ? "#08519c" : data2['color2'][j];
                     }
-                    count[j] = temp + data1[careerarea_selector_name][j];
+                    source2.trigger('change');
                 }
+                lib.aggregate_count(layer.source, agg, data1, function (new_count) {
+                    lib.show_layer_count(layer, agg, new_count);
+                });
+            });
+        });
+    """
+
+#a double-tap on a career area shows its occupation groups ranked for the experience selector,
+#and a double-tap anywhere on the occupation groups shows the career areas again
+DRILL_CALLBACK_CODE = """
+        var data2 = source2.get('data');
+        var experience_selector_name = data2['experience_selector'][0];
+        var selector = experience_selector_name.slice("count".length);
+        var agg = lib.get_aggregator(source1, experience_selector_name);
+        if (lib.get_drill_careerarea(source2) !== null) {
+            lib.show_ranking(source2, selector, null, agg);
+            return;
+        }
+        var j = Math.round(cb_obj.y) - 1;
+        if (j >= 0 && j < data2['tag'].length) {
+            lib.show_ranking(source2, selector, data2['tag'][j], agg);
+        }
+    """
+
+#swap the level of detail of both maps when the map is zoomed
+LOD_CALLBACK_CODE = """
+        var tolerances = %s;
+        var pixel = (cb_obj.get('end') - cb_obj.get('start')) / %d;
+        var level = tolerances.length - 1;
+        for (i = 0; i < tolerances.length; i++) {
+            if (tolerances[i] <= pixel) {level = i; break;}
+        }
+        var sources = [source1, source2];
+        if (typeof source3 !== 'undefined') {sources.push(source3);}
+        for (i = 0; i < sources.length; i++) {
+            var current = sources[i].lod_level === undefined ? %d : sources[i].lod_level;
+            if (current == level) {continue;}
+            var data = sources[i].get('data');
+            data['x_lod' + current] = data['x'];
+            data['y_lod' + current] = data['y'];
+            data['x'] = data['x_lod' + level];
+            data['y'] = data['y_lod' + level];
+            sources[i].lod_level = level;
+            sources[i].trigger('change');
+        }
+    """
+
+#show the counties instead of the states once the map is zoomed in, hover and the color bar follow the layer on show
+COUNTY_ZOOM_CODE = """
+        var show_counties = cb_obj.get('end') - cb_obj.get('start') <= %s;
+        if (renderer3.get('visible') != show_counties) {
+            renderer2.set('visible', !show_counties);
+            renderer3.set('visible', show_counties);
+            hover2.set('active', !show_counties);
+            hover3.set('active', show_counties);
+            color_bar.set('title', (show_counties ? source3 : source2).get('tags')[0]);
+        }
+    """
+
+# lon span of the map in degree from which counties are drawn, about a few states wide
+COUNTY_ZOOM_SPAN = 30
+
+#javascript that shows a frame of the count series: copies the count columns of the frame into the map source
+#and sums the selected career areas again
+FRAME_CODE = """
+        var frame_dates = %s;
+        var frame_quantile_breaks = color_bar.get('tags')[0]['frame_quantile_breaks'];
+        function show_frame(slider, source1, source2, frames, color_bar, frame) {
+            var data1 = source1.get('data');
+            var data2 = source2.get('data');
+            var data3 = frames.get('data');
+            var n = data1['count'].length;
+            for (var name in data3) {
+                data1[name] = Array.prototype.slice.call(data3[name], frame * n, (frame + 1) * n);
             }
+            var experience_selector_name = data2['experience_selector'][0];
+            var agg = get_aggregator(source1, experience_selector_name);
+            agg.frame = frame;
+            reset_aggregator(agg, data1, experience_selector_name);
+            source1.quantile_breaks = frame_quantile_breaks[frame];
+            source1.quantile_cache = {};
+            slider.set('title', "Date: " + frame_dates[frame]);
+            aggregate_count(source1, agg, data1, function (new_count) {
+                var count = data1['count'];
+                for (var j = 0; j < count.length; j++) {
+                    count[j] = new_count[j];
+                }
+                color_by_quantile(source1, agg, color_bar);
+                source1.trigger('change');
+            });
+        }
+"""
+
+FRAME_CALLBACK_CODE = """
+        lib.show_frame(cb_obj, source1, source2, frames, color_bar, cb_obj.get('value'));
+    """
+
+#step the slider through the frames until the button is pressed again
+PLAY_CALLBACK_CODE = """
+        if (cb_obj.play_timer) {
+            clearInterval(cb_obj.play_timer);
+            cb_obj.play_timer = null;
+            cb_obj.set('label', "Play");
+            return;
         }
-        source1.trigger('change');
-        source2.trigger('change');
-    """)
+        cb_obj.set('label', "Pause");
+        cb_obj.play_timer = setInterval(function () {
+            var frame = (slider.get('value') + 1) %% lib.frame_dates.length;
+            slider.set('value', frame);
+            lib.show_frame(slider, source1, source2, frames, color_bar, frame);
+        }, %d);
+    """
+
+# 10 frames per second
+FRAME_INTERVAL = 100
+
+
+###############################################
+#give the callback that holds the javascript every callback of the standalone html shares, so that it ships once:
+#the columns, the selection and its count, the quintile colors, the map layers, the rankings and the frames.
+#It is run by no event, each callback runs it the first time and keeps the functions it gives on it
+#params:
+#   @data, sources: DashboardData and DashboardSources of the dashboard
+#   @source, career_source, color_bar: models the functions change
+#   @packed_source: ColumnDataSource of the packed counts the worker sums, None to sum columns of the map source
+#   @county_args: source3 of counties and renderer1, renderer3 of states and counties, {} without county layer
+#   @career_area_bar: figure of the career area bar, its x range and title follow the ranking on show
+#return:
+#   CustomJS that gives an object of the functions in SHARED_FUNCTION_NAMES
+###############################################
+
+SHARED_FUNCTION_NAMES = ['get_aggregator', 'load_columns', 'selected_columns', 'reset_aggregator', 'toggle_careerarea',
+    'aggregate_count', 'get_map_layers', 'show_layer_count', 'show_ranking', 'get_drill_careerarea']
+
+# with a count series
+SHARED_FRAME_NAMES = ['show_frame', 'frame_dates']
+
+# the first line of every callback of the standalone html, lib is the object of the shared functions
+SHARED_CALL_CODE = """
+        var lib = shared.dashboard_functions || (shared.dashboard_functions = shared.execute(null, {}));
+"""
+
+def get_shared_callback(data, sources, source, career_source, color_bar, packed_source = None, county_args = None,
+        career_area_bar = None):
+    args = dict(source1 = source, source2 = career_source, color_bar = color_bar,
+        range2 = career_area_bar.x_range, title2 = career_area_bar.title)
+    if packed_source is not None:
+        args['packed'] = packed_source
+    args.update(county_args or {})
+    code = get_aggregation_code(data, sources) + RANKING_CODE % json.dumps(CAREER_AREA_BAR_TITLE)
+    names = list(SHARED_FUNCTION_NAMES)
+    if len(sources.frame_dates) > 1:
+        code += FRAME_CODE % json.dumps(sources.frame_dates)
+        names += SHARED_FRAME_NAMES
+    return CustomJS(args = args,
+        code = code + "\n        return {%s};\n" % ", ".join("%s: %s" % (name, name) for name in names))
+
+
+# javascript of the columns, the selection and its count, and the quintile colors
+def get_aggregation_code(data, sources):
+    code = (COLUMN_ALIAS_CODE % json.dumps(sources.column_aliases)
+        + COLUMN_LOADER_CODE % json.dumps(sources.shard_files)
+        + SELECTION_AGGREGATOR_CODE % (json.dumps(data.occupation_index.careerarea_names), SELECTION_CACHE_SIZE))
+    if sources.packed_counts is not None:
+        code += COUNT_WORKER_CODE % (json.dumps(['count' + name for name in EXPERIENCE_NAMES]),
+            json.dumps(list(sources.packed_counts.shape)))
+    return code + QUANTILE_CODE % (json.dumps(QUANTILE_LEVELS), json.dumps(palette1)) + MAP_LAYER_CODE
+
+
+###############################################
+#give the javascript callbacks of the experience selector and the career area bar in standalone html
+#params:
+#   @shared: CustomJS given by get_shared_callback
+#   @source, career_source: ColumnDataSource of the us states and the career area bar
+#return:
+#   CustomJS of the experience selector, of a tap and of a double-tap on the career area bar
+###############################################
+
+def get_static_callbacks(shared, source, career_source):
+    args = dict(shared = shared, source1 = source, source2 = career_source)
+
+    callback_experience = CustomJS(args=dict(args),
+        code=SHARED_CALL_CODE + EXPERIENCE_CALLBACK_CODE)
+
+    callback_career = CustomJS(args=dict(args),
+        code=SHARED_CALL_CODE + CAREER_CALLBACK_CODE)
+
+    callback_drill = CustomJS(args=dict(args),
+        code=SHARED_CALL_CODE + DRILL_CALLBACK_CODE)
+
+    return callback_experience, callback_career, callback_drill
+
+
+###############################################
+#give the javascript callbacks of the date slider and the play button in standalone html,
+#frames of every count column ship in one source shared by both
+#params:
+#   @shared: CustomJS given by get_shared_callback
+#   @sources: DashboardSources of the dashboard
+#   @source, career_source, color_bar, slider: models the callbacks change
+#return:
+#   CustomJS of the date slider and of the play button
+###############################################
+
+def get_frame_callbacks(shared, sources, source, career_source, color_bar, slider):
+    args = dict(shared = shared, source1 = source, source2 = career_source,
+        frames = ColumnDataSource(data = sources.frames), color_bar = color_bar)
+
+    callback_frame = CustomJS(args=dict(args),
+        code=SHARED_CALL_CODE + FRAME_CALLBACK_CODE)
+
+    callback_play = CustomJS(args=dict(args, slider = slider),
+        code=SHARED_CALL_CODE + PLAY_CALLBACK_CODE % FRAME_INTERVAL)
+
+    return callback_frame, callback_play
+
+
+
 
 ######################################################
-#Deploy widget, call back
+#server mode handlers, the selection is kept in python and
+#the count is computed from the count matrix for any subset of occupations
+#params:
+#   @data: DashboardData of the dashboard
+#   @source, career_source: ColumnDataSource of the us states and the career area bar
+#   @color_bar: ColorBar of the map, its title shows the quintile breaks
+#   @select_experience, select_group: Select widgets of experience and occupation group
+#   @slider_frame, button_play: date Slider and play Button over the count series, None without a series
+#   @county_source: ColumnDataSource of counties, None without county layer
+#   @map_renderers: MapRenderers of the map, the color bar shows the quintile breaks of the layer on show
+#   @career_area_bar: figure of the career area bar, a double-tap shows the occupation groups of a career area
+#   @career_rankings: CareerRankings the career area bar is filled from
 ######################################################
-career_area_bar.add_tools(TapTool(renderers=[bar],
-    callback = callback_career))
 
-select_experience = Select(
-    title="Select postings that require experience of:",
-    value='All',
-    options= ['All', 'None', 'At least 1 year', 'At least 2 year'],
-    callback = callback_experience)
+def add_server_handlers(data, source, career_source, color_bar, select_experience, select_group,
+        slider_frame = None, button_play = None, county_source = None, map_renderers = None,
+        career_area_bar = None, career_rankings = None):
+    occupation_index = data.occupation_index
+    careerarea_codes = {name: code for code, name in enumerate(occupation_index.careerarea_names)}
+    group_codes = {name: code for code, name in enumerate(occupation_index.group_names)}
+    server_selection = dict(experience = '_all', group = 'All', count_matrix = data.count_matrix, play = None,
+        careerarea = None)
+
+    #count of every career area in each row of a count matrix under the experience and group filters
+    def get_server_careerarea_count(count_matrix):
+        return get_careerarea_count_us_continent_mask(occupation_index, get_occupation_mask(occupation_index,
+            experience = server_selection['experience'],
+            groups = None if server_selection['group'] == 'All' else [group_codes[server_selection['group']]]),
+            count_matrix)
+
+    #every map layer keeps its own sum of the selection, the states follow the frame on show
+    server_layers = [dict(source = source, renderer = None,
+        count_matrix = lambda: server_selection['count_matrix'])]
+    if county_source is not None:
+        server_layers[0]['renderer'] = map_renderers.states
+        server_layers.append(dict(source = county_source, renderer = map_renderers.counties,
+            count_matrix = lambda: data.counties.count_matrix))
+    for layer in server_layers:
+        layer['aggregator'] = SelectionAggregator(get_server_careerarea_count(layer['count_matrix']()))
+    server_aggregator = server_layers[0]['aggregator']
+
+    def reset_server_aggregators():
+        for layer in server_layers:
+            layer['aggregator'].reset(get_server_careerarea_count(layer['count_matrix']()))
+
+    #push only the rows whose count or quintile changes
+    def push_server_count():
+        for layer in server_layers:
+            push_server_layer_count(layer['source'], layer['aggregator'].count(), layer['renderer'])
+
+    def push_server_layer_count(layer_source, count, renderer):
+        breaks = get_quantile_breaks(count)
+        color = get_quantile_colors(count, breaks)
+        patches = {}
+        changed = np.nonzero(count != np.asarray(layer_source.data['count']))[0]
+        if len(changed):
+            patches['count'] = [(int(i), int(count[i])) for i in changed]
+        changed_color = [(j, c) for j, (c, old) in enumerate(zip(color, layer_source.data['color'])) if c != old]
+        if changed_color:
+            patches['color'] = changed_color
+        if patches:
+            layer_source.patch(patches)
+        # the page swaps the title from the tags of the layer when it is zoomed, and syncs back which one is on show
+        if renderer is not None:
+            layer_source.tags = [get_quantile_title(breaks)]
+        if renderer is None or renderer.visible:
+            color_bar.title = get_quantile_title(breaks)
+
+    def get_server_career_color(tags):
+        selected = server_aggregator.get_selected_codes()
+        return ["#08519c" if careerarea_codes[tag] in selected else "#6baed6" for tag in tags]
+
+    def push_server_career_color():
+        color = get_server_career_color(career_source.data['tag'])
+        changed = [(j, c) for j, (c, old) in enumerate(zip(color, career_source.data['color'])) if c != old]
+        if changed:
+            career_source.patch({'color': changed})
+
+    #the bars of the ranking on show replace all others, the career areas or the occupation groups of one of them
+    def push_server_ranking():
+        careerarea = server_selection['careerarea']
+        columns = get_ranking_columns(career_rankings, server_selection['experience'], careerarea)
+        n_bars = len(columns['tag'])
+        columns['color2'] = ["#6baed6"] * n_bars
+        columns['color'] = columns['color2'] if careerarea is not None else get_server_career_color(columns['tag'])
+        columns['experience_selector'] = ['count' + server_selection['experience']] + [0] * (n_bars - 1)
+        career_source.data = columns
+        career_area_bar.x_range.end = max(int(columns['width'][-1]), 1) if n_bars else 1
+        career_area_bar.title.text = (CAREER_AREA_BAR_TITLE if careerarea is None
+            else careerarea + " (double-tap to go back)")
+
+    def on_experience_change(attr, old, new):
+        selector = EXPERIENCE_SELECTOR[new]
+        server_selection['experience'] = selector
+        reset_server_aggregators()
+        push_server_ranking()
+        push_server_count()
+
+    def on_careerarea_tap(attr, old, new):
+        inds = new['1d']['indices']
+        if not inds:
+            return
+        # the occupation groups of a career area are only shown, they select nothing
+        if server_selection['careerarea'] is None:
+            for j in inds:
+                for layer in server_layers:
+                    layer['aggregator'].toggle(careerarea_codes[career_source.data['tag'][j]])
+        # clear the selection, so that tapping the same bar again toggles it back
+        career_source.selected = {'0d': {'glyph': None, 'indices': []}, '1d': {'indices': []}, '2d': {'indices': {}}}
+        if server_selection['careerarea'] is None:
+            push_server_career_color()
+            push_server_count()
+
+    def on_careerarea_double_tap(event):
+        if server_selection['careerarea'] is not None:
+            server_selection['careerarea'] = None
+        else:
+            j = int(round(event.y)) - 1
+            if not 0 <= j < len(career_source.data['tag']):
+                return
+            server_selection['careerarea'] = career_source.data['tag'][j]
+        push_server_ranking()
+
+    def on_group_change(attr, old, new):
+        server_selection['group'] = new
+        reset_server_aggregators()
+        push_server_count()
+
+    #a new frame keeps all filters and the selection, only the states whose count changes are pushed
+    def on_frame_change(attr, old, new):
+        server_selection['count_matrix'] = get_count_series_frame(data.count_series, new)
+        slider_frame.title = "Date: " + data.count_series.dates[new]
+        reset_server_aggregators()
+        push_server_count()
+
+    def on_play_step():
+        slider_frame.value = (slider_frame.value + 1) % len(data.count_series.dates)
+
+    def on_play_click():
+        if server_selection['play'] is None:
+            server_selection['play'] = curdoc().add_periodic_callback(on_play_step, FRAME_INTERVAL)
+            button_play.label = "Pause"
+        else:
+            curdoc().remove_periodic_callback(server_selection['play'])
+            server_selection['play'] = None
+            button_play.label = "Play"
+
+    select_experience.on_change('value', on_experience_change)
+    select_group.on_change('value', on_group_change)
+    career_source.on_change('selected', on_careerarea_tap)
+    if career_area_bar is not None:
+        career_area_bar.on_event(DoubleTap, on_careerarea_double_tap)
+    if slider_frame is not None:
+        slider_frame.on_change('value', on_frame_change)
+        button_play.on_click(on_play_click)
+
+
+
+
+###############################################
+#run startup tasks in a thread pool, each one as soon as the tasks it needs are done,
+#so that reading files and caches, parsing and the download of world borders overlap
+#with a stage cache, a task whose result is cached is loaded instead, and the tasks only it needed are skipped
+#params:
+#   @tasks: list of StartupTask of a name, a function, the names of the tasks it needs, its inputs and
+#           whether its result is cached, the function is called with the results of the needed tasks in that order,
+#           every task comes after the tasks it needs,
+#           cached may be a function of a cached result instead, that tells whether it is still valid,
+#           e.g. whether the files it refers to are still there, an invalid one is a miss
+#   @max_workers: threads of the pool, 1 runs the tasks one after another in the order of the list
+#   @stage_cache: StageCache of task results, None to run every task
+#   @wanted: names of the tasks whose results are given, None for all of them
+#return:
+#   StartupReport of the result of every task by name, (start, end) seconds of every task since the start,
+#   the critical path: the chain of tasks the last one to end waited for, the wall time,
+#   and the status of every task: 'run', 'miss' (run and cached), 'hit' (loaded from the cache) or 'skip'
+###############################################
+
+StartupTask = namedtuple('StartupTask', ['name', 'function', 'needs', 'inputs', 'cached'])
+
+StartupReport = namedtuple('StartupReport', ['results', 'spans', 'critical_path', 'seconds', 'status'])
+
+STARTUP_WORKERS = 4
+
+def run_startup_tasks(tasks, max_workers = STARTUP_WORKERS, stage_cache = None, wanted = None):
+    start = time.perf_counter()
+    results, spans = {}, {}
+
+    # from the wanted tasks back to the ones they need, a cached result needs nothing
+    keys = stage_cache.get_keys(tasks) if stage_cache is not None else {}
+    needed = set(wanted) if wanted is not None else set(task.name for task in tasks)
+    status = {}
+    for task in reversed(tasks):
+        if task.name not in needed:
+            status[task.name] = 'skip'
+            continue
+        if task.cached and keys.get(task.name) is not None:
+            task_start = time.perf_counter() - start
+            cached = stage_cache.load(task.name, keys[task.name])
+            if cached is not None and (not callable(task.cached) or task.cached(cached['result'])):
+                results[task.name] = cached['result']
+                spans[task.name] = (task_start, time.perf_counter() - start)
+                status[task.name] = 'hit'
+                continue
+        status[task.name] = 'miss' if task.cached and keys.get(task.name) is not None else 'run'
+        needed.update(task.needs)
+
+    def run_task(task):
+        task_start = time.perf_counter() - start
+        result = task.function(*[results[name] for name in task.needs])
+        if status[task.name] == 'miss':
+            stage_cache.store(task.name, keys[task.name], result)
+        spans[task.name] = (task_start, time.perf_counter() - start)
+        return result
+
+    pending = [task for task in tasks if status[task.name] in ('run', 'miss')]
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+        running = {}
+        while pending or running:
+            for task in [task for task in pending if all(name in results for name in task.needs)]:
+                pending.remove(task)
+                running[pool.submit(run_task, task)] = task
+                # one worker keeps the order of the list
+                if max_workers == 1:
+                    break
+            if not running:
+                raise ValueError("startup tasks need unknown tasks: %s" % ", ".join(task.name for task in pending))
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future).name] = future.result()
+
+    return StartupReport(results, spans, get_critical_path(tasks, spans), time.perf_counter() - start, status)
+
+
+# from the last task to end, step back to the task it needed that ended last, a cache hit needed none
+def get_critical_path(tasks, spans):
+    if not spans:
+        return []
+    needs = {task.name: [name for name in task.needs if name in spans] for task in tasks}
+    name = max(spans, key = lambda name: spans[name][1])
+    path = [name]
+    while needs[name]:
+        name = max(needs[name], key = lambda name: spans[name][1])
+        path.append(name)
+    return path[::-1]
+
+
+def print_startup_report(report):
+    critical = set(report.critical_path)
+    for name, (start, end) in sorted(report.spans.items(), key = lambda item: item[1]):
+        print("  %s %-20s %8.4f s -> %8.4f s  %8.4f s  %s" % ('*' if name in critical else ' ', name, start, end,
+            end - start, report.status[name]))
+    busy = sum(end - start for start, end in report.spans.values())
+    print("startup %.4f s, %.4f s of tasks, critical path (*) %s" % (report.seconds, busy,
+        " -> ".join(report.critical_path)))
+    counts = {state: sum(1 for status in report.status.values() if status == state) for state in ('hit', 'miss', 'skip')}
+    if counts['hit'] or counts['miss']:
+        print("stage cache: %d hits, %d misses, %d tasks skipped%s" % (counts['hit'], counts['miss'], counts['skip'],
+            "" if not counts['skip'] else " (%s)" % ", ".join(
+                name for name, status in report.status.items() if status == 'skip')))
+
+
+
+
+###############################################
+#content-addressed cache of startup task results on disk, the key of a task is the hash of its inputs, the keys
+#of the tasks it needs and the code, so that a task only runs again when something it depends on changed,
+#and keys are known before any task runs
+#a result is kept as a shared store file, see write_shared_store, its arrays are loaded read-only
+#params:
+#   @directory: directory of the cache files
+#   @keep: results kept of every task, the least recently used ones are removed when a new one is stored
+#get_keys gives the key of every task by name, None for a task with unknown inputs and every task that needs it
+###############################################
+
+STAGE_CACHE_DIR = os.path.join(BINARY_CACHE_DIR, "stages")
+STAGE_CACHE_KEEP = 4
+
+class StageCache(object):
+
+    def __init__(self, directory = STAGE_CACHE_DIR, keep = STAGE_CACHE_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self.code_key = get_code_key()
+
+    def get_keys(self, tasks):
+        keys = {}
+        for task in tasks:
+            if task.inputs is None or any(keys.get(name) is None for name in task.needs):
+                keys[task.name] = None
+                continue
+            key = json.dumps([task.name, task.inputs, [keys[name] for name in task.needs], self.code_key],
+                sort_keys = True)
+            keys[task.name] = hashlib.sha1(key.encode()).hexdigest()
+        return keys
+
+    def get_path(self, name, key):
+        return os.path.join(self.directory, "%s-%s.bin" % (name, key))
+
+    # dict of the result, None if it is not cached
+    def load(self, name, key):
+        path = self.get_path(name, key)
+        cached = read_shared_store(path)
+        if cached is not None:
+            # the time of last use decides what is removed
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return cached
+
+    def store(self, name, key, result):
+        try:
+            write_shared_store(self.get_path(name, key), dict(result = result))
+        except OSError:
+            return
+        paths = sorted(glob.glob(os.path.join(self.directory, name + "-*.bin")), key = os.path.getmtime, reverse = True)
+        for path in paths[self.keep:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# the code and the bokeh version, a result of another one of them is never used
+def get_code_key():
+    # this module and map_count_distribution_data that the stages call into
+    paths = [__file__, sys.modules[load_count_matrix.__module__].__file__]
+    return "-".join([get_file_hash(os.path.abspath(path)) for path in paths] + [bokeh_version])
+
+
+# content hash of every input file, None for an input that is not used
+def get_input_keys(paths):
+    return [get_file_hash(path) if path is not None else None for path in paths]
+
+
+
+
+###############################################
+#startup tasks of the whole dashboard: states map, counts, occupation info and world borders load at the same time,
+#the world borders are simplified while the counts are aggregated, see run_startup_tasks
+#params:
+#   same as build_dashboard, @shard_dir: directory of count shards, None to embed every count column
+#return:
+#   list of StartupTask, 'data', 'aggregate', 'aggregate_counties', 'sources' and 'render' give
+#   the results of the stages, 'data' leaves the world borders to the 'world' task,
+#   'save' writes the html of the layout to output and gives SavedDashboard, see save_dashboard
+#   the inputs of a task are the content hashes of the files it reads and the options it takes,
+#   world borders without a local json file are the same as long as the url is, like in load_geo_world,
+#   the sources, the layout and the html also depend on the shard directory and the name of the html,
+#   the html loads shards by urls made of them
+#   the simplified world borders, the aggregates, the sources and the html are cached,
+#   sources that write shards or that a server changes in place are not, and a cached html only
+#   as long as the shards it loads are still there as they were saved
+###############################################
+
+def get_dashboard_tasks(counts_path = COUNT_FILEPATH, occupations_path = OCCUPATION_FILEPATH,
+        geo_cache = WORLD_GEO_CACHE, output = DASHBOARD_HTML, geojson_path = None, shard_dir = None,
+        server_mode = False, series_pattern = None, dedupe = True, worker = False, county_counts_path = None,
+        counties_map = None):
+    if county_counts_path is not None:
+        count_paths = [county_counts_path]
+    elif series_pattern is not None:
+        count_paths = get_count_files(series_pattern)
+    else:
+        count_paths = [counts_path]
+    geojson_key = get_input_keys([geojson_path])[0]
+    layout_inputs = dict(lazy = shard_dir is not None,
+        shard_dir = os.path.abspath(shard_dir) if shard_dir is not None else None,
+        output = os.path.basename(output) if output is not None else None)
+    return [
+        StartupTask('counts', lambda: load_count_data(counts_path, series_pattern, county_counts_path), [],
+            dict(counts = get_input_keys(count_paths), series = series_pattern is not None,
+                counties = county_counts_path is not None), False),
+        StartupTask('world', lambda: load_geo_world(geo_cache, geojson_path), [],
+            dict(geojson = geojson_key, url = WORLD_GEO_URL if geojson_key is None else None), False),
+        StartupTask('occupations', lambda: get_occupation_info(occupations_path), [],
+            dict(occupations = get_input_keys([occupations_path])), False),
+        StartupTask('geography', get_states_geography, [], dict(states = 'us_states'), False),
+        StartupTask('county_geography',
+            lambda: get_counties_geography(counties_map) if county_counts_path is not None else None, [],
+            dict(counties = county_counts_path is not None) if counties_map is None else None, False),
+        StartupTask('data', join_dashboard_data, ['counts', 'occupations', 'geography', 'county_geography'], {}, False),
+        StartupTask('world_source', build_world_source, ['world'], {}, True),
+        StartupTask('aggregate', aggregate_dashboard_data, ['data'], {}, True),
+        StartupTask('aggregate_counties', aggregate_county_data, ['data'], {}, True),
+        StartupTask('sources', lambda data, state_count_cube, county_count_cube, world_source: build_dashboard_sources(
+            data, state_count_cube, shard_dir, server_mode, world_source, dedupe, worker, county_count_cube),
+            ['data', 'aggregate', 'aggregate_counties', 'world_source'],
+            dict(server_mode = server_mode, dedupe = dedupe, worker = worker, **layout_inputs),
+            shard_dir is None and not server_mode),
+        StartupTask('render', lambda data, sources: render_dashboard(data, sources, None, server_mode),
+            ['data', 'sources'], dict(server_mode = server_mode, **layout_inputs), False),
+        StartupTask('save', lambda layout, sources: save_dashboard(layout, output, sources.shard_files),
+            ['render', 'sources'], dict(layout_inputs),
+            (lambda saved: has_saved_shards(saved, output)) if output is not None else False),
+    ]
+
+
+
+
+###############################################
+#build the whole dashboard stage by stage
+#params:
+#   @counts_path, occupations_path: count and occupation info .csv files
+#   @geo_cache: .npz cache of the world borders, None means no cache
+#   @output: standalone html file to write, None to write nothing
+#   @geojson_path: local world-geo json file, None to use the cache or the url
+#   @lazy: move count columns of every selector combination out to shards next to the html
+#   @server_mode: widgets call python handlers of a bokeh server instead of javascript
+#   @series_pattern: directory or glob pattern of dated count .csv files, adds a date slider over them
+#   @dedupe: leave copies of columns out of the html, see build_dashboard_sources
+#   @worker: sum the selection in a web worker of the page over packed counts, see build_dashboard_sources
+#   @county_counts_path: count .csv file of counties, adds a county layer and replaces counts_path
+#                        by its rollup to states, see load_dashboard_data
+#   @counties_map: county borders like bokeh.sampledata.us_counties, None for bokeh sampledata
+#   @max_workers: threads that run independent stages at the same time, 1 runs them one after another,
+#                 tracing allocations always runs them one after another, their peaks would mix otherwise
+#   @stage_cache: StageCache of stage results, only the stages whose inputs changed run, None to run all of them
+#return:
+#   DashboardBuild of the result of every stage and the StartupReport of their tasks,
+#   the layout is None when the html is written from the stage cache, and the world borders of the data
+#   are None when the simplified ones are taken from it
+###############################################
+
+DashboardBuild = namedtuple('DashboardBuild', ['data', 'state_count_cube', 'sources', 'layout', 'county_count_cube',
+    'startup'])
+
+def build_dashboard(counts_path = COUNT_FILEPATH, occupations_path = OCCUPATION_FILEPATH,
+        geo_cache = WORLD_GEO_CACHE, output = DASHBOARD_HTML, geojson_path = None, lazy = False, server_mode = False,
+        series_pattern = None, dedupe = True, worker = False, county_counts_path = None, counties_map = None,
+        max_workers = STARTUP_WORKERS, stage_cache = None):
+    shard_dir = get_shard_dir(output) if lazy and output is not None and not server_mode else None
+    trace = _stage_trace.get('trace')
+    if trace is not None and trace.memory:
+        max_workers = 1
+    wanted = ['data', 'aggregate', 'aggregate_counties', 'sources', 'save' if output is not None else 'render']
+    startup = run_startup_tasks(get_dashboard_tasks(counts_path, occupations_path, geo_cache, output, geojson_path,
+        shard_dir, server_mode, series_pattern, dedupe, worker, county_counts_path, counties_map), max_workers,
+        stage_cache, wanted)
+    results = startup.results
+    if startup.status['save'] == 'hit':
+        restore_dashboard(results['save'].html, output)
+    data = results['data']._replace(world = results.get('world'))
+    return DashboardBuild(data, results['aggregate'], results['sources'], results.get('render'),
+        results['aggregate_counties'], startup)
+
 
-#Display data
-multi_filter = VBox(widgetbox(select_experience), career_area_bar)
-tot =  HBox(multi_filter, gridplot([[mp]]))
+# shards of a html go to a directory named after it, so that dashboards in one directory never share shards
+def get_shard_dir(output):
+    return os.path.splitext(output)[0] + "_shards"
 
 
-show(tot)
+
+
+###############################################
+#shared store of what every server session of the same files builds the same: the count data, the aggregated
+#cube and the geometry columns, written once into one file and memory-mapped read-only by every session and
+#every server process, so that the os keeps one copy of its arrays in the page cache
+#every numpy array goes out of band of the pickle, aligned in the file, and is attached without a copy,
+#a list of arrays like the borders of a patches column goes as one flat array, and comes back as views of it,
+#records (namedtuples) are kept by their name, so that any session module can read them back
+#params:
+#   @path: store file
+#   @value: tree of records, dicts, lists, tuples, numpy arrays and plain values
+#return:
+#   read_shared_store gives the tree with read-only arrays backed by the file, or None if there is no valid store
+###############################################
+
+SHARED_STORE_DIR = ".dashboard_shared"
+
+# the version is part of the magic, a store of an older layout is not read
+SHARED_STORE_MAGIC = b'MCDVSHM2'
+SHARED_STORE_ALIGN = 64
+SHARED_RECORD_KEY = '__record__'
+SHARED_RAGGED_KEY = '__ragged__'
+
+@traced_stage('write_shared_store')
+def write_shared_store(path, value):
+    buffers = []
+    payload = pickle.dumps(to_shared_tree(value), protocol = 5, buffer_callback = buffers.append)
+    raws = [buffer.raw() for buffer in buffers]
+
+    # header: magic, payload size, number of buffers, (offset, size) of every buffer, then the payload
+    align = lambda offset: -(-offset // SHARED_STORE_ALIGN) * SHARED_STORE_ALIGN
+    offset = align(len(SHARED_STORE_MAGIC) + 16 + 16 * len(raws) + len(payload))
+    table = []
+    for raw in raws:
+        table.append((offset, raw.nbytes))
+        offset = align(offset + raw.nbytes)
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)))
+    temp_path = get_temp_path(path)
+    with open(temp_path, "wb") as f:
+        f.write(SHARED_STORE_MAGIC)
+        f.write(np.array([len(payload), len(raws)], dtype = '<u8').tobytes())
+        f.write(np.array(table, dtype = '<u8').reshape(-1, 2).tobytes())
+        f.write(payload)
+        for (start, size), raw in zip(table, raws):
+            f.seek(start)
+            f.write(raw)
+    # sessions that attached the old file keep their mapping of it
+    os.replace(temp_path, path)
+
+
+@traced_stage('read_shared_store')
+def read_shared_store(path):
+    try:
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    start = len(SHARED_STORE_MAGIC)
+    if mapped[:start] != SHARED_STORE_MAGIC:
+        return None
+    # a truncated or partly written store is no store, the caller builds it again
+    try:
+        n_payload, n_buffers = np.frombuffer(mapped, dtype = '<u8', count = 2, offset = start).tolist()
+        if start + 16 + 16 * n_buffers > len(mapped):
+            return None
+        table = np.frombuffer(mapped, dtype = '<u8', count = 2 * n_buffers, offset = start + 16).reshape(-1, 2).tolist()
+        start += 16 + 16 * n_buffers
+        if start + n_payload > len(mapped) or any(offset + size > len(mapped) for offset, size in table):
+            return None
+        view = memoryview(mapped)
+        buffers = [view[offset:offset + size] for offset, size in table]
+        return from_shared_tree(pickle.loads(view[start:start + n_payload], buffers = buffers))
+    except (ValueError, OverflowError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def to_shared_tree(value):
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        return {SHARED_RECORD_KEY: type(value).__name__, 'fields': [to_shared_tree(v) for v in value]}
+    if isinstance(value, dict):
+        return {k: to_shared_tree(v) for k, v in value.items()}
+    if is_ragged_list(value):
+        offsets = np.zeros(len(value) + 1, dtype = np.int64)
+        np.cumsum([len(v) for v in value], out = offsets[1:])
+        return {SHARED_RAGGED_KEY: np.concatenate(value), 'offsets': offsets}
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_shared_tree(v) for v in value)
+    # a memmap of the binary cache is written as the plain array it holds
+    if isinstance(value, np.ndarray) and type(value) is not np.ndarray:
+        return np.ascontiguousarray(value).view(np.ndarray)
+    return value
+
+
+def from_shared_tree(value):
+    if isinstance(value, dict):
+        if SHARED_RECORD_KEY in value:
+            return get_shared_record(value[SHARED_RECORD_KEY])(*[from_shared_tree(v) for v in value['fields']])
+        if SHARED_RAGGED_KEY in value:
+            flat, offsets = value[SHARED_RAGGED_KEY], value['offsets'].tolist()
+            return [flat[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return {k: from_shared_tree(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(from_shared_tree(v) for v in value)
+    return value
+
+
+# records of the count data come from map_count_distribution_data, the others are defined in this module
+SHARED_DATA_RECORDS = {record.__name__: record for record in (CountMatrix, CountSeries, OccupationIndex, StateCountCube)}
+
+def get_shared_record(name):
+    return SHARED_DATA_RECORDS[name] if name in SHARED_DATA_RECORDS else globals()[name]
+
+
+# a list of 1-d arrays of one dtype
+def is_ragged_list(value):
+    return (isinstance(value, list) and len(value) > 0
+        and all(isinstance(v, np.ndarray) and v.ndim == 1 and v.dtype == value[0].dtype for v in value)
+        and value[0].dtype != object)
+
+
+###############################################
+#give the store file of the server sessions of the same files, named after the paths, sizes and mtimes of them
+#params:
+#   @shared_dir: directory of shared stores
+#   @paths: input files of the dashboard, None for an input that is not used
+#return:
+#   path of the store file
+###############################################
+
+def get_shared_store_path(shared_dir, paths):
+    files = []
+    for path in paths:
+        if path is not None and os.path.isfile(path):
+            files.append([os.path.abspath(path), get_file_signature(path)])
+        else:
+            files.append(path)
+    key = json.dumps(dict(magic = SHARED_STORE_MAGIC.decode(), files = files), sort_keys = True)
+    return os.path.join(shared_dir, hashlib.sha1(key.encode()).hexdigest()[:16] + ".bin")
+
+
+###############################################
+#give the layout of a bokeh server session, the first session builds the dashboard and keeps its data and
+#sources in a shared store, every later session and server process renders from the store
+#params:
+#   same as build_dashboard
+#   @shared_dir: directory of shared stores, None builds every session on its own
+#return:
+#   layout of the dashboard
+###############################################
+
+# columns a session changes in place, every session keeps its own copy of them
+SESSION_COLUMNS = ['count']
+
+def get_server_dashboard(counts_path = COUNT_FILEPATH, occupations_path = OCCUPATION_FILEPATH,
+        geo_cache = WORLD_GEO_CACHE, geojson_path = None, series_pattern = None, county_counts_path = None,
+        counties_map = None, max_workers = STARTUP_WORKERS, shared_dir = SHARED_STORE_DIR):
+    build = lambda: build_dashboard(counts_path, occupations_path, geo_cache, None, geojson_path, server_mode = True,
+        series_pattern = series_pattern, county_counts_path = county_counts_path, counties_map = counties_map,
+        max_workers = max_workers)
+    if shared_dir is None:
+        return build().layout
+
+    series_paths = get_count_files(series_pattern) if series_pattern is not None else []
+    path = get_shared_store_path(shared_dir, [counts_path, occupations_path, geojson_path, county_counts_path]
+        + series_paths)
+    shared = read_shared_store(path)
+    if shared is None:
+        dashboard = build()
+        # sessions only render, borders and occupation info are in the sources and the occupation index already
+        data = dashboard.data._replace(world = None, geography = None, occupation_info = None)
+        if data.counties is not None:
+            data = data._replace(counties = data.counties._replace(geography = None))
+        try:
+            write_shared_store(path, dict(data = data, sources = dashboard.sources))
+        except OSError:
+            pass
+        return dashboard.layout
+
+    sources = shared['sources']
+    session_sources = dict(states = dict(sources.states),
+        counties = dict(sources.counties) if sources.counties is not None else None)
+    for columns in session_sources.values():
+        for name in SESSION_COLUMNS:
+            if columns is not None and name in columns:
+                columns[name] = np.array(columns[name])
+    return render_dashboard(shared['data'], sources._replace(**session_sources), server_mode = True)
+
+
+
+
+###############################################
+#build dashboards of many count files in a process pool,
+#world borders and occupation info are loaded once and shared by every worker
+#params:
+#   @counts_pattern: directory of count .csv files, or a glob pattern of them
+#   @occupations_path: occupation info .csv file shared by all count files
+#   @output_dir: directory of the html files, each named after its count file
+#   @geo_cache: .npz cache of the world borders, None means no cache
+#   @geojson_path: local world-geo json file, None to use the cache or the url
+#   @lazy: move count columns of every selector combination out to shards next to each html
+#   @max_workers: processes of the pool, None for the number of cpus
+#return:
+#   list of BatchResult in order of the count files, a throughput summary is printed at the end,
+#   under trace_stages the workers trace their stages too and their records join the trace
+#   world source and occupation info go to a shared store in the temp directory that every worker attaches,
+#   it is removed at the end
+###############################################
+
+BatchResult = namedtuple('BatchResult', ['counts_path', 'output', 'seconds', 'stage_seconds', 'trace_records'])
+
+def build_dashboards(counts_pattern, occupations_path = OCCUPATION_FILEPATH, output_dir = ".",
+        geo_cache = WORLD_GEO_CACHE, geojson_path = None, lazy = False, max_workers = None):
+    start = time.time()
+    counts_paths = get_count_files(counts_pattern)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    occupation_info = get_occupation_info(occupations_path)
+    world_source = build_world_source(load_geo_world(geo_cache, geojson_path))
+    # a directory only this user can enter, the workers unpickle the store
+    shared_dir = tempfile.mkdtemp(prefix = "dashboard-batch-")
+    shared_path = os.path.join(shared_dir, "batch.bin")
+
+    trace = _stage_trace.get('trace')
+    try:
+        write_shared_store(shared_path, dict(occupation_info = occupation_info, world_source = world_source))
+        with ProcessPoolExecutor(max_workers = max_workers, initializer = init_batch_worker,
+                initargs = (shared_path,)) as pool:
+            futures = []
+            for counts_path in counts_paths:
+                output = os.path.join(output_dir, os.path.splitext(os.path.basename(counts_path))[0] + ".html")
+                futures.append(pool.submit(build_batch_dashboard, counts_path, output, lazy,
+                    trace is not None, trace is not None and trace.memory))
+            results = [future.result() for future in futures]
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors = True)
+    if trace is not None:
+        for result in results:
+            trace.records.extend(result.trace_records)
+
+    print_batch_summary(results, time.time() - start)
+    return results
+
+
+# shared data of the worker process, set once by init_batch_worker
+_batch_shared = {}
+
+def init_batch_worker(shared_path):
+    _batch_shared.update(read_shared_store(shared_path))
+
+
+def build_batch_dashboard(counts_path, output, lazy = False, trace = False, trace_memory = False):
+    if trace:
+        with trace_stages(memory = trace_memory) as stage_trace:
+            result = build_batch_dashboard(counts_path, output, lazy)
+        return result._replace(trace_records = stage_trace.records)
+
+    start = time.time()
+    stage_seconds = OrderedDict()
+
+    # every count file is read only once, so keep no cache of parsed matrices in the worker
+    geography = get_states_geography()
+    count_matrix = align_count_rows(load_count_matrix(counts_path, cache = False), geography)
+    occupation_index = get_occupation_index(_batch_shared['occupation_info'], count_matrix)
+    data = DashboardData(count_matrix, _batch_shared['occupation_info'], occupation_index, None, geography, None, None)
+    stage_seconds['load'] = time.time() - start
+
+    t = time.time()
+    state_count_cube = aggregate_dashboard_data(data)
+    stage_seconds['aggregate'] = time.time() - t
+
+    t = time.time()
+    sources = build_dashboard_sources(data, state_count_cube, get_shard_dir(output) if lazy else None,
+        world_source = _batch_shared['world_source'])
+    stage_seconds['sources'] = time.time() - t
+
+    t = time.time()
+    render_dashboard(data, sources, output)
+    stage_seconds['render'] = time.time() - t
+
+    return BatchResult(counts_path, output, time.time() - start, stage_seconds, None)
+
+
+def print_batch_summary(results, seconds):
+    print("built %d dashboards in %.2f s, %.2f dashboards/s" % (
+        len(results), seconds, len(results) / seconds if seconds else float('inf')))
+    if results:
+        for stage in results[0].stage_seconds:
+            print("  %-10s mean %.3f s per dashboard" % (
+                stage, sum(result.stage_seconds[stage] for result in results) / len(results)))
+
+
+
+
+###############################################
+#command line entry point, writes the dashboard as a standalone html file
+#params:
+#   @argv: command line arguments, default as sys.argv
+###############################################
+
+def main(argv = None):
+    args = get_argument_parser().parse_args(argv)
+
+    if args.trace is not None:
+        with trace_stages(args.trace, args.trace_memory) as trace:
+            run_main(args)
+        print("stages traced to %s" % args.trace)
+        print_stage_trace(trace)
+    else:
+        run_main(args)
+
+
+def run_main(args):
+    if args.batch is not None:
+        build_dashboards(args.batch, args.occupations, args.output_dir, args.geo_cache, args.geojson,
+            args.lazy, args.workers)
+        return
+
+    build = build_dashboard(args.counts, args.occupations, args.geo_cache, args.output, args.geojson, args.lazy,
+        series_pattern = args.series, dedupe = not args.no_dedupe, worker = args.worker,
+        county_counts_path = args.counties, max_workers = args.threads,
+        stage_cache = StageCache(args.stage_cache) if not args.no_stage_cache else None)
+    if args.startup_report:
+        print_startup_report(build.startup)
+    if args.show:
+        webbrowser.open("file://" + os.path.abspath(args.output))
+
+
+# `bokeh serve map_count_distribution_visualization.py --args ...` takes the same data options
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description = "Build the job posting map dashboard as a standalone html file.")
+    parser.add_argument("--counts", default = COUNT_FILEPATH, help = "count .csv file, state x occupation id")
+    parser.add_argument("--occupations", default = OCCUPATION_FILEPATH, help = "occupation info .csv file")
+    parser.add_argument("--geo-cache", default = WORLD_GEO_CACHE, help = "cache file of the world borders")
+    parser.add_argument("--geojson", default = None, help = "local world-geo json file instead of the url")
+    parser.add_argument("-o", "--output", default = DASHBOARD_HTML, help = "html file to write")
+    parser.add_argument("--lazy", action = "store_true",
+        help = "fetch count columns of every selection from shards next to the html on demand")
+    parser.add_argument("--show", action = "store_true", help = "open the html in a browser")
+    parser.add_argument("--batch", default = None,
+        help = "directory or glob pattern of count .csv files, builds one html per file into --output-dir")
+    parser.add_argument("--output-dir", default = ".", help = "directory of the html files in batch mode")
+    parser.add_argument("--workers", type = int, default = None, help = "processes of the batch mode, default as cpus")
+    parser.add_argument("--series", default = None,
+        help = "directory or glob pattern of dated count .csv files (YYYY-MM in the name), adds a date slider")
+    parser.add_argument("--counties", default = None,
+        help = "count .csv file, county FIPS code x occupation id, adds counties to the map when zoomed in "
+            "(borders from bokeh sampledata, run bokeh.sampledata.download() first)")
+    parser.add_argument("--worker", action = "store_true",
+        help = "sum the selection in a web worker of the page over packed counts instead of count columns")
+    parser.add_argument("--no-dedupe", action = "store_true",
+        help = "keep columns that are copies of another one in the html")
+    parser.add_argument("--threads", type = int, default = STARTUP_WORKERS,
+        help = "threads that load and build independent stages at the same time, 1 for one after another")
+    parser.add_argument("--startup-report", action = "store_true",
+        help = "print when every startup task ran, the critical path among them and stage cache hits")
+    parser.add_argument("--stage-cache", default = STAGE_CACHE_DIR,
+        help = "directory of cached stage results, a stage only runs again when its inputs changed")
+    parser.add_argument("--no-stage-cache", action = "store_true", help = "run every stage")
+    parser.add_argument("--shared-dir", default = SHARED_STORE_DIR,
+        help = "directory of the store all bokeh server sessions and processes of the same files share")
+    parser.add_argument("--no-shared", action = "store_true",
+        help = "build the dashboard in every bokeh server session on its own")
+    parser.add_argument("--trace", default = None,
+        help = "chrome trace json file of the time of every build stage, e.g. for chrome://tracing")
+    parser.add_argument("--trace-memory", action = "store_true", help = "also trace allocations of every stage")
+    return parser
+
+
+if SERVER_MODE:
+    server_args = get_argument_parser().parse_args(sys.argv[1:])
+    curdoc().add_root(get_server_dashboard(server_args.counts, server_args.occupations, server_args.geo_cache,
+        server_args.geojson, server_args.series, server_args.counties, max_workers = server_args.threads,
+        shared_dir = None if server_args.no_shared else server_args.shared_dir))
+elif __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# tests run from the repository root or from tests/, the modules sit next to the data files in the root
+import csv
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+# rows of the count files, real state names so that they get their FIPS codes, in alphabetical order like the shipped counts
+STATE_NAMES = ['Alabama', 'Alaska', 'Arizona', 'California', 'Colorado', 'Texas']
+
+# id, firststep, starterjob, group id, group name, careerarea id, careerarea name
+OCCUPATIONS = [
+    (1, False, False, 63, 'General Managers', 15, 'Business Management and Operations'),
+    (2, True, True, 136, 'Retail Managers', 28, 'Sales'),
+    (3, False, True, 136, 'Retail Managers', 28, 'Sales'),
+    (4, True, False, 70, 'Accountants', 12, 'Finance'),
+    (5, False, True, 70, 'Accountants', 12, 'Finance'),
+    (6, False, False, 71, 'Auditors', 12, 'Finance'),
+    (7, True, True, 63, 'General Managers', 15, 'Business Management and Operations'),
+    (8, False, False, 136, 'Retail Managers', 28, 'Sales'),
+]
+
+# a count column that the occupation info does not know, it is left out of every aggregate
+UNKNOWN_OCCUPATION = 9
+
+
+def write_counts_csv(path, states, occupation_ids, counts):
+    with open(path, "w", newline = "") as csvfile:
+        writer = csv.writer(csvfile, quoting = csv.QUOTE_ALL)
+        writer.writerow(["State"] + [str(i) for i in occupation_ids])
+        for state, row in zip(states, counts):
+            writer.writerow([state] + [str(int(count)) for count in row])
+
+
+def write_occupations_csv(path, occupations = OCCUPATIONS):
+    with open(path, "w", newline = "") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['id', 'firststep', 'starterjob', 'occupation_group_id', 'occupation_group_name',
+            'careerarea_id', 'careerarea_name'])
+        for Id, firststep, starterjob, group_id, group, careerarea_id, careerarea in occupations:
+            writer.writerow([Id, str(firststep).upper(), str(starterjob).upper(), group_id, group,
+                careerarea_id, careerarea])
+
+
+# square states on a grid, like bokeh.sampledata.us_states
+def get_square_states_map(names = STATE_NAMES):
+    states_map = {}
+    for i, name in enumerate(names):
+        x, y = i % 3 * 10.0 - 120, i // 3 * 10.0 + 30
+        states_map['S%d' % i] = dict(name = name,
+            lons = [x, x + 10, x + 10, x], lats = [y, y, y + 10, y + 10])
+    return states_map
+
+
+@pytest.fixture
+def count_data():
+    rng = np.random.RandomState(7)
+    occupation_ids = [Id for Id, *_ in OCCUPATIONS] + [UNKNOWN_OCCUPATION]
+    counts = rng.randint(0, 1000, size = (len(STATE_NAMES), len(occupation_ids)))
+    return list(STATE_NAMES), occupation_ids, counts
+
+
+@pytest.fixture
+def data_files(tmp_path, count_data):
+    counts_path = str(tmp_path / "counts.csv")
+    occupations_path = str(tmp_path / "occupations.csv")
+    write_counts_csv(counts_path, *count_data)
+    write_occupations_csv(occupations_path)
+    return counts_path, occupations_path
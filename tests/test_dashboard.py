@@ -0,0 +1,75 @@
+import json
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("bokeh")
+
+import map_count_distribution_visualization as mcdv
+from conftest import get_square_states_map
+
+
+@pytest.fixture
+def build(tmp_path, data_files, monkeypatch):
+    monkeypatch.setattr(mcdv, 'get_states_map', get_square_states_map)
+    geojson_path = str(tmp_path / "world.json")
+    with open(geojson_path, "w") as f:
+        json.dump(dict(type = 'FeatureCollection', features = [dict(type = 'Feature', properties = dict(name = 'Land'),
+            geometry = dict(type = 'Polygon', coordinates = [[[-10, -10], [10, -10], [10, 10], [-10, 10]]]))]), f)
+    stage_cache = mcdv.StageCache(str(tmp_path / "stages"))
+
+    def build(output, lazy):
+        if not os.path.isdir(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+        return mcdv.build_dashboard(*data_files, geo_cache = str(tmp_path / "world.npz"), output = output,
+            geojson_path = geojson_path, lazy = lazy, max_workers = 1, stage_cache = stage_cache)
+    return build
+
+
+def read_html(output):
+    with open(output, "rb") as f:
+        return f.read()
+
+
+def test_switching_lazy_never_restores_the_other_html(tmp_path, build):
+    output = str(tmp_path / "out" / "dash.html")
+    shard_url = b"dash_shards/count_"
+
+    embedded = build(output, lazy = False)
+    assert embedded.startup.status['save'] == 'miss'
+    embedded_html = read_html(output)
+    assert shard_url not in embedded_html
+
+    lazy = build(output, lazy = True)
+    assert lazy.startup.status['save'] == 'miss'
+    assert lazy.sources.shard_files
+    lazy_html = read_html(output)
+    assert shard_url in lazy_html
+
+    # each of them is a hit of its own earlier build
+    assert build(output, lazy = False).startup.status['save'] == 'hit'
+    assert read_html(output) == embedded_html
+    assert build(output, lazy = True).startup.status['save'] == 'hit'
+    assert read_html(output) == lazy_html
+
+
+def test_cached_html_needs_its_shards(tmp_path, build):
+    output = str(tmp_path / "out" / "dash.html")
+    shard_dir = mcdv.get_shard_dir(output)
+    build(output, lazy = True)
+    assert build(output, lazy = True).startup.status['save'] == 'hit'
+
+    shutil.rmtree(shard_dir)
+    rebuilt = build(output, lazy = True)
+    assert rebuilt.startup.status['save'] == 'miss'
+    assert all(os.path.isfile(os.path.join(str(tmp_path / "out"), url)) for url in rebuilt.sources.shard_files.values())
+
+
+def test_cached_html_is_not_reused_elsewhere(tmp_path, build):
+    build(str(tmp_path / "out" / "dash.html"), lazy = True)
+    # another shard directory, and another html name that makes the shard urls
+    assert build(str(tmp_path / "other" / "dash.html"), lazy = True).startup.status['save'] == 'miss'
+    renamed = str(tmp_path / "out" / "renamed.html")
+    assert build(renamed, lazy = True).startup.status['save'] == 'miss'
+    assert b"renamed_shards/count_" in read_html(renamed)
@@ -0,0 +1,199 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import map_count_distribution_data as mcdd
+from conftest import ROOT, write_counts_csv
+
+
+def test_count_matrix_matches_csv(data_files, count_data):
+    states, occupation_ids, counts = count_data
+    count_matrix = mcdd.load_count_matrix(data_files[0])
+    assert count_matrix.states == states
+    assert list(count_matrix.occupation_ids) == occupation_ids
+    np.testing.assert_array_equal(count_matrix.counts, counts)
+    assert count_matrix.column_index == {Id: i for i, Id in enumerate(occupation_ids)}
+
+    columns = [occupation_ids.index(Id) for Id in (2, 5, 9)]
+    np.testing.assert_array_equal(mcdd.get_count_us_continent({2, 5, 9}, count_matrix),
+        counts[:, columns].sum(axis = 1))
+    assert mcdd.load_count_matrix(data_files[0]) is count_matrix
+
+
+
+def test_chunked_parse_matches_whole_parse(tmp_path, data_files, count_data):
+    states, occupation_ids, counts = count_data
+    for chunk_rows in [1, 2, 4, None]:
+        chunked = mcdd.load_count_matrix(data_files[0], cache = False, chunk_rows = chunk_rows)
+        assert chunked.states == states
+        np.testing.assert_array_equal(chunked.counts, counts)
+        assert chunked.counts.dtype == np.int32
+
+    subset = mcdd.load_count_matrix(data_files[0], cache = False, columns = [5, 2], chunk_rows = 4)
+    assert list(subset.occupation_ids) == [2, 5]
+    np.testing.assert_array_equal(subset.counts, counts[:, [1, 4]])
+
+    mapped = mcdd.load_count_matrix(data_files[0], cache = False, mmap_path = str(tmp_path / "counts.npy"))
+    np.testing.assert_array_equal(mapped.counts, counts)
+    np.testing.assert_array_equal(np.load(str(tmp_path / "counts.npy")), counts)
+
+
+def test_malformed_rows_are_rejected(tmp_path):
+    path = str(tmp_path / "bad.csv")
+    with open(path, "w") as f:
+        f.write('"State","1","2"\n"Alabama","3","4"\n"Alaska","5"\n')
+    with pytest.raises(ValueError):
+        mcdd.load_count_matrix(path, cache = False)
+
+
+def test_binary_cache_follows_csv_content(data_files, count_data):
+    states, occupation_ids, counts = count_data
+    assert mcdd.read_count_matrix_cache(data_files[0]) is None
+    mcdd.load_count_matrix(data_files[0], cache = False)
+    cached = mcdd.read_count_matrix_cache(data_files[0])
+    assert isinstance(cached.counts, np.memmap)
+    assert cached.states == states
+    np.testing.assert_array_equal(cached.counts, counts)
+    np.testing.assert_array_equal(mcdd.read_count_matrix_cache(data_files[0], columns = [3]).counts, counts[:, [2]])
+
+    # a touch keeps the content, the content hash tells so
+    stat = os.stat(data_files[0])
+    os.utime(data_files[0], ns = (stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert mcdd.read_count_matrix_cache(data_files[0]) is not None
+
+    changed = counts.copy()
+    changed[0, 0] += 1000
+    write_counts_csv(data_files[0], states, occupation_ids, changed)
+    assert mcdd.read_count_matrix_cache(data_files[0]) is None
+    np.testing.assert_array_equal(mcdd.load_count_matrix(data_files[0], cache = False).counts, changed)
+
+
+def test_file_changed_while_cached_is_not_cached(data_files, count_data, monkeypatch):
+    states, occupation_ids, counts = count_data
+    changed = counts.copy()
+    changed[0, 0] += 1000
+    parse_count_matrix = mcdd.parse_count_matrix
+
+    def parse_then_change(*args, **kwargs):
+        count_matrix = parse_count_matrix(*args, **kwargs)
+        if kwargs.get('mmap_path') is not None:
+            write_counts_csv(data_files[0], states, occupation_ids, changed)
+        return count_matrix
+    monkeypatch.setattr(mcdd, 'parse_count_matrix', parse_then_change)
+    np.testing.assert_array_equal(mcdd.load_count_matrix(data_files[0], cache = False).counts, changed)
+    assert mcdd.read_count_matrix_cache(data_files[0]) is None
+
+
+def test_occupation_info_cache_matches_csv(data_files):
+    parsed = mcdd.get_occupation_info(data_files[1], binary_cache = False)
+    assert mcdd.get_occupation_info(data_files[1]) == parsed
+    assert mcdd.read_occupation_rows_cache(data_files[1]) is not None
+    assert mcdd.get_occupation_info(data_files[1]) == parsed
+
+
+# occupation ids of every experience selector as the original script built them
+def get_experience_sets(occupation_info):
+    firststep, starterjob = occupation_info[:2]
+    return dict(
+        _2_year = set(firststep['True']),
+        _1_year = set(firststep['False']) & set(starterjob['True']),
+        _none = set(firststep['False']) & set(starterjob['False']))
+
+
+# career area sums as the original script built them, one set intersection per cell
+def get_baseline_counts(occupation_info, count_matrix):
+    careerarea, careerarea_name = occupation_info[3], occupation_info[5]
+    counts = {}
+    for name, experience_set in get_experience_sets(occupation_info).items():
+        for k, v in careerarea.items():
+            counts[name, careerarea_name[k]] = mcdd.get_count_us_continent(set(v) & experience_set, count_matrix)
+    return counts
+
+
+def check_cube_parity(counts_path, occupations_path):
+    count_matrix = mcdd.load_count_matrix(counts_path)
+    occupation_info = mcdd.get_occupation_info(occupations_path)
+    occupation_index = mcdd.get_occupation_index(occupation_info, count_matrix)
+    cube = mcdd.get_state_count_cube(occupation_index, count_matrix)
+
+    baseline = get_baseline_counts(occupation_info, count_matrix)
+    assert cube.counts.shape == (len(mcdd.EXPERIENCE_NAMES), len(cube.careerarea_names), len(count_matrix.states))
+    for e, experience in enumerate(cube.experience_names):
+        for a, careerarea in enumerate(cube.careerarea_names):
+            np.testing.assert_array_equal(cube.counts[e, a], baseline[experience, careerarea])
+
+
+def test_cube_matches_set_intersection_sums(data_files):
+    check_cube_parity(*data_files)
+
+
+def test_cube_matches_set_intersection_sums_of_shipped_data(tmp_path):
+    paths = []
+    for name in (mcdd.COUNT_FILEPATH, mcdd.OCCUPATION_FILEPATH):
+        shutil.copy(os.path.join(ROOT, name), str(tmp_path / name))
+        paths.append(str(tmp_path / name))
+    check_cube_parity(*paths)
+
+
+def test_occupation_mask_matches_occupation_sets(data_files):
+    count_matrix = mcdd.load_count_matrix(data_files[0])
+    occupation_info = mcdd.get_occupation_info(data_files[1])
+    occupation_index = mcdd.get_occupation_index(occupation_info, count_matrix)
+    occupationgroup, careerarea = occupation_info[2], occupation_info[3]
+    experience_sets = get_experience_sets(occupation_info)
+    experience_sets[None] = set.union(*experience_sets.values())
+
+    for experience, experience_set in experience_sets.items():
+        for careerareas in [None, [0], [0, 2]]:
+            for groups in [None, [1], [0, 3]]:
+                expected = set(experience_set)
+                if careerareas is not None:
+                    expected &= set().union(*[careerarea[occupation_index.careerarea_ids[a]] for a in careerareas])
+                if groups is not None:
+                    expected &= set().union(*[occupationgroup[occupation_index.group_ids[g]] for g in groups])
+                mask = mcdd.get_occupation_mask(occupation_index, experience, careerareas, groups)
+                assert set(count_matrix.occupation_ids[mask].tolist()) == expected
+                np.testing.assert_array_equal(mcdd.get_count_us_continent_mask(mask, count_matrix),
+                    mcdd.get_count_us_continent(expected, count_matrix))
+
+
+def test_selection_aggregator_matches_direct_sums(data_files):
+    count_matrix = mcdd.load_count_matrix(data_files[0])
+    occupation_index = mcdd.get_occupation_index(mcdd.get_occupation_info(data_files[1]), count_matrix)
+    mask = mcdd.get_occupation_mask(occupation_index, '_1_year')
+    careerarea_count = mcdd.get_careerarea_count_us_continent_mask(occupation_index, mask, count_matrix)
+    aggregator = mcdd.SelectionAggregator(careerarea_count, cache_size = 2)
+
+    np.testing.assert_array_equal(aggregator.count(), mcdd.get_count_us_continent_mask(mask, count_matrix))
+    selected = set()
+    for code in [0, 2, 1, 0, 2, 0, 1]:
+        selected ^= {code}
+        count = aggregator.toggle(code)
+        expected_mask = mcdd.get_occupation_mask(occupation_index, '_1_year', selected) if selected else mask
+        np.testing.assert_array_equal(count, mcdd.get_count_us_continent_mask(expected_mask, count_matrix))
+
+
+def test_count_matrix_cache_follows_file_changes(data_files, count_data):
+    states, occupation_ids, counts = count_data
+    first = mcdd.load_count_matrix(data_files[0])
+    assert mcdd.load_count_matrix(data_files[0]) is first
+
+    changed = counts.copy()
+    # one more digit, the signature changes even if the rewrite keeps the mtime of the same clock tick
+    changed[0, 0] += 1000
+    write_counts_csv(data_files[0], states, occupation_ids, changed)
+    second = mcdd.load_count_matrix(data_files[0])
+    assert second is not first
+    np.testing.assert_array_equal(second.counts, changed)
+    # the binary cache of the old file is not used either
+    np.testing.assert_array_equal(mcdd.load_count_matrix(data_files[0], cache = False).counts, changed)
+
+
+def test_memory_trace_needs_reset_peak(monkeypatch):
+    monkeypatch.delattr(mcdd.tracemalloc, 'reset_peak')
+    with pytest.raises(ValueError):
+        with mcdd.trace_stages(memory = True):
+            pass
+    assert mcdd._stage_trace.get('trace') is None
@@ -0,0 +1,163 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("bokeh")
+
+import map_count_distribution_visualization as mcdv
+from map_count_distribution_data import CountMatrix
+from conftest import STATE_NAMES, get_square_states_map
+
+
+# even-odd rule of every part of a patch, one point and one edge at a time
+def is_point_in_patch(xs, ys, lon, lat):
+    inside = False
+    parts, part = [], []
+    for x, y in zip(xs, ys):
+        if np.isnan(x) or np.isnan(y):
+            parts.append(part)
+            part = []
+        else:
+            part.append((x, y))
+    parts.append(part)
+    for part in parts:
+        if len(part) < 3:
+            continue
+        for (x0, y0), (x1, y1) in zip(part, part[1:] + part[:1]):
+            if (y0 > lat) != (y1 > lat) and lon < x0 + (lat - y0) * (x1 - x0) / (y1 - y0):
+                inside = not inside
+    return inside
+
+
+def lookup_brute_force(xs, ys, lons, lats):
+    patches = []
+    for lon, lat in zip(lons, lats):
+        found = [i for i in range(len(xs)) if is_point_in_patch(xs[i], ys[i], lon, lat)]
+        patches.append(found[0] if found else -1)
+    return np.array(patches, dtype = np.int64)
+
+
+def get_random_patches(rng, n):
+    xs, ys = [], []
+    for i in range(n):
+        x, y = rng.uniform(-100, 100), rng.uniform(-50, 50)
+        k = rng.randint(3, 9)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, k))
+        radius = rng.uniform(1, 12, k)
+        patch_x = list(x + radius * np.cos(angles))
+        patch_y = list(y + radius * np.sin(angles))
+        if i % 5 == 0:
+            # a hole in the middle, a second part of the same patch
+            patch_x += [np.nan, x - 0.5, x + 0.5, x + 0.5, x - 0.5]
+            patch_y += [np.nan, y - 0.5, y - 0.5, y + 0.5, y + 0.5]
+        xs.append(patch_x)
+        ys.append(patch_y)
+    return xs, ys
+
+
+def test_geo_index_matches_brute_force():
+    rng = np.random.RandomState(3)
+    xs, ys = get_random_patches(rng, 60)
+    # one patch without any part is never found
+    xs.append([])
+    ys.append([])
+    names = ["patch %d" % i for i in range(len(xs))]
+    index = mcdv.build_geo_index(xs, ys, names, node_size = 4)
+    assert len(index.levels) > 2
+
+    lons, lats = rng.uniform(-115, 115, 2000), rng.uniform(-65, 65, 2000)
+    patches = mcdv.lookup_geo_index(index, lons, lats)
+    np.testing.assert_array_equal(patches, lookup_brute_force(xs, ys, lons, lats))
+    assert (patches >= 0).any() and (patches < 0).any()
+    assert mcdv.get_geo_region_names(index, lons[:20], lats[:20]) == [
+        names[patch] if patch >= 0 else None for patch in patches[:20]]
+
+
+def test_far_apart_parts_are_boxed_apart():
+    # one patch of islands on both sides of the antimeridian, like Alaska, and one patch between them
+    xs = [[-179, -170, -170, -179, np.nan, 170, 179, 179, 170], [-10, 10, 10, -10]]
+    ys = [[50, 50, 60, 60, np.nan, 50, 50, 60, 60], [50, 50, 60, 60]]
+    index = mcdv.build_geo_index(xs, ys, ["islands", "between"])
+    assert list(index.parts) == [0, 0, 1]
+    lons, lats = np.array([-175.0, 175.0, 0.0, 100.0]), np.full(4, 55.0)
+    assert mcdv.get_geo_region_names(index, lons, lats) == ["islands", "islands", "between", None]
+    # only the part between them is tested for the point between them
+    parts, points = mcdv.get_geo_index_candidates(index, lons[2:], lats[2:])
+    assert list(zip(parts, points)) == [(2, 0)]
+
+
+def test_states_geo_index_finds_state_centers():
+    states_map = get_square_states_map()
+    states = sorted(states_map.values(), key = lambda state: state['name'])
+    index = mcdv.get_states_geo_index(states_map)
+    lons = [np.mean(state['lons']) for state in states]
+    lats = [np.mean(state['lats']) for state in states]
+    assert mcdv.get_geo_region_names(index, lons, lats) == [state['name'] for state in states]
+    assert mcdv.get_geo_region_names(index, [0.0], [0.0]) == [None]
+
+
+def test_align_count_rows_joins_by_fips_and_name():
+    geography = mcdv.get_states_geography(get_square_states_map())
+    assert geography.names == sorted(STATE_NAMES, key = lambda name: mcdv.STATE_FIPS[name])
+
+    # labels out of order, as unpadded FIPS codes and names, one unknown label and one state without a row
+    labels = ['48', 'Alabama', '6', 'Atlantis', 'Arizona']
+    counts = np.arange(len(labels) * 3).reshape(len(labels), 3)
+    with pytest.warns(UserWarning, match = "Atlantis"):
+        aligned = mcdv.align_count_rows(CountMatrix(labels, [1, 2, 3], counts, {1: 0, 2: 1, 3: 2}), geography)
+
+    assert aligned.states == geography.names
+    expected = np.zeros((len(geography.names), 3), dtype = counts.dtype)
+    for label, row in zip(['Texas', 'Alabama', 'California', 'Arizona'], [0, 1, 2, 4]):
+        expected[geography.names.index(label)] = counts[row]
+    np.testing.assert_array_equal(aligned.counts, expected)
+
+
+def test_align_count_rows_keeps_aligned_counts():
+    geography = mcdv.get_states_geography(get_square_states_map())
+    counts = np.ones((len(geography.names), 2), dtype = np.int32)
+    aligned = mcdv.align_count_rows(CountMatrix(list(geography.fips), [1, 2], counts, {1: 0, 2: 1}), geography)
+    assert aligned.counts is counts
+    assert aligned.states == geography.names
+
+
+def test_align_count_rows_rejects_duplicate_rows():
+    geography = mcdv.get_states_geography(get_square_states_map())
+    counts = np.ones((2, 1), dtype = np.int32)
+    with pytest.raises(ValueError):
+        mcdv.align_count_rows(CountMatrix(['Texas', '48'], [1], counts, {1: 0}), geography)
+
+
+def get_counties_map(states_map):
+    counties_map = {}
+    for k, state in enumerate(sorted(states_map.values(), key = lambda state: mcdv.STATE_FIPS[state['name']])):
+        # Alaska has no county, the others one more than the one before
+        n = 0 if state['name'] == 'Alaska' else k + 1
+        x, y = state['lons'][0], state['lats'][0]
+        for i in range(n):
+            counties_map[(int(mcdv.STATE_FIPS[state['name']]), i + 1)] = {'name': "County %d" % i,
+                'detailed name': "County %d, %s" % (i, state['name']),
+                'lons': [x + i, x + i + 1, x + i + 1, x + i], 'lats': [y, y, y + 1, y + 1]}
+    # a county of a state out of the map rolls up to no state
+    counties_map[(72, 1)] = {'name': "Adjuntas", 'lons': [0, 1, 1], 'lats': [0, 0, 1]}
+    return counties_map
+
+
+def test_geo_rollup_sums_counties_of_each_state():
+    states_map = get_square_states_map()
+    geography = mcdv.get_states_geography(states_map)
+    county_geography = mcdv.get_counties_geography(get_counties_map(states_map))
+    rollup = mcdv.get_geo_rollup(county_geography, geography)
+    assert rollup.shape == (len(geography.fips), len(county_geography.fips))
+
+    rng = np.random.RandomState(5)
+    counts = rng.randint(0, 100, size = (3, len(county_geography.fips)))
+    expected = np.zeros((3, len(geography.fips)), dtype = counts.dtype)
+    for county, parent in enumerate(county_geography.parents):
+        if parent in geography.fips:
+            expected[:, geography.fips.index(parent)] += counts[:, county]
+    np.testing.assert_array_equal(mcdv.rollup_counts(rollup, counts), expected)
+
+    county_matrix = CountMatrix(list(county_geography.names), [1, 2, 3], counts.T.copy(), {1: 0, 2: 1, 3: 2})
+    state_matrix = mcdv.rollup_count_matrix(rollup, county_matrix, geography)
+    assert state_matrix.states == geography.names
+    np.testing.assert_array_equal(state_matrix.counts, expected.T)
@@ -0,0 +1,140 @@
+import json
+import subprocess
+import sys
+import threading
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pytest
+
+import map_count_distribution_data as mcdd
+import map_count_distribution_query as mcdq
+from conftest import ROOT, write_counts_csv
+
+
+@pytest.fixture
+def engine(data_files):
+    return mcdq.load_query_engine(*data_files)
+
+
+def get_expected(engine, experience = None, careerareas = None, groups = None, occupations = None):
+    mask = mcdd.get_occupation_mask(engine.occupation_index, experience, careerareas, groups)
+    if occupations is not None:
+        selected = np.zeros(len(mask), dtype = bool)
+        selected[[engine.count_matrix.column_index[i] for i in occupations]] = True
+        mask &= selected
+    return mcdd.get_count_us_continent_mask(mask, engine.count_matrix)
+
+
+def test_queries_match_masked_sums(engine):
+    sales = engine.occupation_index.careerarea_names.index('Sales')
+    finance = engine.occupation_index.careerarea_names.index('Finance')
+    accountants = engine.occupation_index.group_names.index('Accountants')
+    np.testing.assert_array_equal(engine.count(dict()), get_expected(engine))
+    np.testing.assert_array_equal(engine.count(dict(experience = 'At least 1 year', careerareas = ['Sales', 12])),
+        get_expected(engine, '_1_year', [sales, finance]))
+    np.testing.assert_array_equal(engine.count(dict(groups = 'Accountants', occupations = ['4', 5, 6])),
+        get_expected(engine, None, None, [accountants], [4, 5, 6]))
+    # the occupation out of the occupation info is in no selection
+    assert engine.total(dict(occupations = [9])) == 0
+
+
+def test_batch_counts_every_distinct_query_once(engine):
+    queries = [dict(experience = '_2_year'), dict(careerareas = 'Sales'), dict(experience = '_2_year')]
+    counts = engine.count_batch(queries, states = ['Texas', 'Alabama'])
+    assert counts.shape == (3, 2)
+    np.testing.assert_array_equal(counts[0], counts[2])
+    assert engine.get_stats()['misses'] == 2 and engine.get_stats()['hits'] == 0
+
+    engine.count_batch(queries)
+    assert engine.get_stats()['hits'] == 2
+    # the result is a new array, changing it leaves the cache as it was
+    expected = engine.count(queries[0])
+    engine.count_batch(queries)[0] = -1
+    np.testing.assert_array_equal(engine.count(queries[0]), expected)
+
+
+def test_cache_keeps_most_recent_queries(data_files):
+    engine = mcdq.load_query_engine(*data_files, cache_size = 2)
+    for experience in ['_none', '_1_year', '_2_year', '_none']:
+        engine.count(dict(experience = experience))
+    stats = engine.get_stats()
+    assert stats['size'] == 2 and stats['hits'] == 0 and stats['misses'] == 4
+
+
+@pytest.mark.parametrize('query', [dict(experience = 'Ten years'), dict(careerareas = 'Fishing'),
+    dict(occupations = [99]), dict(occupations = ['4.5']), dict(occupations = [4.0]), dict(occupations = [True])])
+def test_bad_queries_are_rejected(engine, query):
+    with pytest.raises(ValueError):
+        engine.count(query)
+
+
+def test_unknown_states_are_rejected(engine):
+    with pytest.raises(ValueError):
+        engine.count(dict(), states = ['Atlantis'])
+
+
+def test_engine_loads_changed_files_again(engine, data_files, count_data):
+    states, occupation_ids, counts = count_data
+    before = engine.count(dict())
+    changed = counts.copy()
+    changed[:, 0] += 1000
+    write_counts_csv(data_files[0], states, occupation_ids, changed)
+    after = engine.count(dict())
+    np.testing.assert_array_equal(after - before, np.full(len(states), 1000))
+    assert engine.get_stats()['size'] == 1
+
+
+def test_refresh_during_a_batch_keeps_its_data(engine, data_files, count_data, monkeypatch):
+    states, occupation_ids, counts = count_data
+    queries = [dict(), dict(careerareas = 'Sales')]
+    before = [get_expected(engine, careerareas = careerareas) for careerareas in [None, [
+        engine.occupation_index.careerarea_names.index('Sales')]]]
+    get_occupation_mask = mcdd.get_occupation_mask
+
+    # the file changes, one occupation less, and another request refreshes while the batch counts its masks
+    def refresh_first(*args):
+        monkeypatch.setattr(mcdd, 'get_occupation_mask', get_occupation_mask)
+        write_counts_csv(data_files[0], states, occupation_ids[1:], counts[:, 1:] + 1000)
+        engine.refresh()
+        return get_occupation_mask(*args)
+    monkeypatch.setattr(mcdd, 'get_occupation_mask', refresh_first)
+    np.testing.assert_array_equal(engine.count_batch(queries), before)
+
+    # the counts of the old data are not cached for the new one
+    assert engine.get_stats()['size'] == 0
+    np.testing.assert_array_equal(engine.count(dict()), get_expected(engine))
+    assert not np.array_equal(engine.count(dict()), before[0])
+
+
+def test_engine_runs_without_bokeh(data_files):
+    # bokeh set to None in sys.modules fails any import of it
+    code = "import sys; sys.modules['bokeh'] = None; import map_count_distribution_query as mcdq; " \
+        "print(mcdq.load_query_engine(%r, %r).total(dict()))" % data_files
+    output = subprocess.check_output([sys.executable, "-c", code], cwd = ROOT)
+    assert int(output) == mcdq.load_query_engine(*data_files).total(dict())
+
+
+def test_http_endpoint(engine):
+    server = mcdq.get_query_server(engine, port = 0)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.start()
+    url = "http://%s:%d" % server.server_address[:2]
+    try:
+        result = json.loads(urlopen(url + "/count?careerarea=Sales&state=Texas&total=1").read().decode('utf-8'))
+        assert result == dict(totals = int(get_expected(engine, careerareas = [
+            engine.occupation_index.careerarea_names.index('Sales')])[engine.state_rows['Texas']]))
+
+        body = json.dumps(dict(queries = [dict(experience = '_none'), dict()])).encode('utf-8')
+        result = json.loads(urlopen(Request(url + "/count", data = body)).read().decode('utf-8'))
+        assert result['states'] == list(engine.count_matrix.states)
+        assert result['counts'][1] == get_expected(engine).tolist()
+
+        with pytest.raises(HTTPError) as error:
+            urlopen(url + "/count?occupation=four")
+        assert error.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
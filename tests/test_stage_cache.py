@@ -0,0 +1,111 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("bokeh")
+
+import map_count_distribution_visualization as mcdv
+from map_count_distribution_visualization import StartupTask
+
+
+def get_tasks(calls, source = 'a', scale = 2, cached = True):
+    def call(name, function):
+        def run(*args):
+            calls.append(name)
+            return function(*args)
+        return run
+    return [
+        StartupTask('load', call('load', lambda: np.arange(4)), [], dict(source = source), False),
+        StartupTask('other', call('other', lambda: 'other'), [], dict(), False),
+        StartupTask('scale', call('scale', lambda values: values * scale), ['load'], dict(scale = scale), cached),
+        StartupTask('total', call('total', lambda values: int(values.sum())), ['scale'], {}, cached),
+    ]
+
+
+def test_keys_follow_inputs_and_needs(tmp_path):
+    stage_cache = mcdv.StageCache(str(tmp_path))
+    keys = stage_cache.get_keys(get_tasks([]))
+    assert keys == mcdv.StageCache(str(tmp_path)).get_keys(get_tasks([]))
+    assert len(set(keys.values())) == len(keys)
+
+    # a new input changes the key of its task and of every task that needs it, and no other key
+    scaled = stage_cache.get_keys(get_tasks([], scale = 3))
+    assert [name for name in keys if scaled[name] != keys[name]] == ['scale', 'total']
+    loaded = stage_cache.get_keys(get_tasks([], source = 'b'))
+    assert [name for name in keys if loaded[name] != keys[name]] == ['load', 'scale', 'total']
+
+
+def test_unknown_inputs_have_no_key(tmp_path):
+    tasks = get_tasks([])
+    tasks[0] = tasks[0]._replace(inputs = None)
+    keys = mcdv.StageCache(str(tmp_path)).get_keys(tasks)
+    assert keys['load'] is None and keys['scale'] is None and keys['total'] is None
+    assert keys['other'] is not None
+
+
+def test_code_change_changes_keys(tmp_path):
+    stage_cache = mcdv.StageCache(str(tmp_path))
+    keys = stage_cache.get_keys(get_tasks([]))
+    stage_cache.code_key += "-changed"
+    assert all(stage_cache.get_keys(get_tasks([]))[name] != key for name, key in keys.items())
+
+
+def test_cached_results_are_hits_and_skip_what_they_need(tmp_path):
+    stage_cache = mcdv.StageCache(str(tmp_path))
+    calls = []
+    report = mcdv.run_startup_tasks(get_tasks(calls), 1, stage_cache, ['total'])
+    assert report.results['total'] == 12
+    assert report.status == dict(load = 'run', other = 'skip', scale = 'miss', total = 'miss')
+    assert calls == ['load', 'scale', 'total']
+
+    calls = []
+    report = mcdv.run_startup_tasks(get_tasks(calls), 1, stage_cache, ['total'])
+    assert report.results['total'] == 12
+    assert report.status == dict(load = 'skip', other = 'skip', scale = 'skip', total = 'hit')
+    assert calls == []
+
+    # a hit of an array comes back read-only from the store
+    report = mcdv.run_startup_tasks(get_tasks([]), 1, stage_cache, ['scale'])
+    assert report.status['scale'] == 'hit'
+    np.testing.assert_array_equal(report.results['scale'], np.arange(4) * 2)
+    assert not report.results['scale'].flags.writeable
+
+
+def test_changed_inputs_are_misses(tmp_path):
+    stage_cache = mcdv.StageCache(str(tmp_path))
+    mcdv.run_startup_tasks(get_tasks([]), 1, stage_cache, ['total'])
+    calls = []
+    report = mcdv.run_startup_tasks(get_tasks(calls, scale = 3), 1, stage_cache, ['total'])
+    assert report.results['total'] == 18
+    assert report.status['scale'] == 'miss' and report.status['total'] == 'miss'
+    assert calls == ['load', 'scale', 'total']
+
+
+def test_uncached_tasks_always_run(tmp_path):
+    stage_cache = mcdv.StageCache(str(tmp_path))
+    for _ in range(2):
+        calls = []
+        report = mcdv.run_startup_tasks(get_tasks(calls, cached = False), 2, stage_cache)
+        assert set(report.status.values()) == {'run'}
+        assert sorted(calls) == ['load', 'other', 'scale', 'total']
+    assert glob.glob(os.path.join(str(tmp_path), "*")) == []
+
+
+def test_least_recently_used_results_are_removed(tmp_path):
+    stage_cache = mcdv.StageCache(str(tmp_path), keep = 2)
+    for scale in range(4):
+        mcdv.run_startup_tasks(get_tasks([], scale = scale), 1, stage_cache, ['scale'])
+    assert len(glob.glob(os.path.join(str(tmp_path), "scale-*.bin"))) == 2
+
+
+def test_unreadable_result_is_a_miss(tmp_path):
+    stage_cache = mcdv.StageCache(str(tmp_path))
+    mcdv.run_startup_tasks(get_tasks([]), 1, stage_cache, ['total'])
+    for path in glob.glob(os.path.join(str(tmp_path), "total-*.bin")):
+        with open(path, "r+b") as f:
+            f.truncate(16)
+    report = mcdv.run_startup_tasks(get_tasks([]), 1, stage_cache, ['total'])
+    assert report.status['total'] == 'miss'
+    assert report.results['total'] == 12
@@ -0,0 +1,49 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("bokeh")
+
+import map_count_distribution_visualization as mcdv
+from map_count_distribution_visualization import StartupTask
+
+
+def get_tasks(calls, delay = 0):
+    lock = threading.Lock()
+    def call(name, function, seconds = 0):
+        def run(*args):
+            time.sleep(seconds)
+            with lock:
+                calls.append(name)
+            return function(*args)
+        return run
+    return [
+        StartupTask('slow', call('slow', lambda: 2, delay), [], None, False),
+        StartupTask('fast', call('fast', lambda: 3), [], None, False),
+        StartupTask('sum', call('sum', lambda slow, fast: slow + fast), ['slow', 'fast'], None, False),
+        StartupTask('double', call('double', lambda total: total * 2), ['sum'], None, False),
+    ]
+
+
+def test_tasks_run_after_what_they_need():
+    calls = []
+    report = mcdv.run_startup_tasks(get_tasks(calls, 0.05))
+    assert report.results == dict(slow = 2, fast = 3, sum = 5, double = 10)
+    assert calls.index('sum') > max(calls.index('slow'), calls.index('fast'))
+    assert calls[-1] == 'double'
+    # the sum waited for the slow task, not for the fast one
+    assert report.critical_path == ['slow', 'sum', 'double']
+    assert all(report.spans[name][0] <= report.spans[name][1] for name in report.results)
+
+
+def test_one_worker_keeps_the_order_of_the_list():
+    calls = []
+    mcdv.run_startup_tasks(get_tasks(calls), max_workers = 1)
+    assert calls == ['slow', 'fast', 'sum', 'double']
+
+
+def test_unknown_needs_are_rejected():
+    tasks = get_tasks([]) + [StartupTask('lost', lambda missing: missing, ['missing'], None, False)]
+    with pytest.raises(ValueError, match = "lost"):
+        mcdv.run_startup_tasks(tasks)